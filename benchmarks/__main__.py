@@ -0,0 +1,81 @@
+import json
+import shutil
+import tempfile
+
+import click
+
+from .suite import BENCHMARKS, environment, run_benchmarks
+from .tree import SIZE_DISTRIBUTIONS, generate_tree
+
+
+def _format(value, template):
+    return '-' if value is None else template.format(value)
+
+
+def _print_result(result):
+    click.echo("{0:<22} {1:>10} {2:>12} {3:>10} {4:>10}".format(
+        result['name'],
+        _format(result['seconds'], '{0:.3f}s'),
+        _format(result['files_per_second'], '{0:.0f}'),
+        _format(result['mb_per_second'], '{0:.1f}'),
+        _format(result['peak_rss'] / 1024 / 1024, '{0:.0f}MB'),
+    ))
+
+
+@click.group()
+def benchmarks():
+    pass
+
+
+@benchmarks.command()
+@click.option('--files', default=2000, type=click.IntRange(1), help="number of files in the generated tree")
+@click.option('--min-size', default=1024, type=click.IntRange(0), help="minimum file size in bytes")
+@click.option('--max-size', default=1024 * 1024, type=click.IntRange(0), help="maximum file size in bytes")
+@click.option('--distribution', default='lognormal', type=click.Choice(SIZE_DISTRIBUTIONS),
+              help="file size distribution")
+@click.option('--duplicates', default=0.2, type=click.FloatRange(0, 1), help="fraction of files which are a copy")
+@click.option('--depth', default=3, type=click.IntRange(0), help="directory depth of the generated tree")
+@click.option('--fanout', default=4, type=click.IntRange(1), help="subdirectories per directory")
+@click.option('--seed', default=0, help="random seed of the generated tree")
+@click.option('--repeat', default=3, type=click.IntRange(1), help="runs per benchmark, the fastest run is reported")
+@click.option('--only', multiple=True, type=click.Choice([name for name, _ in BENCHMARKS]),
+              help="only run this benchmark, can be repeated")
+@click.option('--output', type=click.Path(), help="save the results as JSON")
+def run(files, min_size, max_size, distribution, duplicates, depth, fanout, seed, repeat, only, output):
+    tree = {
+        'files': files, 'min_size': min_size, 'max_size': max(min_size, max_size), 'distribution': distribution,
+        'duplicate_ratio': duplicates, 'depth': depth, 'fanout': fanout, 'seed': seed,
+    }
+    root = tempfile.mkdtemp(prefix='hashdex-tree-')
+    try:
+        click.echo("Generating {0} files...".format(files))
+        summary = generate_tree(root, **tree)
+        click.echo("{0:<22} {1:>10} {2:>12} {3:>10} {4:>10}".format('benchmark', 'time', 'files/s', 'MB/s', 'peak RSS'))
+        results = []
+        for result in run_benchmarks(root, only, repeat):
+            _print_result(result)
+            results.append(result)
+    finally:
+        shutil.rmtree(root)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'environment': environment(), 'tree': dict(tree, **summary), 'results': results}, f, indent=2)
+
+
+@benchmarks.command()
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+def compare(baseline, current):
+    baseline = dict((result['name'], result) for result in json.load(baseline)['results'])
+    click.echo("{0:<22} {1:>11} {2:>11} {3:>8}".format('benchmark', 'baseline', 'current', 'change'))
+    for result in json.load(current)['results']:
+        before = baseline.get(result['name'])
+        if before is None:
+            continue
+        click.echo("{0:<22} {1:>10.3f}s {2:>10.3f}s {3:>+8.1%}".format(
+            result['name'], before['seconds'], result['seconds'], result['seconds'] / before['seconds'] - 1))
+
+
+if __name__ == '__main__':
+    benchmarks()
@@ -0,0 +1,185 @@
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from click.testing import CliRunner
+
+import hashdex
+from hashdex import chunks
+from hashdex.cli import cli
+from hashdex.files import DirectoryScanner
+from hashdex.hashing import Hasher
+from hashdex.indexer import Indexer, create_connection
+
+
+# every benchmark prepares its input outside of the measured time and returns a function which does the measured work
+# and returns the number of files and bytes it processed
+def _scan(root, workdir):
+    def run():
+        return len(DirectoryScanner(root).get_files()), None
+    return run
+
+
+def _hash(strategy):
+    def setup(root, workdir):
+        files = DirectoryScanner(root).get_files()
+        hasher = Hasher(strategy)
+
+        def run():
+            for file in files:
+                hasher.get_hashes(file)
+            return len(files), sum(file.stat.st_size for file in files)
+        return run
+    return setup
+
+
+def _chunk(chunker_class):
+    def setup(root, workdir):
+        # empty files are never chunked by the index
+        files = [file for file in DirectoryScanner(root).get_files() if file.stat.st_size]
+        chunker = chunker_class()
+
+        def run():
+            for file in files:
+                for _ in chunker.file_chunks(file.full_path):
+                    pass
+            return len(files), sum(file.stat.st_size for file in files)
+        return run
+    return setup
+
+
+def _build_index(workdir):
+    indexer = Indexer(create_connection(os.path.join(workdir, 'index.db')), Hasher())
+    indexer.build_db()
+    return indexer
+
+
+def _add_files(root, workdir):
+    files = DirectoryScanner(root).get_files()
+    indexer = _build_index(workdir)
+
+    def run():
+        list(indexer.add_files(files))
+        return len(files), sum(file.stat.st_size for file in files)
+    return run
+
+
+def _add_file(root, workdir):
+    files = DirectoryScanner(root).get_files()
+    indexer = _build_index(workdir)
+
+    def run():
+        for file in files:
+            indexer.add_file(file)
+        return len(files), sum(file.stat.st_size for file in files)
+    return run
+
+
+def _get_duplicates(root, workdir):
+    files = DirectoryScanner(root).get_files()
+    indexer = _build_index(workdir)
+    list(indexer.add_files(files))
+
+    def run():
+        duplicates = sum(len(result.get_files()) for result in indexer.get_duplicates())
+        return duplicates, None
+    return run
+
+
+def _invoke(*args):
+    result = CliRunner().invoke(cli, list(args))
+    if result.exit_code != 0:
+        raise RuntimeError("hashdex {0} failed:\n{1}".format(args[0], result.output))
+    return result
+
+
+def _command(name, indexed):
+    def setup(root, workdir):
+        index = os.path.join(workdir, 'index.db')
+        files = DirectoryScanner(root).get_files()
+        if indexed:
+            _invoke('add', root, '--index', index, '--no-cache', '--no-count')
+
+        def run():
+            if name == 'duplicates':
+                # only the index is read
+                _invoke('duplicates', '--index', index)
+                return len(files), None
+            _invoke(name, root, '--index', index, '--no-cache', '--no-count')
+            return len(files), sum(file.stat.st_size for file in files)
+        return run
+    return setup
+
+
+BENCHMARKS = [
+    ('scan', _scan),
+] + [
+    ('hash-{0}'.format(strategy), _hash(strategy)) for strategy in Hasher.STRATEGIES
+] + [
+    # the native backend is only measured when the fastcdc package is installed
+    ('chunk-{0}'.format(backend), _chunk(chunks.CHUNKERS[backend]))
+    for backend in sorted(set([chunks.PYTHON, chunks.default_backend()]))
+] + [
+    ('add-files', _add_files),
+    ('add-file', _add_file),
+    ('get-duplicates', _get_duplicates),
+    ('cli-add', _command('add', False)),
+    ('cli-check', _command('check', True)),
+    ('cli-duplicates', _command('duplicates', True)),
+]
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(name, root, repeat=3):
+    setup = dict(BENCHMARKS)[name]
+    workdir = tempfile.mkdtemp(prefix='hashdex-benchmark-')
+    try:
+        timings = []
+        for i in range(repeat):
+            run = setup(root, tempfile.mkdtemp(dir=workdir))
+            started = time.perf_counter()
+            files, size = run()
+            timings.append(time.perf_counter() - started)
+    finally:
+        shutil.rmtree(workdir)
+
+    # the fastest run is the least disturbed by everything else running on the machine
+    seconds = min(timings)
+    return {
+        'name': name,
+        'seconds': seconds,
+        'timings': timings,
+        'files': files,
+        'bytes': size,
+        'files_per_second': files / seconds if seconds else None,
+        'mb_per_second': size / seconds / 1024 / 1024 if seconds and size is not None else None,
+        'peak_rss': _peak_rss(),
+    }
+
+
+def run_benchmarks(root, names=None, repeat=3):
+    # every benchmark runs in a new process, so the peak memory usage only covers that benchmark
+    for name, _ in BENCHMARKS:
+        if names and name not in names:
+            continue
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            yield executor.submit(measure, name, root, repeat).result()
+
+
+def environment():
+    return {
+        'hashdex': hashdex.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
@@ -0,0 +1,61 @@
+import math
+import os
+import random
+import shutil
+
+SIZE_DISTRIBUTIONS = ('uniform', 'lognormal')
+
+
+def _directories(root, depth, fanout):
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, 'dir{0}'.format(i)) for parent in level for i in range(fanout)]
+        directories.extend(level)
+
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+
+def _size(rng, distribution, min_size, max_size):
+    if distribution == 'uniform':
+        return rng.randint(min_size, max_size)
+
+    # most files are small with a long tail of large files, the median is halfway between min and max on a log scale
+    median = math.sqrt(max(min_size, 1) * max_size)
+    return int(min(max(rng.lognormvariate(math.log(median), 1.0), min_size), max_size))
+
+
+def _content(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
+def generate_tree(root, files=1000, min_size=1024, max_size=1024 * 1024, distribution='lognormal',
+                  duplicate_ratio=0.2, depth=3, fanout=4, seed=0):
+    # the same arguments always generate the same tree, so results of different versions can be compared
+    if distribution not in SIZE_DISTRIBUTIONS:
+        raise ValueError("unknown size distribution {0}".format(distribution))
+
+    rng = random.Random(seed)
+    directories = _directories(root, depth, fanout)
+    originals = []
+    duplicates = 0
+    total_size = 0
+    for i in range(files):
+        path = os.path.join(rng.choice(directories), 'file{0:06d}.bin'.format(i))
+        if originals and rng.random() < duplicate_ratio:
+            shutil.copyfile(rng.choice(originals), path)
+            duplicates += 1
+        else:
+            with open(path, 'wb') as f:
+                f.write(_content(rng, _size(rng, distribution, min_size, max_size)))
+            originals.append(path)
+        total_size += os.path.getsize(path)
+
+    return {
+        'files': files,
+        'duplicates': duplicates,
+        'directories': len(directories),
+        'bytes': total_size,
+    }
@@ -0,0 +1,124 @@
+import time
+
+from .files import stat_file
+
+DEFAULT_CACHE_LOCATION = '~/.config/hashdex/cache.db'
+
+
+class HashCache(object):
+    # number of new entries and hits written to the cache at once
+    BATCH_SIZE = 500
+    MAX_ENTRIES = 1000000
+
+    def __init__(self, connection, max_entries=MAX_ENTRIES):
+        self.connection = connection
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stored = {}
+        self._used = []
+        self._build()
+
+    def _build(self):
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                strategy TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                sha1_hash TEXT NOT NULL,
+                md5_hash TEXT NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (device, inode, size, mtime_ns, strategy, algorithm)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache (last_used)")
+        self.connection.commit()
+
+    def _key(self, file, strategy, algorithm):
+        stat = stat_file(file)
+        # without an inode number a file can't be told apart from the file which replaced it
+        if not stat.st_ino:
+            return None
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, strategy, algorithm)
+
+    def get(self, file, strategy, algorithm):
+        key = self._key(file, strategy, algorithm)
+        if key is None:
+            return None
+
+        if key in self._stored:
+            self.hits += 1
+            return self._stored[key]
+
+        row = self.connection.execute("""
+            SELECT sha1_hash, md5_hash
+            FROM cache
+            WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND strategy = ? AND algorithm = ?
+        """, key).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._used.append(key)
+        self._flush_if_full()
+        return (row[0], row[1])
+
+    def put(self, file, strategy, algorithm, hashes):
+        key = self._key(file, strategy, algorithm)
+        if key is not None:
+            self._stored[key] = tuple(hashes)
+            self._flush_if_full()
+
+    def _flush_if_full(self):
+        if len(self._stored) + len(self._used) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._stored and not self._used:
+            return
+
+        now = int(time.time())
+        self.connection.executemany("""
+            INSERT OR REPLACE INTO cache
+            (device, inode, size, mtime_ns, strategy, algorithm, sha1_hash, md5_hash, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [key + hashes + (now,) for key, hashes in self._stored.items()])
+        self.connection.executemany("""
+            UPDATE cache SET last_used = ?
+            WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND strategy = ? AND algorithm = ?
+        """, [(now,) + key for key in self._used])
+        self.connection.commit()
+
+        self._stored = {}
+        self._used = []
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def size(self):
+        page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def prune(self, max_entries=None):
+        # the least recently used entries are removed first
+        max_entries = self.max_entries if max_entries is None else max_entries
+        self.flush()
+        cursor = self.connection.execute("""
+            DELETE FROM cache WHERE rowid IN (
+                SELECT rowid FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (max_entries, ))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.flush()
+        if self.count() > self.max_entries:
+            self.prune()
+        self.connection.close()
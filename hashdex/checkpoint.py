@@ -0,0 +1,54 @@
+import os
+from collections import Counter
+
+
+# journal of the directories of which all files are stored in the index. The scanner yields the files of a directory
+# one after another, a directory is complete once the scanner moved on to another directory and the batches holding
+# all of its files are committed. Completed directories are stored in the transaction of the batch which completed
+# them, so the journal never gets ahead of the index.
+class Checkpoint(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._pending = Counter()
+        self._listed = set()
+        self._current = None
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint ( path TEXT PRIMARY KEY ) WITHOUT ROWID")
+        self.connection.commit()
+
+    def completed_directories(self):
+        return set(row[0] for row in self.connection.execute("SELECT path FROM checkpoint"))
+
+    def clear(self):
+        self.connection.execute("DELETE FROM checkpoint")
+        self.connection.commit()
+
+    def track(self, files):
+        for file in files:
+            directory = os.path.dirname(file.full_path)
+            if directory != self._current:
+                self._finish_listing()
+                self._current = directory
+            self._pending[directory] += 1
+            yield file
+        self._finish_listing()
+
+    def _finish_listing(self):
+        if self._current is not None:
+            self._listed.add(self._current)
+            self._current = None
+
+    def _completed(self, files):
+        counts = Counter(os.path.dirname(file.full_path) for file in files)
+        return [directory for directory in self._listed if self._pending[directory] == counts[directory]]
+
+    def store(self, cursor, files):
+        cursor.executemany(
+            "INSERT OR IGNORE INTO checkpoint (path) VALUES (?)", [(path, ) for path in self._completed(files)])
+
+    def committed(self, files):
+        completed = self._completed(files)
+        self._pending.subtract(Counter(os.path.dirname(file.full_path) for file in files))
+        for directory in completed:
+            self._listed.remove(directory)
+            del self._pending[directory]
@@ -0,0 +1,264 @@
+import hashlib
+import random
+
+from .files import stat_file
+from .indexer import UNCHANGED, split_path, _batches
+from .stats import measure
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # pragma: no cover
+    fastcdc_cy = None
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+PYTHON = 'python'
+FASTCDC = 'fastcdc'
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _gear_table():
+    # random values of every byte for the gear hash, generated from a fixed seed so chunk boundaries never change
+    rng = random.Random(0x6861736864657)
+    return tuple(rng.getrandbits(64) for _ in range(256))
+
+
+_GEAR = _gear_table()
+
+
+def _mask(bits):
+    # the gear hash shifts every byte one bit further to the left, so the high bits depend on the last 64 bytes while
+    # the low bits only depend on the last few bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+class Chunker(object):
+    # content defined chunking with FastCDC: a gear hash rolls over the content and a chunk ends where the masked bits
+    # of the hash are all zero, so inserting or removing bytes only changes the chunks around the change. The first
+    # min_size bytes of a chunk are skipped, a stricter mask is used before avg_size and a looser one after it
+    READ_SIZE = 1 << 20
+
+    def __init__(self, avg_size=DEFAULT_CHUNK_SIZE):
+        if avg_size < 256 or avg_size & (avg_size - 1):
+            raise ValueError("the average chunk size must be a power of two of at least 256 bytes")
+
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 4
+        bits = avg_size.bit_length() - 1
+        self._mask_small = _mask(bits + 2)
+        self._mask_large = _mask(bits - 2)
+
+    def _cut_point(self, data, start, end):
+        if end - start <= self.min_size:
+            return end
+
+        gear = _GEAR
+        normal = min(start + self.avg_size, end)
+        value = 0
+        mask = self._mask_small
+        for i in range(start + self.min_size, normal):
+            value = ((value << 1) + gear[data[i]]) & _MASK_64
+            if not value & mask:
+                return i + 1
+
+        mask = self._mask_large
+        for i in range(normal, end):
+            value = ((value << 1) + gear[data[i]]) & _MASK_64
+            if not value & mask:
+                return i + 1
+        return end
+
+    def chunks(self, f):
+        # the file is streamed, at most max_size bytes plus one read are held in memory
+        buffer = b''
+        position = 0
+        offset = 0
+        eof = False
+        while True:
+            if not eof and len(buffer) - position < self.max_size:
+                content = f.read(self.READ_SIZE)
+                eof = not content
+                buffer = buffer[position:] + content
+                position = 0
+                continue
+
+            if position >= len(buffer):
+                return
+
+            end = self._cut_point(buffer, position, min(position + self.max_size, len(buffer)))
+            view = memoryview(buffer)[position:end]
+            yield offset, end - position, hashlib.sha1(view).digest()
+            view.release()
+            offset += end - position
+            position = end
+
+    def file_chunks(self, path):
+        with open(path, 'rb') as f:
+            for chunk in self.chunks(f):
+                yield chunk
+
+
+class NativeChunker(Chunker):
+    # FastCDC of the fastcdc package, which chunks memory mapped files in C. It uses another gear table, so its chunk
+    # boundaries never match those of the Chunker
+    def file_chunks(self, path):
+        for chunk in fastcdc_cy(path, self.min_size, self.avg_size, self.max_size, fat=True):
+            yield chunk.offset, chunk.length, hashlib.sha1(chunk.data).digest()
+
+
+CHUNKERS = {
+    PYTHON: Chunker,
+    FASTCDC: NativeChunker,
+}
+
+
+def default_backend():
+    return PYTHON if fastcdc_cy is None else FASTCDC
+
+
+class ChunkIndex(object):
+    # number of chunks written at once
+    BATCH_SIZE = 1000
+
+    def __init__(self, indexer, avg_size=None):
+        self.indexer = indexer
+        self.connection = indexer.connection
+        self.stats = indexer.stats
+        self._avg_size = avg_size
+        self.chunker = None
+
+    def build(self):
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                chunk_id INTEGER PRIMARY KEY,
+                digest BLOB NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks ON chunks ( digest )")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                dir_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                chunk_id INTEGER NOT NULL,
+                PRIMARY KEY (dir_id, name, position)
+            ) WITHOUT ROWID
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_file_chunks ON file_chunks ( chunk_id )")
+
+        # chunks of different sizes or backends never match, the chunk size and backend of the first chunked files are
+        # used for all others. Indexes chunked before the backend was stored are chunked in python
+        stored = self.indexer.get_meta('chunk_size')
+        if stored is None:
+            self.indexer.set_meta('chunk_size', self._avg_size or DEFAULT_CHUNK_SIZE)
+            self.indexer.set_meta('chunker', default_backend())
+        elif self._avg_size is not None and int(stored) != self._avg_size:
+            raise ValueError("the index is chunked with an average chunk size of {0} bytes".format(stored))
+
+        backend = self.indexer.get_meta('chunker', PYTHON)
+        if backend == FASTCDC and fastcdc_cy is None:
+            raise ValueError("the index is chunked with the fastcdc package, install it with hashdex[chunks]")
+        self.chunker = CHUNKERS[backend](int(self.indexer.get_meta('chunk_size')))
+        self.connection.commit()
+
+    def _chunk_ids(self, cursor, chunks):
+        cursor.executemany(
+            "INSERT OR IGNORE INTO chunks (digest, size) VALUES (?,?)", [(digest, size) for _, size, digest in chunks])
+        return dict(
+            (bytes(digest), chunk_id)
+            for chunk_id, digest in self.indexer._select_in(
+                "SELECT chunk_id, digest FROM chunks WHERE digest IN ({0})", [digest for _, _, digest in chunks])
+        )
+
+    def _store_file(self, cursor, file):
+        directory, name = split_path(file.full_path)
+        dir_id = self.indexer.directory_ids(cursor, [directory])[directory]
+        cursor.execute("DELETE FROM file_chunks WHERE dir_id = ? AND name = ?", (dir_id, name))
+
+        for chunks in _batches(self.chunker.file_chunks(file.full_path), self.BATCH_SIZE):
+            chunk_ids = self._chunk_ids(cursor, chunks)
+            cursor.executemany(
+                "INSERT INTO file_chunks (dir_id, name, position, chunk_id) VALUES (?,?,?,?)",
+                [(dir_id, name, offset, chunk_ids[digest]) for offset, _, digest in chunks]
+            )
+
+    def _is_chunked(self, file):
+        return self.connection.execute("""
+            SELECT 1
+            FROM file_chunks c
+            JOIN directories d ON d.dir_id = c.dir_id
+            WHERE d.path = ? AND c.name = ?
+            LIMIT 1
+        """, split_path(file.full_path)).fetchone() is not None
+
+    def _needs_chunks(self, file, status):
+        if status is None or stat_file(file).st_size == 0:
+            return False
+        return status != UNCHANGED or not self._is_chunked(file)
+
+    def add_file(self, file):
+        cursor = self.connection.cursor()
+        try:
+            measure(self.stats, 'chunk', 1, stat_file(file).st_size, self._store_file, cursor, file)
+        except (IOError, OSError):
+            # the chunks of a file which can't be read are left out, the whole file is still indexed
+            self.connection.rollback()
+            return False
+        self.connection.commit()
+        return True
+
+    def add_files(self, results):
+        # the results of Indexer.add_files are passed through, the chunks of every file are committed at once
+        self.build()
+        for file, status in results:
+            if self._needs_chunks(file, status):
+                self.add_file(file)
+            yield file, status
+
+    def _create_shared_table(self):
+        # chunks which occur in more than one file
+        self.connection.execute("DROP TABLE IF EXISTS temp.shared_chunks")
+        self.connection.execute("""
+            CREATE TEMP TABLE shared_chunks AS
+            SELECT chunk_id
+            FROM (SELECT DISTINCT chunk_id, dir_id, name FROM file_chunks)
+            GROUP BY chunk_id
+            HAVING COUNT(*) > 1
+        """)
+
+    def shared_files(self, limit=None):
+        if not self.indexer.has_table('file_chunks'):
+            return []
+        self._create_shared_table()
+        return self.connection.execute("""
+            SELECT d.path || fc.name, SUM(c.size), SUM(CASE WHEN s.chunk_id IS NULL THEN 0 ELSE c.size END) AS shared
+            FROM file_chunks fc
+            JOIN files f ON f.dir_id = fc.dir_id AND f.name = fc.name
+            JOIN directories d ON d.dir_id = fc.dir_id
+            JOIN chunks c ON c.chunk_id = fc.chunk_id
+            LEFT JOIN shared_chunks s ON s.chunk_id = fc.chunk_id
+            GROUP BY fc.dir_id, fc.name
+            HAVING shared > 0
+            ORDER BY shared DESC, d.path || fc.name
+            LIMIT ?
+        """, (-1 if limit is None else limit, ))
+
+    def shared_directories(self, limit=None):
+        if not self.indexer.has_table('file_chunks'):
+            return []
+        self._create_shared_table()
+        return self.connection.execute("""
+            SELECT d.path, SUM(c.size), SUM(CASE WHEN s.chunk_id IS NULL THEN 0 ELSE c.size END) AS shared
+            FROM file_chunks fc
+            JOIN files f ON f.dir_id = fc.dir_id AND f.name = fc.name
+            JOIN directories d ON d.dir_id = fc.dir_id
+            JOIN chunks c ON c.chunk_id = fc.chunk_id
+            LEFT JOIN shared_chunks s ON s.chunk_id = fc.chunk_id
+            GROUP BY fc.dir_id
+            HAVING shared > 0
+            ORDER BY shared DESC, d.path
+            LIMIT ?
+        """, (-1 if limit is None else limit, ))
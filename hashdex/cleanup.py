@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Cleaner(object):
+    def __init__(self, indexer, jobs=1, dry_run=False, batch_size=None):
+        self.indexer = indexer
+        self.jobs = jobs
+        self.dry_run = dry_run
+        self.batch_size = batch_size or indexer.BATCH_SIZE
+
+    def _list_directory(self, path):
+        entries = os.scandir(path)
+        try:
+            names = set()
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        names.add(entry.name)
+                except OSError:
+                    # the file can't be checked, it is kept in the index
+                    names.add(entry.name)
+            return names
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+
+    def _find_missing(self, directory):
+        dir_id, path, names = directory
+        try:
+            existing = self._list_directory(path)
+        except (FileNotFoundError, NotADirectoryError):
+            existing = set()
+        except OSError:
+            # the files of a directory which can't be listed may still exist
+            return dir_id, path, []
+        return dir_id, path, [name for name in names if name not in existing]
+
+    def _missing_files(self):
+        directories = self.indexer.iter_directories()
+        if self.jobs <= 1:
+            for directory in directories:
+                yield self._find_missing(directory)
+            return
+
+        # directories are listed in a thread pool, at most two directories per worker are listed ahead of the deletes
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = set()
+            for directory in directories:
+                pending.add(executor.submit(self._find_missing, directory))
+                if len(pending) >= self.jobs * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+            for future in pending:
+                yield future.result()
+
+    def _delete(self, files):
+        if files and not self.dry_run:
+            self.indexer.delete_files(files)
+
+    def clean(self):
+        batch = []
+        for dir_id, path, missing in self._missing_files():
+            for name in missing:
+                batch.append((dir_id, name))
+                yield path + name
+
+            if len(batch) >= self.batch_size:
+                self._delete(batch)
+                batch = []
+        self._delete(batch)
+
+        # hashes and directories no longer used by any file are removed once, after all files are removed
+        if not self.dry_run:
+            self.indexer.purge_orphans()
@@ -1,12 +1,123 @@
+import functools
 import os
+from collections import Counter
+from contextlib import ExitStack
+
 import click
 import hashdex
+from . import migrations
 from .files import DirectoryScanner
-from .indexer import Indexer, Hasher, create_connection
+from .hashing import ParallelHasher, BACKENDS, ALGORITHMS
+from .indexer import Indexer, Hasher, create_connection, NEW, CHANGED, UNCHANGED, PROFILES, DEFAULT_PROFILE
+from .verify import Verifier
+from .cache import HashCache, DEFAULT_CACHE_LOCATION
+from .cleanup import Cleaner
+from .checkpoint import Checkpoint
+from .stats import Stats
+from .chunks import ChunkIndex, DEFAULT_CHUNK_SIZE
+from .trees import TreeIndex
+from .dedupe import Deduplicator, LINKS, HARDLINK
+from .perceptual import PerceptualIndex, DEFAULT_DISTANCE, AVAILABLE as IMAGES_AVAILABLE, is_image
 
 DEFAULT_INDEX_LOCATION = '~/.config/hashdex/index.db'
 
 
+def current_stats():
+    ctx = click.get_current_context(silent=True)
+    return ctx.meta.get('hashdex.stats') if ctx is not None else None
+
+
+def with_stats(command):
+    # statistics are only collected when they are shown, scanners, hashers and indexers of the command pick them up
+    # from the click context
+    @click.option('--stats', 'show_stats', default=False, is_flag=True, help="show the time spent in every stage")
+    @click.option('--stats-json', type=click.Path(allow_dash=True),
+                  help="write the time spent in every stage as JSON to this file, - for stdout")
+    @functools.wraps(command)
+    def wrapper(show_stats, stats_json, **kwargs):
+        stats = Stats() if show_stats or stats_json else None
+        click.get_current_context().meta['hashdex.stats'] = stats
+        command(**kwargs)
+
+        if show_stats:
+            click.echo(stats.summary(), err=True)
+        if stats_json:
+            with click.open_file(stats_json, 'w') as f:
+                f.write(stats.to_json() + "\n")
+    return wrapper
+
+
+def create_hasher(jobs=1, backend='threads', strategy=Hasher.SAMPLED, algorithm=Hasher.DEFAULT_ALGORITHM,
+                  use_mmap=False, cache=None):
+    hasher = Hasher(strategy, algorithm, use_mmap, cache)
+    hasher.stats = current_stats()
+    if jobs > 1:
+        return ParallelHasher(hasher, jobs, backend)
+    return hasher
+
+
+def open_cache(location, enabled=True, resources=None):
+    if not enabled:
+        return None
+    cache = HashCache(create_connection(location))
+    if resources is not None:
+        # the cache is flushed even when the command fails
+        resources.callback(cache.close)
+    return cache
+
+
+def open_perceptual(indexer, jobs=1):
+    if not IMAGES_AVAILABLE:
+        raise click.UsageError("finding similar images needs Pillow, install it with: pip install hashdex[images]")
+    return PerceptualIndex(indexer, jobs)
+
+
+def open_chunk_index(indexer, chunk_size=None):
+    chunk_index = ChunkIndex(indexer, chunk_size)
+    try:
+        chunk_index.build()
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    return chunk_index
+
+
+def open_indexer(index, jobs=1, backend='threads', strategy=None, algorithm=None, use_mmap=False, cache=None,
+                 profile=DEFAULT_PROFILE, read_only=False, resources=None):
+    if read_only and not os.path.exists(os.path.expanduser(index)):
+        raise click.UsageError("index {0} does not exist".format(index))
+
+    indexer = Indexer(create_connection(index, profile, read_only), None)
+    indexer.read_only = read_only
+    indexer.stats = current_stats()
+    built = indexer.is_built()
+    if read_only and not built:
+        raise click.UsageError("index {0} has to be created by another command first".format(index))
+    elif built:
+        try:
+            indexer.check_schema()
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        indexed_strategy, indexed_algorithm = indexer.get_hasher_settings()
+        strategy = strategy or indexed_strategy
+        algorithm = algorithm or indexed_algorithm
+
+    indexer.hasher = create_hasher(
+        jobs, backend, strategy or Hasher.SAMPLED, algorithm or Hasher.DEFAULT_ALGORITHM, use_mmap, cache)
+    if resources is not None and isinstance(indexer.hasher, ParallelHasher):
+        # the workers are shut down before the cache is closed and before the interpreter exits
+        resources.enter_context(indexer.hasher)
+
+    if not built:
+        indexer.build_db()
+    else:
+        try:
+            indexer.check_hasher()
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    return indexer
+
+
 @click.group(invoke_without_command=True)
 @click.option("-v", help="show current version", is_flag=True)
 @click.pass_context
@@ -22,27 +133,71 @@ def cli(ctx, v):
 @cli.command()
 @click.argument('directory', default='.', type=click.Path(exists=True))
 @click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index file")
-def add(directory, index):
-    scanner = DirectoryScanner(directory)
+@click.option('--incremental', default=False, is_flag=True, help="skip files which did not change since last indexed")
+@click.option('--jobs', default=1, type=click.IntRange(1), help="number of files to hash in parallel")
+@click.option('--backend', default='threads', type=click.Choice(sorted(BACKENDS)), help="parallel hashing backend")
+@click.option('--batch-size', default=Indexer.BATCH_SIZE, type=click.IntRange(1),
+              help="number of files to store per transaction")
+@click.option('--strategy', type=click.Choice(Hasher.STRATEGIES), help="which parts of a file to hash for a new index")
+@click.option('--algorithm', type=click.Choice(sorted(ALGORITHMS)), help="hash algorithm for a new index")
+@click.option('--mmap', 'use_mmap', default=False, is_flag=True, help="memory map files when hashing full content")
+@click.option('--count/--no-count', default=True, help="count the files to index before indexing them")
+@click.option('--scan-jobs', default=1, type=click.IntRange(1), help="number of directories to list in parallel")
+@click.option('--cache', 'cache_location', default=DEFAULT_CACHE_LOCATION, help="hash cache file")
+@click.option('--no-cache', default=False, is_flag=True, help="don't use the hash cache")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--resume', default=False, is_flag=True,
+              help="continue an interrupted add, skipping directories which were completely indexed")
+@click.option('--perceptual', default=False, is_flag=True,
+              help="also index what images look like to find resized or re-encoded copies")
+@click.option('--chunks', default=False, is_flag=True,
+              help="also index content defined chunks of files to find content shared by different files")
+@click.option('--chunk-size', type=click.IntRange(256),
+              help="average chunk size in bytes for an index without chunks, a power of two [default: {0}]".format(
+                  DEFAULT_CHUNK_SIZE))
+@with_stats
+def add(directory, index, incremental, jobs, backend, batch_size, strategy, algorithm, use_mmap, count, scan_jobs,
+        cache_location, no_cache, profile, resume, perceptual, chunks, chunk_size):
+    with ExitStack() as resources:
+        cache = open_cache(cache_location, not no_cache, resources)
+        indexer = open_indexer(index, jobs, backend, strategy, algorithm, use_mmap, cache, profile, resources=resources)
+        images = open_perceptual(indexer, jobs) if perceptual else None
+        chunk_index = open_chunk_index(indexer, chunk_size) if chunks else None
 
-    build_db = not os.path.exists(index)
-    indexer = Indexer(create_connection(index), Hasher())
-    if build_db:
-        indexer.build_db()
+        checkpoint = Checkpoint(indexer.connection)
+        if resume:
+            completed = checkpoint.completed_directories()
+            click.echo("Skipping {0} completely indexed directories".format(len(completed)))
+            # files of directories which were partially indexed are only hashed again when they changed
+            incremental = True
+        else:
+            completed = ()
+            checkpoint.clear()
+        scanner = DirectoryScanner(directory, scan_jobs, completed)
+        scanner.stats = current_stats()
+
+        with click.progressbar(
+                iterable=scanner.iter_files(),
+                length=scanner.count_files() if count else None,
+                label="Indexing files...",
+                show_percent=True,
+                show_pos=True,
+                item_show_func=lambda x: x.full_path[-100:] if x is not None else ''
+        ) as files:
+            results = indexer.add_files(files, incremental, batch_size, checkpoint)
+            if images is not None:
+                results = images.add_files(results)
+            if chunk_index is not None:
+                results = chunk_index.add_files(results)
+            statuses = Counter(status for _, status in results)
 
-    real_files = scanner.get_files()
-    with click.progressbar(
-            iterable=real_files,
-            label="Indexing files...",
-            show_percent=True,
-            show_pos=True,
-            item_show_func=lambda x: x.full_path[-100:] if x is not None else ''
-    ) as files:
-        for file in files:
-            indexer.add_file(file)
+        checkpoint.clear()
 
-    click.echo("Successfully Indexed {0} files".format(len(real_files)))
-    click.echo("A total of {0} files are indexed".format(indexer.get_index_count()))
+        click.echo("Successfully Indexed {0} files".format(sum(statuses.values())))
+        click.echo("{0} new, {1} changed, {2} unchanged files".format(
+            statuses[NEW], statuses[CHANGED], statuses[UNCHANGED]))
+        click.echo("A total of {0} files are indexed".format(indexer.get_index_count()))
 
 
 @cli.command()
@@ -50,43 +205,102 @@ def add(directory, index):
 @click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to check against")
 @click.option('--rm', default=False, help="delete duplicate files", is_flag=True)
 @click.option('--mv', help="move duplicate files", type=click.Path(exists=True))
-def check(directory, index, rm, mv):
-    scanner = DirectoryScanner(directory)
-    indexer = Indexer(create_connection(index), Hasher())
-
-    files = scanner.get_files()
-    click.echo("{0} files to check".format(len(files)))
-
-    deleted = 0
-    for file in files:
-        original = indexer.fetch_indexed_file(file)
-        if original is not None:
-            if rm:
-                click.echo('deleting {0} - original file located at {1}'.format(file.full_path, original.full_path))
-                os.unlink(file.full_path)
-            elif not rm and mv:
-                new_path = os.path.join(mv, file.filename)
-                click.echo(
-                    'moving {0} to {1} - original file located at {2}'.format(
-                        file.full_path,
-                        new_path,
-                        original.full_path
-                        )
-                )
-                os.rename(file.full_path, new_path)
-            else:
-                click.echo('duplicate file found {0} - original file located at {1}'.format(
-                    file.full_path, original.full_path))
-            deleted += 1
-
-    click.echo("{0} files of {1} files deleted !".format(deleted, len(files)))
+@click.option('--jobs', default=1, type=click.IntRange(1), help="number of files to hash in parallel")
+@click.option('--backend', default='threads', type=click.Choice(sorted(BACKENDS)), help="parallel hashing backend")
+@click.option('--mmap', 'use_mmap', default=False, is_flag=True, help="memory map files when hashing full content")
+@click.option('--count/--no-count', default=True, help="count the files to check before checking them")
+@click.option('--scan-jobs', default=1, type=click.IntRange(1), help="number of directories to list in parallel")
+@click.option('--cache', 'cache_location', default=DEFAULT_CACHE_LOCATION, help="hash cache file")
+@click.option('--no-cache', default=False, is_flag=True, help="don't use the hash cache")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--read-only', default=False, is_flag=True, help="open the index without writing to it")
+@click.option('--similar', default=False, is_flag=True,
+              help="also report images which look like an indexed image, they are never deleted or moved")
+@click.option('--distance', default=DEFAULT_DISTANCE, type=click.IntRange(0, 64),
+              help="maximum number of different bits of the perceptual hashes of similar images")
+@with_stats
+def check(directory, index, rm, mv, jobs, backend, use_mmap, count, scan_jobs, cache_location, no_cache, profile,
+          read_only, similar, distance):
+    with ExitStack() as resources:
+        scanner = DirectoryScanner(directory, scan_jobs)
+        scanner.stats = current_stats()
+        cache = open_cache(cache_location, not no_cache, resources)
+        indexer = open_indexer(index, jobs, backend, use_mmap=use_mmap, cache=cache, profile=profile,
+                               read_only=read_only, resources=resources)
+        images = open_perceptual(indexer, jobs) if similar else None
+
+        if count:
+            click.echo("{0} files to check".format(scanner.count_files()))
+
+        checked = 0
+        deleted = 0
+        unmatched = []
+        for file, original in indexer.fetch_indexed_files(scanner.iter_files()):
+            checked += 1
+            if original is None and images is not None and is_image(file.full_path):
+                unmatched.append(file)
+            elif original is not None:
+                if rm:
+                    click.echo('deleting {0} - original file located at {1}'.format(file.full_path, original.full_path))
+                    os.unlink(file.full_path)
+                elif not rm and mv:
+                    new_path = os.path.join(mv, file.filename)
+                    click.echo(
+                        'moving {0} to {1} - original file located at {2}'.format(
+                            file.full_path,
+                            new_path,
+                            original.full_path
+                            )
+                    )
+                    os.rename(file.full_path, new_path)
+                else:
+                    click.echo('duplicate file found {0} - original file located at {1}'.format(
+                        file.full_path, original.full_path))
+                deleted += 1
+
+        if images is not None:
+            for file, matches in images.find_similar(unmatched, distance):
+                click.echo('similar image found {0} - looks like {1}'.format(
+                    file.full_path, ", ".join("{0} (distance {1})".format(path, d) for d, path in matches)))
+
+        click.echo("{0} files of {1} files deleted !".format(deleted, checked))
 
 
 @cli.command()
 @click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to check against")
-def duplicates(index):
-    indexer = Indexer(create_connection(index), Hasher())
-    for dupe_result in indexer.get_duplicates():
+@click.option('--min-size', default=0, type=click.IntRange(0), help="only report files of at least this many bytes")
+@click.option('--path', 'paths', multiple=True, type=click.Path(), help="only report files in this directory")
+@click.option('--sort', default='hash', type=click.Choice(['hash', 'wasted']),
+              help="report the duplicates wasting the most space first")
+@click.option('--verify/--no-verify', default=True, help="compare the content of files with the same hash")
+@click.option('--verify-min-size', default=0, type=click.IntRange(0),
+              help="only compare the content of files of at least this many bytes")
+@click.option('--jobs', default=1, type=click.IntRange(1), help="number of duplicate groups to compare in parallel")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--read-only', default=False, is_flag=True, help="open the index without writing to it")
+@click.option('--similar', default=False, is_flag=True,
+              help="report groups of similar images instead of identical files")
+@click.option('--distance', default=DEFAULT_DISTANCE, type=click.IntRange(0, 64),
+              help="maximum number of different bits of the perceptual hashes of similar images")
+@click.option('--dirs', default=False, is_flag=True,
+              help="report identical directories once instead of every file in them, files are not compared")
+@with_stats
+def duplicates(index, min_size, paths, sort, verify, verify_min_size, jobs, profile, read_only, similar, distance,
+               dirs):
+    indexer = open_indexer(index, profile=profile, read_only=read_only)
+    if similar:
+        echo_similar_images(open_perceptual(indexer), distance)
+        return
+
+    if verify:
+        indexer.verifier = Verifier(jobs, verify_min_size)
+        indexer.verifier.stats = current_stats()
+    else:
+        indexer.verifier = None
+    finder = TreeIndex(indexer) if dirs else indexer
+    for dupe_result in finder.get_duplicates(min_size, paths, sort == 'wasted'):
         click.echo("*" * 150)
         dupes = dupe_result.get_files()
 
@@ -103,15 +317,134 @@ def duplicates(index):
     click.echo("*" * 150)
 
 
+@cli.command()
+@click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to deduplicate")
+@click.option('--link', 'mode', default=HARDLINK, type=click.Choice(sorted(LINKS)),
+              help="replace duplicates with hardlinks, or reflinks sharing their content on copy on write file systems")
+@click.option('--min-size', default=0, type=click.IntRange(0), help="only replace files of at least this many bytes")
+@click.option('--path', 'paths', multiple=True, type=click.Path(), help="only replace files in this directory")
+@click.option('--jobs', default=1, type=click.IntRange(1), help="number of duplicate groups to compare in parallel")
+@click.option('--batch-size', default=Indexer.BATCH_SIZE, type=click.IntRange(1),
+              help="number of replaced files to update in the index per transaction")
+@click.option('--dry-run', default=False, is_flag=True, help="only show which files would be replaced")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@with_stats
+def dedupe(index, mode, min_size, paths, jobs, batch_size, dry_run, profile):
+    indexer = open_indexer(index, profile=profile)
+    # files are only replaced when their content is compared byte by byte, whatever the hashing strategy
+    indexer.verifier = Verifier(jobs)
+    indexer.verifier.stats = current_stats()
+
+    linked = 0
+    deduplicator = Deduplicator(indexer, mode, dry_run, batch_size)
+    for path, original, error in deduplicator.dedupe(indexer.get_duplicates(min_size, paths)):
+        if error is not None:
+            click.echo("skipping {0} - {1}".format(path, error), err=True)
+            continue
+        click.echo("linking {0} to {1}".format(path, original))
+        linked += 1
+
+    click.echo("{0} files linked !".format(linked))
+
+
+@cli.command()
+@click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to report on")
+@click.option('--dirs', default=False, is_flag=True, help="rank directories instead of files")
+@click.option('--limit', default=20, type=click.IntRange(0), help="number of files or directories to report, 0 for all")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--read-only', default=False, is_flag=True, help="open the index without writing to it")
+@with_stats
+def shared(index, dirs, limit, profile, read_only):
+    chunk_index = ChunkIndex(open_indexer(index, profile=profile, read_only=read_only))
+    ranked = chunk_index.shared_directories if dirs else chunk_index.shared_files
+    click.echo("{0:>14} {1:>14} {2:>7}  {3}".format('shared bytes', 'total bytes', 'shared', 'path'))
+    for path, total, shared_size in ranked(limit or None):
+        click.echo("{0:>14} {1:>14} {2:>7.1%}  {3}".format(shared_size, total, shared_size / total, path))
+
+
+def echo_similar_images(images, distance):
+    for group in images.similar_groups(distance):
+        click.echo("*" * 150)
+        click.echo("\n" + "".join("{0} (distance {1}) \n".format(path, d) for d, path in group))
+    click.echo("*" * 150)
+
+
+@cli.command()
+@click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to migrate")
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--batch-size', default=Indexer.BATCH_SIZE, type=click.IntRange(1),
+              help="number of rows to migrate per transaction")
+@click.option('--vacuum', default=False, is_flag=True, help="shrink the index file after migrating")
+@click.option('--base', type=click.Path(exists=True, file_okay=False),
+              help="directory the relative paths of an index of an older version are relative to")
+@with_stats
+def migrate(index, profile, batch_size, vacuum, base):
+    if not os.path.exists(os.path.expanduser(index)):
+        raise click.UsageError("index {0} does not exist".format(index))
+
+    indexer = Indexer(create_connection(index, profile), None)
+    if not indexer.is_built():
+        raise click.UsageError("index {0} has to be created by another command first".format(index))
+
+    migrated = False
+    try:
+        for version, description in migrations.migrate(indexer, batch_size, base):
+            click.echo("Migrating index to version {0}: {1}".format(version, description))
+            migrated = True
+    except ValueError as e:
+        indexer.connection.rollback()
+        raise click.UsageError(str(e))
+
+    if migrated:
+        click.echo("Migrated index to version {0}".format(indexer.get_schema_version()))
+    else:
+        click.echo("Index is up to date")
+
+    if vacuum:
+        indexer.connection.execute("VACUUM")
+
+
 @cli.command()
 @click.option('--index', default=DEFAULT_INDEX_LOCATION, help="index to check against")
-def cleanup(index):
-    indexer = Indexer(create_connection(index), Hasher())
+@click.option('--profile', default=DEFAULT_PROFILE, type=click.Choice(sorted(PROFILES)),
+              help="sqlite settings to open the index with")
+@click.option('--jobs', default=1, type=click.IntRange(1), help="number of directories to list in parallel")
+@click.option('--dry-run', default=False, is_flag=True, help="only list the files which would be removed")
+@with_stats
+def cleanup(index, profile, jobs, dry_run):
+    indexer = open_indexer(index, profile=profile)
+
+    for full_path in Cleaner(indexer, jobs, dry_run).clean():
+        click.echo("{0} {1}".format("Missing" if dry_run else "Deleted", full_path))
+
+
+@cli.group()
+def cache():
+    pass
+
+
+@cache.command()
+@click.option('--cache', 'cache_location', default=DEFAULT_CACHE_LOCATION, help="hash cache file")
+@with_stats
+def stats(cache_location):
+    hash_cache = open_cache(cache_location)
+    click.echo("{0} cached hashes".format(hash_cache.count()))
+    click.echo("{0} bytes used".format(hash_cache.size()))
+    hash_cache.close()
+
 
-    for file in indexer.get_files():
-        if not os.path.exists(file.full_path):
-            indexer.delete(file)
-            click.echo("Deleted {0}".format(file.full_path))
+@cache.command()
+@click.option('--cache', 'cache_location', default=DEFAULT_CACHE_LOCATION, help="hash cache file")
+@click.option('--max-entries', default=HashCache.MAX_ENTRIES, type=click.IntRange(0),
+              help="number of most recently used hashes to keep")
+@with_stats
+def prune(cache_location, max_entries):
+    hash_cache = open_cache(cache_location)
+    click.echo("Removed {0} cached hashes".format(hash_cache.prune(max_entries)))
+    hash_cache.close()
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -0,0 +1,106 @@
+import errno
+import os
+import shutil
+import uuid
+
+from .files import File
+from .stats import measure
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# ioctl sharing the extents of another file, supported by btrfs, XFS and other copy on write file systems
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+
+
+def _temporary_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{0}.{1}.hashdex'.format(name, uuid.uuid4().hex))
+
+
+def _replace(path, create):
+    # the link is created next to the duplicate and renamed over it, so the duplicate is never missing or incomplete
+    temporary = _temporary_path(path)
+    try:
+        create(temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.lexists(temporary):
+            os.unlink(temporary)
+        raise
+
+
+def hardlink(original, path):
+    _replace(path, lambda temporary: os.link(original, temporary))
+
+
+def _clone(original, path, temporary):
+    with open(original, 'rb') as source, open(temporary, 'xb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    # a reflink is a separate file, it keeps the permissions and times of the duplicate
+    shutil.copystat(path, temporary)
+
+
+def reflink(original, path):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    _replace(path, lambda temporary: _clone(original, path, temporary))
+
+
+LINKS = {
+    HARDLINK: hardlink,
+    REFLINK: reflink,
+}
+
+
+class Deduplicator(object):
+    def __init__(self, indexer, mode=HARDLINK, dry_run=False, batch_size=None):
+        self.indexer = indexer
+        self.link = LINKS[mode]
+        self.dry_run = dry_run
+        self.batch_size = batch_size or indexer.BATCH_SIZE
+        self.stats = indexer.stats
+
+    def _link(self, original, path):
+        if not self.dry_run:
+            self.link(original, path)
+        return File(path, os.path.basename(path), os.stat(path))
+
+    def _check_unchanged(self, path, stat):
+        # the signature stored when the file was hashed predates the comparison of its content, a file rewritten since,
+        # even in place with the same size, is not replaced
+        if self.indexer.get_signature(path) != (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev):
+            raise OSError(errno.EAGAIN, "the file changed since it was compared", path)
+
+    def _dedupe_file(self, original, original_stat, path, linked):
+        stat = os.stat(path)
+        if (stat.st_dev, stat.st_ino) == (original_stat.st_dev, original_stat.st_ino):
+            # hardlinks of the original are already the same file
+            return False
+        self._check_unchanged(original, original_stat)
+        self._check_unchanged(path, stat)
+
+        linked.append(measure(self.stats, 'link', 1, stat.st_size, self._link, original, path))
+        return True
+
+    def dedupe(self, results):
+        # every identical copy of a verified duplicate is replaced by a link to the first file of its group. The index
+        # is only updated once all duplicates are read, no cursor of the index is open while writing to it
+        linked = []
+        for result in results:
+            original = result.dupes[0] if result.dupes else None
+            for path in result.dupes[1:]:
+                try:
+                    if self._dedupe_file(original, os.stat(original), path, linked):
+                        yield path, original, None
+                except (IOError, OSError) as e:
+                    yield path, original, e
+
+        if not self.dry_run:
+            for i in range(0, len(linked), self.batch_size):
+                self.indexer.update_signatures(linked[i:i + self.batch_size])
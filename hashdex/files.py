@@ -1,32 +1,122 @@
 import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-File = namedtuple('File', ['full_path', 'filename'])
+from .stats import timed_iter
+
+File = namedtuple('File', ['full_path', 'filename', 'stat'])
+File.__new__.__defaults__ = (None,)
+
+
+def stat_file(file):
+    if file.stat is not None:
+        return file.stat
+    return os.stat(file.full_path)
 
 
 class DirectoryScanner(object):
-    def __init__(self, basepath):
+    def __init__(self, basepath, jobs=1, skip_directories=()):
         self.basepath = basepath
+        self.jobs = jobs
+        self.skip_directories = skip_directories
+        self.stats = None
 
-    def _fetch_files(self, dir):
-        file_list = []
-        for root, subdirs, files in os.walk(dir):
-            for file in files:
-                file_list.append(File(os.path.join(root, file), file))
+    def _scan_directory(self, path, directories):
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            return
 
-        return file_list
+        # the files of skipped directories are not yielded, their subdirectories are still scanned
+        skipped = os.path.dirname(os.path.join(path, '')) in self.skip_directories
+        try:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            directories.append(entry.path)
+                    elif not skipped and entry.is_file():
+                        yield entry
+                except OSError:
+                    pass
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
 
-    def get_files(self):
+    def _list_directory(self, path, convert):
+        directories = []
+        items = [convert(entry) for entry in self._scan_directory(path, directories)]
+        return [item for item in items if item is not None], directories
+
+    def _scan_parallel(self, directory, convert):
+        # directories are listed in a thread pool, at most two directories per worker are listed ahead of the consumer
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            directories = []
+            pending = set([executor.submit(self._list_directory, directory, convert)])
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    items, subdirectories = future.result()
+                    directories.extend(subdirectories)
+                    for item in items:
+                        yield item
+
+                while directories and len(pending) < self.jobs * 2:
+                    pending.add(executor.submit(self._list_directory, directories.pop(), convert))
+
+    def _scan(self, directory, convert):
+        if self.jobs > 1:
+            for item in self._scan_parallel(directory, convert):
+                yield item
+            return
+
+        # depth first, only the entries of a single directory and the directories still to visit are kept in memory
+        directories = [directory]
+        while directories:
+            for entry in self._scan_directory(directories.pop(), directories):
+                item = convert(entry)
+                if item is not None:
+                    yield item
+
+    def _to_file(self, entry):
+        try:
+            return File(entry.path, entry.name, entry.stat())
+        except OSError:
+            return None
+
+    def _fetch_files(self, dir):
+        return self._scan(dir, self._to_file)
+
+    def iter_files(self):
         if os.path.isfile(self.basepath):
             real_path = os.path.realpath(os.path.expanduser(self.basepath))
-            return [File(real_path, os.path.basename(real_path))]
-        return self._fetch_files(self.basepath)
+            return iter([File(real_path, os.path.basename(real_path))])
+
+        files = self._fetch_files(os.path.abspath(os.path.expanduser(self.basepath)))
+        if self.stats is not None:
+            files = timed_iter(self.stats, 'scan', files, lambda file: file.stat.st_size)
+        return files
+
+    def count_files(self):
+        if os.path.isfile(self.basepath):
+            return 1
+
+        entries = self._scan(os.path.abspath(os.path.expanduser(self.basepath)), lambda entry: entry)
+        if self.stats is not None:
+            entries = timed_iter(self.stats, 'count', entries)
+        return sum(1 for _ in entries)
+
+    def get_files(self):
+        return list(self.iter_files())
 
 
 class DuplicateFileResult(object):
-    def __init__(self):
+    def __init__(self, size=None):
+        self.size = size
         self.dupes = []
         self.diffs = []
+        # number of distinct files among the duplicates, hardlinks of a file don't take up any space
+        self.copies = None
 
     def add_duplicate(self, filepath):
         self.dupes.append(filepath)
@@ -40,6 +130,12 @@ class DuplicateFileResult(object):
     def is_equal(self):
         return len(self.dupes) > 0 and len(self.diffs) == 0
 
+    def get_wasted_size(self):
+        if self.size is None or not self.dupes:
+            return 0
+        copies = len(self.dupes) if self.copies is None else self.copies
+        return self.size * (copies - 1)
+
     def __eq__(self, other):
         return set(self.dupes) == set(other.dupes) and \
                 set(self.diffs) == set(other.diffs)
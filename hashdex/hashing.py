@@ -0,0 +1,295 @@
+import hashlib
+import math
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .files import stat_file
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover
+    xxhash = None
+
+BACKENDS = {
+    'threads': ThreadPoolExecutor,
+    'processes': ProcessPoolExecutor,
+}
+
+# every algorithm produces the two digests stored in the hashes table, single digest algorithms leave the second empty
+ALGORITHMS = {
+    'sha1+md5': lambda: [hashlib.sha1(), hashlib.md5()],
+}
+if hasattr(hashlib, 'blake2b'):
+    ALGORITHMS['blake2b'] = lambda: [hashlib.blake2b(digest_size=20)]
+if xxhash is not None:
+    ALGORITHMS['xxhash'] = lambda: [xxhash.xxh3_128()]
+
+
+class Hasher(object):
+
+    BYTE_COUNT = int(10e5)  # 1MB
+    CHUNK_SIZE = 1 << 20
+
+    SAMPLED = 'sampled'
+    HEAD_MIDDLE_TAIL = 'head-middle-tail'
+    FULL = 'full'
+    STRATEGIES = (SAMPLED, HEAD_MIDDLE_TAIL, FULL)
+
+    DEFAULT_ALGORITHM = 'sha1+md5'
+
+    def __init__(self, strategy=SAMPLED, algorithm=DEFAULT_ALGORITHM, use_mmap=False, cache=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("unknown hash strategy {0}".format(strategy))
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unknown or unavailable hash algorithm {0}".format(algorithm))
+
+        self.strategy = strategy
+        self.algorithm = algorithm
+        self.use_mmap = use_mmap
+        self.cache = cache
+        self.stats = None
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        # the cache and statistics are only used by the process which created them
+        state['cache'] = None
+        state['stats'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_buffer(self):
+        # every thread reuses a single buffer for all files it hashes
+        size = max(self.BYTE_COUNT, self.CHUNK_SIZE)
+        view = getattr(self._local, 'view', None)
+        if view is None or len(view) != size:
+            view = self._local.view = memoryview(bytearray(size))
+        return view
+
+    def _read_into(self, f, view):
+        filled = 0
+        while filled < len(view):
+            read = f.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+        return view[:filled]
+
+    def _read_sampled(self, f, filesize, buffer):
+        if filesize < self.BYTE_COUNT:
+            yield self._read_into(f, buffer[:filesize])
+        else:
+            part_count = int(math.floor(self.BYTE_COUNT / 2))
+            yield self._read_into(f, buffer[:part_count])
+
+            # seeking relative to the end with a positive offset reads nothing, this is kept as is because
+            # existing indexes depend on it. The head-middle-tail strategy samples the end of the file
+            f.seek(part_count, os.SEEK_END)
+            yield self._read_into(f, buffer[part_count:part_count * 2])
+
+    def _read_head_middle_tail(self, f, filesize, buffer):
+        if filesize <= self.BYTE_COUNT:
+            yield self._read_into(f, buffer[:filesize])
+        else:
+            part_count = self.BYTE_COUNT // 3
+            for offset in (0, (filesize - part_count) // 2, filesize - part_count):
+                f.seek(offset)
+                yield self._read_into(f, buffer[:part_count])
+
+    def _map(self, f, filesize):
+        # empty files, pipes and some network filesystems can not be mapped, those are read in chunks instead
+        if not self.use_mmap or filesize == 0:
+            return None
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return None
+
+    def _read_full(self, f, filesize, buffer):
+        mapped = self._map(f, filesize)
+        if mapped is not None:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+                mapped.close()
+            return
+
+        chunk = buffer[:self.CHUNK_SIZE]
+        while True:
+            content = self._read_into(f, chunk)
+            if not content:
+                break
+            yield content
+
+    def get_hashes(self, file):
+        if self.cache is None:
+            return self._hash_content(file)
+
+        hashes = self.cache.get(file, self.strategy, self.algorithm)
+        if hashes is None:
+            hashes = self._hash_content(file)
+            self.cache.put(file, self.strategy, self.algorithm, hashes)
+        return hashes
+
+    def _hash_content(self, file):
+        filesize = stat_file(file).st_size
+        read = {
+            self.SAMPLED: self._read_sampled,
+            self.HEAD_MIDDLE_TAIL: self._read_head_middle_tail,
+            self.FULL: self._read_full,
+        }[self.strategy]
+
+        hashers = ALGORITHMS[self.algorithm]()
+        if self.stats is not None:
+            self._measured_update(hashers, file.full_path, read, filesize)
+        else:
+            with open(file.full_path, 'rb', buffering=0) as f:
+                for content in read(f, filesize, self._get_buffer()):
+                    for hasher in hashers:
+                        hasher.update(content)
+
+        digests = [hasher.hexdigest() for hasher in hashers]
+        return (digests[0], digests[1] if len(digests) > 1 else '')
+
+    def _measured_update(self, hashers, path, read, filesize):
+        # opening and reading the file and updating the hashes are measured separately and stored once per file
+        stats = self.stats
+        read_time = [0.0, 0.0]
+        hash_time = [0.0, 0.0]
+        size = 0
+
+        def measure(totals, started):
+            now = stats.start()
+            totals[0] += now[0] - started[0]
+            totals[1] += now[1] - started[1]
+            return now
+
+        started = stats.start()
+        with open(path, 'rb', buffering=0) as f:
+            for content in read(f, filesize, self._get_buffer()):
+                started = measure(read_time, started)
+                size += len(content)
+                for hasher in hashers:
+                    hasher.update(content)
+                started = measure(hash_time, started)
+        measure(read_time, started)
+
+        stats.add('read', 1, size, read_time[0], read_time[1])
+        stats.add('hash', 1, size, hash_time[0], hash_time[1])
+
+    def hash_files(self, files, needs_hash=None, ignore_errors=False):
+        for file in files:
+            if needs_hash is not None and not needs_hash(file):
+                yield file, None
+                continue
+
+            try:
+                yield file, self.get_hashes(file)
+            except (IOError, OSError):
+                if not ignore_errors:
+                    raise
+                yield file, None
+
+
+class ParallelHasher(object):
+    def __init__(self, hasher, jobs=1, backend='threads'):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend {0}".format(backend))
+
+        self.hasher = hasher
+        self.jobs = jobs
+        self.backend = backend
+        self._executor = None
+
+    @property
+    def strategy(self):
+        return self.hasher.strategy
+
+    @property
+    def algorithm(self):
+        return self.hasher.algorithm
+
+    def get_hashes(self, file):
+        return self.hasher.get_hashes(file)
+
+    def _get_executor(self):
+        # the pool is shared by all calls, so batches don't pay for starting new workers
+        if self._executor is None:
+            self._executor = BACKENDS[self.backend](max_workers=self.jobs)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def hash_files(self, files, needs_hash=None, ignore_errors=False):
+        if self.jobs <= 1:
+            for result in self.hasher.hash_files(files, needs_hash, ignore_errors):
+                yield result
+            return
+
+        # the input is consumed in the calling thread, so needs_hash, the cache and whatever the caller does with
+        # the results never run concurrently. At most two files per worker are queued at any time.
+        files = iter(files)
+        max_pending = self.jobs * 2
+        executor = self._get_executor()
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                file = next(files, None)
+                if file is None:
+                    exhausted = True
+                elif needs_hash is not None and not needs_hash(file):
+                    yield file, None
+                else:
+                    hashes = self._cached(file, ignore_errors)
+                    if hashes is not None:
+                        yield file, hashes
+                    else:
+                        pending[executor.submit(self.hasher._hash_content, file)] = file
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file = pending.pop(future)
+                yield file, self._result(file, future, ignore_errors)
+
+    def _cached(self, file, ignore_errors):
+        if self.hasher.cache is None:
+            return None
+        try:
+            return self.hasher.cache.get(file, self.strategy, self.algorithm)
+        except (IOError, OSError):
+            if not ignore_errors:
+                raise
+            return None
+
+    def _result(self, file, future, ignore_errors):
+        try:
+            hashes = future.result()
+        except (IOError, OSError):
+            if not ignore_errors:
+                raise
+            return None
+
+        if self.hasher.cache is not None:
+            self.hasher.cache.put(file, self.strategy, self.algorithm, hashes)
+        return hashes
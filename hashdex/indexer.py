@@ -1,158 +1,767 @@
-import math
 import os
 import sqlite3
-import filecmp
-from hashlib import sha1, md5
+from collections import Counter, defaultdict
+from itertools import groupby
+from urllib.request import pathname2url
 
 from hashdex.files import DuplicateFileResult
-from .files import File
+from .files import File, stat_file
+from .hashing import Hasher  # noqa: F401
+from .stats import measure, timed_iter
+from .verify import Verifier
 
+# maximum number of parameters in a single "IN (...)" clause
+MAX_VARIABLES = 500
 
-def create_connection(db):
-    if db == ':memory:':
-        connection_string = db
-    else:
-        connection_string = os.path.expanduser(db)
-        dirname = os.path.dirname(connection_string)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+SCHEMA_VERSION = 6
+
+# files are the same copy when they share their device and inode, file systems without inodes report 0
+COPY_KEY = "COALESCE(f.device || ':' || NULLIF(f.inode, 0), f.dir_id || '/' || f.name)"
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    yield batch
 
-    return sqlite3.connect(connection_string)
 
+def split_path(full_path):
+    # directory paths are stored with a trailing separator, the full path of a file is its directory path and name
+    return os.path.join(os.path.dirname(full_path), ''), os.path.basename(full_path)
 
-class Hasher(object):
 
-    BYTE_COUNT = int(10e5)  # 1MB
+def parent_directory(path):
+    # the parent of the root directory is the root directory itself
+    return os.path.join(os.path.dirname(os.path.dirname(path)), '')
 
-    def get_hashes(self, file):
-        filesize = os.stat(file.full_path).st_size
-        with open(file.full_path, 'rb') as f:
-            content = b""
-            if filesize < self.BYTE_COUNT:
-                content += f.read(filesize)
-            else:
-                part_count = int(math.floor(self.BYTE_COUNT / 2))
-                content += f.read(part_count)
 
-                f.seek(part_count, os.SEEK_END)
-                content += f.read(part_count)
+def link_key(stat):
+    # only files with more than one hardlink can share their inode with another path
+    if stat.st_nlink > 1 and stat.st_ino:
+        return stat.st_dev, stat.st_ino
+    return None
 
-            sha_hash = sha1(content).hexdigest()
-            md5_hash = md5(content).hexdigest()
 
-        return (sha_hash, md5_hash)
+def _link_representatives(rows, links):
+    # the first path of every inode represents all of its hardlinks, files without an inode represent themselves
+    representatives = []
+    first = {}
+    for full_path, inode in rows:
+        if inode is None or inode not in first:
+            representatives.append(full_path)
+            links[full_path] = [full_path]
+            if inode is not None:
+                first[inode] = full_path
+        else:
+            links[first[inode]].append(full_path)
+    return representatives
+
+
+def to_digest(hashes):
+    # both hex digests are stored as a single binary value, single digest algorithms have an empty second digest
+    return bytes.fromhex(hashes[0] + hashes[1])
+
+
+DEFAULT_PROFILE = 'default'
+
+# pragmas set on every new connection. The tuned profile switches the index to write ahead logging, so readers don't
+# block a running add, and only syncs the log at checkpoints. journal_mode is stored in the database itself.
+PROFILES = {
+    DEFAULT_PROFILE: [],
+    'tuned': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64000),  # 64MB
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+
+def create_connection(db, profile=DEFAULT_PROFILE, read_only=False, check_same_thread=True):
+    # connections used by the async pipeline are opened in the caller's thread but only used from its database thread
+    if db == ':memory:':
+        connection = sqlite3.connect(db, check_same_thread=check_same_thread)
+    elif read_only:
+        connection = sqlite3.connect(
+            'file:{0}?mode=ro'.format(pathname2url(os.path.expanduser(db))), uri=True,
+            check_same_thread=check_same_thread)
+    else:
+        connection_string = os.path.expanduser(db)
+        dirname = os.path.dirname(connection_string)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        connection = sqlite3.connect(connection_string, check_same_thread=check_same_thread)
+
+    for pragma, value in PROFILES[profile]:
+        # the journal mode can't be changed without writing to the database
+        if read_only and pragma == 'journal_mode':
+            continue
+        connection.execute("PRAGMA {0} = {1}".format(pragma, value))
+
+    return connection
 
 
 class Indexer(object):
+    BATCH_SIZE = 1000
+
     def __init__(self, connection, hasher):
         self.connection = connection
         self.hasher = hasher
+        self.verifier = Verifier()
+        self.read_only = False
+        self.stats = None
 
     def build_db(self, ):
+        self.build_tables()
+        self.build_meta(self.hasher.strategy, self.hasher.algorithm)
+        self.set_schema_version(SCHEMA_VERSION)
+
+    def build_tables(self):
         self.connection.execute("""
             CREATE TABLE hashes (
-                hash_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sha1_hash TEXT,
-                md5_hash TEXT
+                hash_id INTEGER PRIMARY KEY,
+                digest BLOB NOT NULL
             )
         """)
-        self.connection.execute("CREATE UNIQUE INDEX idx_hashes ON hashes ( sha1_hash , md5_hash )")
+        self.connection.execute("CREATE UNIQUE INDEX idx_hashes ON hashes ( digest )")
+        self.connection.execute("""
+            CREATE TABLE directories (
+                dir_id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE UNIQUE INDEX idx_paths ON directories ( path )")
         self.connection.execute("""
             CREATE TABLE files (
+                dir_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
                 hash_id INTEGER,
-                full_path TEXT,
-                filename TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                device INTEGER,
+                PRIMARY KEY (dir_id, name),
+                FOREIGN KEY(dir_id) REFERENCES directories(dir_id),
                 FOREIGN KEY(hash_id) REFERENCES hashes(hash_id)
-            )
+            ) WITHOUT ROWID
         """)
-        self.connection.execute("CREATE UNIQUE INDEX idx_paths ON files ( full_path )")
+        self.connection.execute("CREATE INDEX idx_sizes ON files ( size )")
+        self.connection.execute("CREATE INDEX idx_file_hashes ON files ( hash_id )")
+        self.connection.execute("CREATE INDEX idx_inodes ON files ( inode, device )")
+
+    def build_meta(self, strategy, algorithm):
+        self.connection.execute("CREATE TABLE meta ( key TEXT PRIMARY KEY, value TEXT ) WITHOUT ROWID")
+        self.connection.executemany("INSERT INTO meta (key, value) VALUES (?,?)", [
+            ('strategy', strategy),
+            ('algorithm', algorithm),
+        ])
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        if value is None:
+            self.connection.execute("DELETE FROM meta WHERE key = ?", (key, ))
+        else:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)", (key, value))
+
+    def get_hasher_settings(self):
+        meta = dict(self.connection.execute("SELECT key, value FROM meta").fetchall())
+        return meta['strategy'], meta['algorithm']
+
+    def check_hasher(self):
+        strategy, algorithm = self.get_hasher_settings()
+        if (self.hasher.strategy, self.hasher.algorithm) != (strategy, algorithm):
+            raise ValueError("the index is hashed with the {0} strategy and {1} algorithm".format(strategy, algorithm))
 
-    def _check_index(self, sha1_hash, md5_hash):
-        return self.connection.execute("SELECT hash_id FROM hashes WHERE sha1_hash = ? AND md5_hash = ? ",
-                                       [sha1_hash, md5_hash]).fetchone()
+    def is_built(self):
+        return self.has_table('files')
 
-    def add_file(self, file):
-        sha_hash, md5_hash = self.hasher.get_hashes(file)
+    def has_table(self, name):
+        return self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name, )
+        ).fetchone() is not None
 
+    def get_schema_version(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version:
+            return version
+
+        # indexes created before the version was stored in the index, or which are still being migrated, store full
+        # paths in version 1 or directories and names in version 2
+        if self.has_table('legacy_files') or not self.has_table('directories'):
+            return 1
+        return 2
+
+    def set_schema_version(self, version):
+        self.connection.execute("PRAGMA user_version = {0:d}".format(version))
+
+    def needs_upgrade(self):
+        return self.get_schema_version() < SCHEMA_VERSION
+
+    def check_schema(self):
+        if self.needs_upgrade():
+            raise ValueError("the index uses an older format, run hashdex migrate first")
+
+    def _find_size_match(self, size, full_path):
+        directory, name = split_path(full_path)
+        return self.connection.execute("""
+            SELECT f.name
+            FROM files f
+            JOIN directories d ON d.dir_id = f.dir_id
+            WHERE f.size = ? AND NOT (d.path = ? AND f.name = ?)
+            LIMIT 1
+        """, (size, directory, name)).fetchone()
+
+    def _find_link(self, file):
+        # an indexed hardlink with the same signature is the same file in the same state
+        directory, name = split_path(file.full_path)
+        return self.connection.execute("""
+            SELECT f.name
+            FROM files f
+            JOIN directories d ON d.dir_id = f.dir_id
+            WHERE f.inode = ? AND f.device = ? AND f.size = ? AND f.mtime_ns = ? AND NOT (d.path = ? AND f.name = ?)
+            LIMIT 1
+        """, (file.stat.st_ino, file.stat.st_dev, file.stat.st_size, file.stat.st_mtime_ns, directory, name)).fetchone()
+
+    def _stat_files(self, files):
+        for file in files:
+            yield file._replace(stat=stat_file(file))
+
+    def get_signature(self, full_path):
+        # size, mtime, inode and device of the file when it was hashed
+        indexed = self.connection.execute("""
+            SELECT f.size, f.mtime_ns, f.inode, f.device
+            FROM files f
+            JOIN directories d ON d.dir_id = f.dir_id
+            WHERE d.path = ? AND f.name = ?
+        """, split_path(full_path)).fetchone()
+        return tuple(indexed) if indexed is not None else None
+
+    def _get_status(self, file):
+        indexed = self.get_signature(file.full_path)
+        if indexed is None:
+            return NEW
+        if indexed == self._signature(file):
+            return UNCHANGED
+        return CHANGED
+
+    def _signature(self, file):
+        return (file.stat.st_size, file.stat.st_mtime_ns, file.stat.st_ino, file.stat.st_dev)
+
+    def _select_in(self, query, values):
+        values = sorted(set(values))
+        for i in range(0, len(values), MAX_VARIABLES):
+            chunk = values[i:i + MAX_VARIABLES]
+            for row in self.connection.execute(query.format(",".join("?" * len(chunk))), chunk).fetchall():
+                yield row
+
+    def _resolve_hash_ids(self, hashes):
+        digests = dict((to_digest(hash_pair), tuple(hash_pair)) for hash_pair in hashes)
+        return dict(
+            (digests[bytes(digest)], hash_id)
+            for hash_id, digest in self._select_in("SELECT hash_id, digest FROM hashes WHERE digest IN ({0})", digests)
+        )
+
+    def directory_ids(self, cursor, paths):
+        paths = set(paths)
+        cursor.executemany("INSERT OR IGNORE INTO directories (path) VALUES (?)", [(path, ) for path in sorted(paths)])
+        return dict(
+            (path, dir_id)
+            for dir_id, path in self._select_in("SELECT dir_id, path FROM directories WHERE path IN ({0})", paths)
+        )
+
+    def _find_unhashed_matches(self, sizes, min_count, links, skip_checked=False, pending_links=None):
+        sizes = sorted(sizes)
+        pending_links = pending_links or {}
+        # files hashed by an earlier batch of a read only check are only stored in the check_indexed table
+        skip = "AND d.path || f.name NOT IN (SELECT full_path FROM check_indexed)" if skip_checked else ""
+        for i in range(0, len(sizes), MAX_VARIABLES):
+            chunk = sizes[i:i + MAX_VARIABLES]
+            rows = self.connection.execute("""
+                SELECT d.path || f.name, f.device, f.inode
+                FROM files f
+                JOIN directories d ON d.dir_id = f.dir_id
+                WHERE f.hash_id IS NULL AND f.size IN (
+                    SELECT f.size FROM files f WHERE f.size IN ({0}) GROUP BY f.size HAVING COUNT(DISTINCT {2}) >= ?
+                ) {1}
+            """.format(",".join("?" * len(chunk)), skip, COPY_KEY), chunk + [min_count]).fetchall()
+            # only the first path of every inode is hashed, its hardlinks get the same hash. Inodes which are being
+            # read by the running add get their hash once that path is stored
+            keys = ((full_path, (device, inode) if inode else None) for full_path, device, inode in rows)
+            keys = ((full_path, key) for full_path, key in keys if not pending_links.get(key))
+            for full_path in _link_representatives(keys, links):
+                yield File(full_path, os.path.basename(full_path))
+
+    def _hash_unhashed_matches(self, cursor, sizes, min_count, pending_links=None):
+        links = {}
+        matches = self._find_unhashed_matches(sizes, min_count, links, pending_links=pending_links)
+        hashed = [
+            (File(link, os.path.basename(link)), hashes)
+            for file, hashes in self.hasher.hash_files(matches, ignore_errors=True)
+            if hashes is not None
+            for link in links[file.full_path]
+        ]
+        hash_ids = self._insert_hashes(cursor, [hashes for _, hashes in hashed])
+        cursor.executemany(
+            "UPDATE files SET hash_id = ? WHERE dir_id = (SELECT dir_id FROM directories WHERE path = ?) AND name = ?",
+            [(hash_ids[tuple(hashes)], ) + split_path(file.full_path) for file, hashes in hashed]
+        )
+        self._invalidate_trees(cursor, [split_path(file.full_path)[0] for file, _ in hashed])
+
+    def _hash_unhashed_matches_read_only(self, sizes):
+        # the index can't be written to, so the hashes only live in a temporary table while checking
+        links = {}
+        hashed = self.hasher.hash_files(self._find_unhashed_matches(sizes, 1, links, True), ignore_errors=True)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO check_indexed (full_path, filename, size, digest) VALUES (?,?,?,?)",
+            [
+                (link, os.path.basename(link), stat_file(file).st_size, to_digest(hashes))
+                for file, hashes in hashed if hashes is not None
+                for link in links[file.full_path]
+            ]
+        )
+
+    def _insert_hashes(self, cursor, hashes):
+        hashes = set(tuple(hash_pair) for hash_pair in hashes)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO hashes (digest) VALUES (?)", [(to_digest(hash_pair), ) for hash_pair in hashes])
+        return self._resolve_hash_ids(hashes)
+
+    def _copy_link_hashes(self, cursor, files):
+        # hardlinks which were not read get the hash of a path of their inode, whichever of them was stored first
+        updates = []
+        for signature in set(self._signature(file) for file in files if link_key(file.stat) is not None):
+            updates.extend(cursor.execute("""
+                SELECT MIN(l.hash_id), f.dir_id, f.name, d.path
+                FROM files f
+                JOIN files l
+                    ON l.inode = f.inode AND l.device = f.device AND l.size = f.size AND l.mtime_ns = f.mtime_ns
+                JOIN directories d ON d.dir_id = f.dir_id
+                WHERE f.size = ? AND f.mtime_ns = ? AND f.inode = ? AND f.device = ?
+                    AND f.hash_id IS NULL AND l.hash_id IS NOT NULL
+                GROUP BY f.dir_id, f.name
+            """, signature).fetchall())
+
+        cursor.executemany("UPDATE files SET hash_id = ? WHERE dir_id = ? AND name = ?", [row[:3] for row in updates])
+        self._invalidate_trees(cursor, [row[3] for row in updates])
+
+    def _store_batch(self, cursor, batch, pending_links=None):
+        hash_ids = self._insert_hashes(cursor, [hashes for _, hashes in batch if hashes is not None])
+        dir_ids = self.directory_ids(cursor, [split_path(file.full_path)[0] for file, _ in batch])
+
+        rows = []
+        for file, hashes in batch:
+            directory, name = split_path(file.full_path)
+            hash_id = None if hashes is None else hash_ids[tuple(hashes)]
+            rows.append((dir_ids[directory], name, hash_id) + self._signature(file))
+        cursor.executemany(
+            "INSERT OR REPLACE INTO files (dir_id, name, hash_id, size, mtime_ns, inode, device) "
+            "VALUES (?,?,?,?,?,?,?)",
+            rows
+        )
+        self._invalidate_trees(cursor, dir_ids)
+
+        self._copy_link_hashes(cursor, [file for file, _ in batch])
+
+        # files stored without a hash which now share their size with another file still need to be hashed
+        self._hash_unhashed_matches(cursor, set(file.stat.st_size for file, _ in batch), 2, pending_links)
+
+    def _invalidate_trees(self, cursor, directories):
+        # the tree hashes of changed directories and of all directories above them are computed again when needed
+        if not self.has_table('tree_hashes'):
+            return
+
+        paths = set()
+        for directory in directories:
+            while directory not in paths:
+                paths.add(directory)
+                directory = parent_directory(directory)
+        cursor.executemany("DELETE FROM tree_hashes WHERE path = ?", [(path, ) for path in sorted(paths)])
+
+    def _flush(self, batch, results, pending_sizes, checkpoint=None, pending_links=None):
         cursor = self.connection.cursor()
+        files = [file for file, _ in results]
         try:
-            cursor.execute("INSERT OR IGNORE INTO hashes (sha1_hash, md5_hash) VALUES (?,?)", (sha_hash, md5_hash))
-            hash_id = self._check_index(sha_hash, md5_hash)[0]
-            cursor.execute(
-                "INSERT OR IGNORE INTO files (hash_id, full_path, filename) VALUES (?,?,?)",
-                (hash_id, file.full_path, file.filename)
+            measure(self.stats, 'store', len(batch), 0, self._store_batch, cursor, batch, pending_links)
+            if checkpoint is not None:
+                checkpoint.store(cursor, files)
+            measure(self.stats, 'commit', len(batch), 0, self.connection.commit)
+            stored = True
+            if checkpoint is not None:
+                checkpoint.committed(files)
+        except sqlite3.Error as e:
+            print(e)
+            self.connection.rollback()
+            stored = False
+
+        for file, _ in batch:
+            pending_sizes[file.stat.st_size] -= 1
+            # only the path reading an inode ends the read, its hardlinks may be written before it
+            if pending_links and pending_links.get(link_key(file.stat)) == file.full_path:
+                pending_links[link_key(file.stat)] = None
+
+        return [(file, status if stored or status == UNCHANGED else None) for file, status in results]
+
+    def _needs_hash(self, file, incremental, statuses, pending_sizes, pending_links=None):
+        status = statuses[file.full_path] = self._get_status(file)
+        if incremental and status == UNCHANGED:
+            return False
+
+        size = file.stat.st_size
+        pending = pending_sizes[size] > 0
+        pending_sizes[size] += 1
+
+        # every inode is read once, hardlinks of a file which is being indexed or already indexed are stored with its
+        # hash without reading them
+        link = None if pending_links is None else link_key(file.stat)
+        if link is not None and (link in pending_links or self._find_link(file) is not None):
+            return False
+
+        shared = pending or self._find_size_match(size, file.full_path) is not None
+        if link is not None:
+            # the inode is being read through this path until it is stored
+            pending_links[link] = file.full_path if shared else None
+        return shared
+
+    def _store_hashed(self, hashed, incremental, statuses, pending_sizes, checkpoint=None, pending_links=None):
+        batch = []
+        results = []
+        for file, hashes in hashed:
+            status = statuses.pop(file.full_path)
+            if not (incremental and status == UNCHANGED):
+                batch.append((file, hashes))
+            results.append((file, status))
+
+        return self._flush(batch, results, pending_sizes, checkpoint, pending_links)
+
+    def add_files(self, files, incremental=False, batch_size=None, checkpoint=None):
+        batch_size = batch_size or self.BATCH_SIZE
+        if checkpoint is not None:
+            files = checkpoint.track(files)
+
+        statuses = {}
+        # sizes of files which are being hashed or waiting in the current batch, they are not visible in the db yet
+        pending_sizes = Counter()
+        # inodes of hardlinked files seen by this add, and the path through which they are being read
+        pending_links = {}
+
+        def needs_hash(file):
+            return measure(
+                self.stats, 'lookup', 1, 0, self._needs_hash, file, incremental, statuses, pending_sizes, pending_links)
+
+        for hashed in _batches(self.hasher.hash_files(self._stat_files(files), needs_hash), batch_size):
+            for result in self._store_hashed(hashed, incremental, statuses, pending_sizes, checkpoint, pending_links):
+                yield result
+
+    def add_file(self, file, incremental=False):
+        for _, status in self.add_files([file], incremental=incremental):
+            return status
+
+    def in_index(self, file):
+        return self.fetch_indexed_file(file) is not None
+
+    def _create_check_tables(self):
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS check_sizes ( full_path TEXT PRIMARY KEY, size INTEGER )")
+        self.connection.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS check_hashes (
+                full_path TEXT PRIMARY KEY,
+                size INTEGER,
+                digest BLOB
             )
+        """)
+        self.connection.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS check_indexed (
+                full_path TEXT PRIMARY KEY,
+                filename TEXT,
+                size INTEGER,
+                digest BLOB
+            )
+        """)
+
+    def _find_candidates(self, batch):
+        # only files sharing their size with an indexed file can be duplicates, any unhashed indexed file of that
+        # size is hashed first so every candidate can be resolved by its hashes
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO check_sizes (full_path, size) VALUES (?,?)",
+            [(file.full_path, file.stat.st_size) for file in batch]
+        )
+        candidates = self.connection.execute("""
+            SELECT c.full_path, c.size
+            FROM check_sizes c
+            WHERE EXISTS (
+                SELECT 1
+                FROM files f
+                JOIN directories d ON d.dir_id = f.dir_id
+                WHERE f.size = c.size AND d.path || f.name != c.full_path
+            )
+        """).fetchall()
+        self.connection.execute("DELETE FROM check_sizes")
+
+        if self.read_only:
+            self._hash_unhashed_matches_read_only(set(size for _, size in candidates))
+            return set(full_path for full_path, _ in candidates)
+
+        cursor = self.connection.cursor()
+        try:
+            self._hash_unhashed_matches(cursor, set(size for _, size in candidates), 1)
             self.connection.commit()
         except sqlite3.Error as e:
             print(e)
             self.connection.rollback()
 
-    def in_index(self, file):
-        sha_hash, md5_hash = self.hasher.get_hashes(file)
-        return self._check_index(sha_hash, md5_hash) is not None
+        return set(full_path for full_path, _ in candidates)
+
+    def _confirm_original(self, file, candidates):
+        # a sampled hash only covers part of the content, a checked file only has an original when it is identical to
+        # one of the indexed files. Candidates are compared one at a time, usually the first one is a copy
+        if self.hasher.strategy == Hasher.FULL:
+            return candidates[0]
+
+        verifier = self.verifier or Verifier()
+        for candidate in candidates:
+            groups = measure(self.stats, 'verify', 2, file.stat.st_size * 2, verifier.split,
+                             [file.full_path, candidate.full_path])
+            if len(groups) == 1:
+                return candidate
+        return None
+
+    def _find_originals(self, batch):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO check_hashes (full_path, size, digest) VALUES (?,?,?)",
+            [(file.full_path, file.stat.st_size, to_digest(hashes)) for file, hashes in batch if hashes is not None]
+        )
+        # every indexed path with the same size and hashes as a checked file is a candidate original
+        rows = self.connection.execute("""
+            SELECT c.full_path, d.path || f.name, f.name
+            FROM check_hashes c
+            JOIN hashes h ON h.digest = c.digest
+            JOIN files f ON f.hash_id = h.hash_id AND f.size = c.size
+            JOIN directories d ON d.dir_id = f.dir_id
+            WHERE d.path || f.name != c.full_path
+        """).fetchall()
+        rows += self.connection.execute("""
+            SELECT c.full_path, i.full_path, i.filename
+            FROM check_hashes c
+            JOIN check_indexed i ON i.digest = c.digest AND i.size = c.size AND i.full_path != c.full_path
+        """).fetchall()
+        self.connection.execute("DELETE FROM check_hashes")
+
+        candidates = defaultdict(set)
+        for full_path, original, filename in rows:
+            candidates[full_path].add(File(original, filename))
+
+        results = []
+        for file, _ in batch:
+            matches = sorted(candidates.get(file.full_path, ()))
+            results.append((file, self._confirm_original(file, matches) if matches else None))
+        return results
+
+    def fetch_indexed_files(self, files, batch_size=None):
+        batch_size = batch_size or self.BATCH_SIZE
+        self._create_check_tables()
+        candidates = set()
+
+        def prefiltered():
+            for batch in _batches(self._stat_files(files), batch_size):
+                candidates.update(measure(self.stats, 'lookup', len(batch), 0, self._find_candidates, batch))
+                for file in batch:
+                    yield file
+
+        def needs_hash(file):
+            if file.full_path in candidates:
+                candidates.remove(file.full_path)
+                return True
+            return False
+
+        for batch in _batches(self.hasher.hash_files(prefiltered(), needs_hash), batch_size):
+            for original in measure(self.stats, 'lookup', len(batch), 0, self._find_originals, batch):
+                yield original
 
     def fetch_indexed_file(self, file):
-        sha_hash, md5_hash = self.hasher.get_hashes(file)
-        data = self.connection.cursor().execute("""
-            SELECT full_path, filename
-            FROM files f
-            JOIN hashes h ON h.hash_id = f.hash_id
-            WHERE h.sha1_hash = ? AND h.md5_hash = ?
-        """, (sha_hash, md5_hash)).fetchone()
-        if data is None:
-            return None
-        return File(data[0], data[1])
+        for _, original in self.fetch_indexed_files([file]):
+            return original
 
     def get_index_count(self):
-        return self.connection.cursor().execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        return self.connection.cursor().execute("SELECT COUNT(*) FROM files").fetchone()[0]
 
-    def get_duplicates(self):
-        cursor = self.connection.cursor()
+    def _duplicate_filters(self, min_size, paths):
+        conditions = ["f.hash_id IS NOT NULL"]
+        params = []
+        if min_size:
+            conditions.append("f.size >= ?")
+            params.append(min_size)
 
-        dupes = cursor.execute("""
-            SELECT GROUP_CONCAT(full_path , '|') FROM files f
-            JOIN hashes h ON h.hash_id = f.hash_id
-            GROUP BY h.hash_id
-            HAVING COUNT(h.hash_id) > 1
-        """).fetchall()
-        for (dupe,) in dupes:
-            real_dupes = dupe.split("|")
+        if paths:
+            # a range on the directory path can use the unique index on directories, unlike LIKE or substr
+            prefixes = [os.path.join(os.path.abspath(os.path.expanduser(path)), '') for path in paths]
+            conditions.append("({0})".format(" OR ".join(["(d.path >= ? AND d.path < ?)"] * len(prefixes))))
+            for prefix in prefixes:
+                params.extend([prefix, prefix + u'\U0010ffff'])
+
+        return " AND ".join(conditions), params
+
+    def get_duplicates(self, min_size=None, paths=None, order_by_wasted=False):
+        conditions, params = self._duplicate_filters(min_size, paths)
+        order = "g.size * (g.copies - 1) DESC, g.hash_id" if order_by_wasted else "g.hash_id"
+        # directories are only needed to group the files when filtering on their path
+        join = "JOIN directories d ON d.dir_id = f.dir_id" if paths else ""
+
+        # hardlinks of a file share its device and inode, they are counted as a single copy. Groups of which all files
+        # are hardlinks of the same file don't waste any space and are not reported
+        rows = self.connection.cursor().execute("""
+            SELECT f.hash_id, d.path || f.name, g.size, f.device || ':' || NULLIF(f.inode, 0)
+            FROM (
+                SELECT f.hash_id, MAX(f.size) AS size, COUNT(DISTINCT {3}) AS copies
+                FROM files f
+                {2}
+                WHERE {0}
+                GROUP BY f.hash_id
+                HAVING copies > 1
+            ) g
+            JOIN files f ON f.hash_id = g.hash_id
+            JOIN directories d ON d.dir_id = f.dir_id
+            WHERE {0}
+            ORDER BY {1}, d.path || f.name
+        """.format(conditions, order, join, COPY_KEY), params + params)
+
+        if self.stats is not None:
+            rows = timed_iter(self.stats, 'query', rows)
+
+        # rows are streamed from the cursor, only the paths of a single group are held in memory. Only the first path
+        # of every inode is compared, the other paths are added back to its results
+        links = {}
+        groups = (
+            (_link_representatives(((row[1], row[3]) for row in group), links), size)
+            for (_, size), group in groupby(rows, key=lambda row: (row[0], row[2]))
+        )
+        if self.verifier is None:
+            verified = ((size, [paths]) for paths, size in groups)
+        else:
+            verified = self.verifier.split_groups(groups)
+
+        for size, splits in verified:
+            for result in self._duplicate_results(size, splits, links):
+                yield result
 
-            result = DuplicateFileResult()
+    def _duplicate_results(self, size, splits, links):
+        # every set of identical files is a result, files without an identical copy are reported as different
+        # on the first result
+        groups = [paths for paths in splits if len(paths) > 1]
+        unmatched = [paths[0] for paths in splits if len(paths) == 1]
+        if not groups:
+            groups, unmatched = [unmatched[:1]], unmatched[1:]
 
-            first = real_dupes[0]
-            result.add_duplicate(first)
-            for next in real_dupes[1:]:
-                same = filecmp.cmp(first, next)
-                if not same:
-                    result.add_diff(next)
-                else:
-                    result.add_duplicate(next)
+        results = []
+        for paths in groups:
+            result = DuplicateFileResult(size)
+            result.copies = len(paths)
+            for path in paths:
+                for link in links.pop(path, [path]):
+                    result.add_duplicate(link)
+            results.append(result)
 
-            yield result
+        for path in unmatched:
+            for link in links.pop(path, [path]):
+                results[0].add_diff(link)
+        return results
+
+    def update_signatures(self, files):
+        # files of which the content is still the same, like files replaced by a link to an identical file
+        self.connection.executemany(
+            "UPDATE files SET size = ?, mtime_ns = ?, inode = ?, device = ? "
+            "WHERE dir_id = (SELECT dir_id FROM directories WHERE path = ?) AND name = ?",
+            [self._signature(file) + split_path(file.full_path) for file in files]
+        )
+        measure(self.stats, 'commit', len(files), 0, self.connection.commit)
 
     def get_files(self):
         cursor = self.connection.cursor()
-        cursor = cursor.execute("SELECT full_path, filename FROM files")
+        cursor = cursor.execute(
+            "SELECT d.path || f.name, f.name FROM files f JOIN directories d ON d.dir_id = f.dir_id")
 
         while True:
             results = cursor.fetchmany(1000)
-            if results is None:
+            if not results:
                 break
 
             for result in results:
                 yield File(result[0], result[1])
 
+    def iter_directories(self, batch_size=None):
+        # directories are read a batch at a time, so no cursor stays open while files are deleted
+        batch_size = batch_size or self.BATCH_SIZE
+        last_id = 0
+        while True:
+            directories = self.connection.execute(
+                "SELECT dir_id, path FROM directories WHERE dir_id > ? ORDER BY dir_id LIMIT ?", (last_id, batch_size)
+            ).fetchall()
+            if not directories:
+                break
+
+            names = defaultdict(list)
+            for dir_id, name in self._select_in(
+                    "SELECT dir_id, name FROM files WHERE dir_id IN ({0})", [dir_id for dir_id, _ in directories]):
+                names[dir_id].append(name)
+
+            for dir_id, path in directories:
+                yield dir_id, path, names[dir_id]
+            last_id = directories[-1][0]
+
+    def delete_files(self, files):
+        self.connection.executemany("DELETE FROM files WHERE dir_id = ? AND name = ?", files)
+        self._invalidate_trees(self.connection, (
+            path for path, in self._select_in(
+                "SELECT path FROM directories WHERE dir_id IN ({0})", [dir_id for dir_id, _ in files])
+        ))
+        measure(self.stats, 'commit', len(files), 0, self.connection.commit)
+
+    def purge_orphans(self):
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM hashes WHERE hash_id NOT IN (SELECT hash_id FROM files WHERE hash_id IS NOT NULL)")
+        if self.has_table('perceptual_hashes'):
+            cursor.execute("""
+                DELETE FROM perceptual_hashes
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM files f WHERE f.dir_id = perceptual_hashes.dir_id AND f.name = perceptual_hashes.name
+                )
+            """)
+        if self.has_table('file_chunks'):
+            cursor.execute("""
+                DELETE FROM file_chunks
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM files f WHERE f.dir_id = file_chunks.dir_id AND f.name = file_chunks.name
+                )
+            """)
+            cursor.execute("DELETE FROM chunks WHERE chunk_id NOT IN (SELECT chunk_id FROM file_chunks)")
+        cursor.execute("DELETE FROM directories WHERE dir_id NOT IN (SELECT dir_id FROM files)")
+        self.connection.commit()
+
     def delete(self, file):
         cursor = self.connection.cursor()
         try:
-            cursor.execute("DELETE FROM files WHERE full_path = ?", (file.full_path, ))
+            cursor.execute(
+                "DELETE FROM files WHERE dir_id = (SELECT dir_id FROM directories WHERE path = ?) AND name = ?",
+                split_path(file.full_path)
+            )
+            self._invalidate_trees(cursor, [split_path(file.full_path)[0]])
             cursor.execute("""
                 DELETE FROM hashes WHERE hash_id IN (
-                    SELECT hash_id
+                    SELECT h.hash_id
                     FROM hashes h
                     LEFT JOIN files f ON h.hash_id = f.hash_id
-                    WHERE f.full_path IS NONE
+                    WHERE f.name IS NULL
                 )
             """)
             return True
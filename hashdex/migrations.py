@@ -0,0 +1,183 @@
+import os
+
+from .hashing import Hasher
+from .indexer import split_path, to_digest
+from .perceptual import BLOCKS, BLOCK_COLUMNS, build_block_indexes, create_table
+
+
+def _batches(indexer, query, key, batch_size):
+    # the last copied id is stored in the same transaction as the copied rows, an interrupted migration continues
+    # after the last committed batch
+    last_id = int(indexer.get_meta(key, 0))
+    while True:
+        rows = indexer.connection.execute(query, (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+
+        yield rows
+
+        last_id = rows[-1][0]
+        indexer.set_meta(key, last_id)
+        indexer.connection.commit()
+
+
+def _legacy_size(full_path):
+    # files indexed before sizes were stored and which no longer exist keep a NULL size, they are never used as a size
+    # match
+    try:
+        return os.stat(full_path).st_size
+    except OSError:
+        return None
+
+
+def _copy_hashes(indexer, batch_size):
+    query = "SELECT hash_id, sha1_hash, md5_hash FROM legacy_hashes WHERE hash_id > ? ORDER BY hash_id LIMIT ?"
+    for rows in _batches(indexer, query, 'migrated_hashes', batch_size):
+        indexer.connection.executemany(
+            "INSERT OR IGNORE INTO hashes (hash_id, digest) VALUES (?,?)",
+            [(hash_id, to_digest((sha1_hash, md5_hash or ''))) for hash_id, sha1_hash, md5_hash in rows]
+        )
+
+
+def _legacy_path(full_path, base):
+    # indexes built before paths were made absolute store them as they were passed to add, relative paths are
+    # resolved against the base directory given to migrate
+    return os.path.normpath(os.path.join(base or '', full_path))
+
+
+def _check_relative_paths(indexer, table):
+    if indexer.has_table('meta') and indexer.get_meta('migration_base') is not None:
+        return
+    for full_path, in indexer.connection.execute("SELECT full_path FROM {0}".format(table)):
+        if not os.path.isabs(full_path):
+            raise ValueError(
+                "the index contains relative paths like {0}, pass the directory they are relative to with "
+                "--base".format(full_path))
+
+
+def _copy_files(indexer, batch_size):
+    columns = [row[1] for row in indexer.connection.execute("PRAGMA table_info(legacy_files)").fetchall()]
+    # files indexed before stat signatures were stored are always treated as changed
+    selected = ", ".join(
+        column if column in columns else "NULL" for column in ('size', 'mtime_ns', 'inode', 'device'))
+    query = "SELECT rowid, hash_id, full_path, {0} FROM legacy_files WHERE rowid > ? ORDER BY rowid LIMIT ?".format(
+        selected)
+
+    base = indexer.get_meta('migration_base')
+    cursor = indexer.connection.cursor()
+    for rows in _batches(indexer, query, 'migrated_files', batch_size):
+        rows = [row[:2] + (_legacy_path(row[2], base), ) + row[3:] for row in rows]
+        dir_ids = indexer.directory_ids(cursor, [split_path(row[2])[0] for row in rows])
+        files = []
+        for _, hash_id, full_path, size, mtime_ns, inode, device in rows:
+            directory, name = split_path(full_path)
+            if size is None:
+                size = _legacy_size(full_path)
+            files.append((dir_ids[directory], name, hash_id, size, mtime_ns, inode, device))
+
+        cursor.executemany(
+            "INSERT OR REPLACE INTO files (dir_id, name, hash_id, size, mtime_ns, inode, device) "
+            "VALUES (?,?,?,?,?,?,?)",
+            files
+        )
+
+
+def _build_legacy_meta(indexer):
+    # indexes built before the hash strategy was recorded were all hashed with the sampled sha1 and md5 hashes
+    if not indexer.has_table('meta'):
+        indexer.build_meta(Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+
+
+def _split_paths(indexer, batch_size):
+    connection = indexer.connection
+    _check_relative_paths(indexer, 'legacy_files' if indexer.has_table('legacy_files') else 'files')
+    _build_legacy_meta(indexer)
+    if not indexer.has_table('legacy_files'):
+        for index in ('idx_hashes', 'idx_paths', 'idx_sizes', 'idx_file_hashes'):
+            connection.execute("DROP INDEX IF EXISTS {0}".format(index))
+        connection.execute("ALTER TABLE files RENAME TO legacy_files")
+        connection.execute("ALTER TABLE hashes RENAME TO legacy_hashes")
+        indexer.build_tables()
+        connection.commit()
+
+    _copy_hashes(indexer, batch_size)
+    _copy_files(indexer, batch_size)
+
+    connection.execute("DROP TABLE legacy_files")
+    connection.execute("DROP TABLE legacy_hashes")
+    indexer.set_meta('migrated_hashes', None)
+    indexer.set_meta('migrated_files', None)
+    indexer.set_meta('migration_base', None)
+
+
+def _index_inodes(indexer, batch_size):
+    # hardlinks are looked up by their inode while adding files
+    indexer.connection.execute("CREATE INDEX IF NOT EXISTS idx_inodes ON files ( inode, device )")
+
+
+def _split_perceptual_hashes(indexer, batch_size):
+    # similar images are found by exact lookups of blocks of their perceptual hash
+    if not indexer.has_table('perceptual_hashes'):
+        return
+
+    connection = indexer.connection
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(perceptual_hashes)").fetchall()]
+    for column in BLOCK_COLUMNS:
+        if column not in columns:
+            connection.execute("ALTER TABLE perceptual_hashes ADD COLUMN {0} INTEGER".format(column))
+    connection.execute("UPDATE perceptual_hashes SET {0}".format(", ".join(
+        "{0} = ((phash >> {1}) & {2})".format(column, shift, mask)
+        for column, (shift, mask) in zip(BLOCK_COLUMNS, BLOCKS))))
+    build_block_indexes(connection)
+
+
+def _drop_tree_hashes(indexer, batch_size):
+    # directory hashes now include the sizes of their files, the stored ones are computed again when needed
+    indexer.connection.execute("DROP TABLE IF EXISTS tree_hashes")
+
+
+def _widen_perceptual_blocks(indexer, batch_size):
+    # the hashes are split into fewer, wider blocks. sqlite can't drop the columns of the old blocks, the table is
+    # copied and the indexes of the old blocks, which would keep their names, are dropped first
+    if not indexer.has_table('perceptual_hashes'):
+        return
+
+    connection = indexer.connection
+    indexes = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_perceptual_%'").fetchall()
+    for name, in indexes:
+        connection.execute("DROP INDEX {0}".format(name))
+    connection.execute("ALTER TABLE perceptual_hashes RENAME TO legacy_perceptual_hashes")
+    create_table(connection)
+    connection.execute("""
+        INSERT INTO perceptual_hashes (dir_id, name, phash, {0})
+        SELECT dir_id, name, phash, {1} FROM legacy_perceptual_hashes
+    """.format(", ".join(BLOCK_COLUMNS), ", ".join(
+        "((phash >> {0}) & {1})".format(shift, mask) for shift, mask in BLOCKS)))
+    connection.execute("DROP TABLE legacy_perceptual_hashes")
+    build_block_indexes(connection)
+
+
+# every migration upgrades the index from the previous version, the version is only stored once it completed
+MIGRATIONS = [
+    (2, "store binary digests and split paths into directories and names", _split_paths),
+    (3, "index files by inode to find hardlinks", _index_inodes),
+    (4, "split perceptual hashes into indexed blocks to find similar images", _split_perceptual_hashes),
+    (5, "hash directories with the sizes of their files", _drop_tree_hashes),
+    (6, "split perceptual hashes into wider blocks searched within a radius", _widen_perceptual_blocks),
+]
+
+
+def migrate(indexer, batch_size=None, base=None):
+    batch_size = batch_size or indexer.BATCH_SIZE
+    if base is not None and indexer.get_schema_version() < 2:
+        # stored in the index, so an interrupted migration resolves the remaining paths the same way
+        _build_legacy_meta(indexer)
+        indexer.set_meta('migration_base', os.path.abspath(os.path.expanduser(base)))
+        indexer.connection.commit()
+    for version, description, migration in MIGRATIONS:
+        if indexer.get_schema_version() < version:
+            yield version, description
+            migration(indexer, batch_size)
+            indexer.set_schema_version(version)
+            indexer.connection.commit()
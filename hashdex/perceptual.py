@@ -0,0 +1,255 @@
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+from .files import stat_file
+from .indexer import UNCHANGED, split_path, _batches
+from .stats import measure
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+AVAILABLE = Image is not None
+
+IMAGE_EXTENSIONS = frozenset(['.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'])
+
+# number of rows and columns of the difference hash, 8 gives a 64 bit hash
+HASH_SIZE = 8
+# maximum number of different bits of two similar images
+DEFAULT_DISTANCE = 8
+
+_SIGN_BIT = 1 << (HASH_SIZE * HASH_SIZE - 1)
+
+
+def _block_bits(count):
+    # the shift and mask of every block, the first blocks get the bits left over when dividing the hash
+    bits, extra = divmod(HASH_SIZE * HASH_SIZE, count)
+    shift = 0
+    blocks = []
+    for i in range(count):
+        width = bits + (i < extra)
+        blocks.append((shift, (1 << width) - 1))
+        shift += width
+    return blocks
+
+
+# multi-index hashing: every hash is split into four blocks of 16 bits and each block is indexed. Of m blocks of two
+# hashes at most d bits apart, at least one differs in at most d // m bits (pigeonhole principle), so the candidates
+# within d bits are found by looking up every value within d // m bits of each block. For the default distance that is
+# 137 values per block, which a random hash matches with one in 120 of the indexed hashes
+BLOCKS = _block_bits(4)
+# the lookups of larger radii grow too long, images further apart are found by comparing all of them
+MAX_RADIUS = 3
+BLOCK_COLUMNS = ['block{0}'.format(i) for i in range(len(BLOCKS))]
+
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def dhash(path):
+    # the image is shrunk to a grid of grey pixels one column wider than the hash, every bit tells whether a pixel is
+    # brighter than its right neighbour. Re-encoding, resizing and small edits only flip a few bits
+    with Image.open(path) as image:
+        # jpeg images are decoded at a fraction of their size, which is a lot faster for photos
+        image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+        pixels = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).tobytes()
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + column
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def image_hash(file):
+    try:
+        return dhash(file.full_path)
+    except (IOError, OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        # files with an image extension which can't be decoded are not compared
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _to_signed(value):
+    # sqlite integers are signed 64 bit values
+    return value - (_SIGN_BIT << 1) if value & _SIGN_BIT else value
+
+
+def _to_unsigned(value):
+    return value + (_SIGN_BIT << 1) if value < 0 else value
+
+
+def split_blocks(value):
+    # gives the same blocks for the signed and unsigned value, as does the same expression in sqlite
+    return [value >> shift & mask for shift, mask in BLOCKS]
+
+
+def _nearby(block, width, radius):
+    # every value of a block of width bits which differs in at most radius bits
+    values = [block]
+    for bits in range(1, radius + 1):
+        for positions in combinations(range(width), bits):
+            values.append(functools.reduce(lambda value, position: value ^ 1 << position, positions, block))
+    return values
+
+
+def create_table(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS perceptual_hashes (
+            dir_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phash INTEGER NOT NULL,
+            {0},
+            PRIMARY KEY (dir_id, name)
+        ) WITHOUT ROWID
+    """.format(",\n".join("{0} INTEGER".format(column) for column in BLOCK_COLUMNS)))
+
+
+def build_block_indexes(connection):
+    for column in BLOCK_COLUMNS:
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_perceptual_{0} ON perceptual_hashes ( {0} )".format(column))
+
+
+class PerceptualIndex(object):
+    BATCH_SIZE = 1000
+
+    def __init__(self, indexer, jobs=1):
+        self.indexer = indexer
+        self.connection = indexer.connection
+        self.jobs = jobs
+        self.stats = indexer.stats
+
+    def build(self):
+        create_table(self.connection)
+        build_block_indexes(self.connection)
+        self.connection.commit()
+
+    def _hash(self, file):
+        return file, measure(self.stats, 'perceptual', 1, stat_file(file).st_size, image_hash, file)
+
+    def hash_images(self, files):
+        if self.jobs <= 1:
+            return map(self._hash, files)
+
+        # decoding and resizing release the GIL, the results keep the order of the files
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(self._hash, files))
+
+    def _has_hash(self, file):
+        return self.connection.execute("""
+            SELECT 1
+            FROM perceptual_hashes p
+            JOIN directories d ON d.dir_id = p.dir_id
+            WHERE d.path = ? AND p.name = ?
+        """, split_path(file.full_path)).fetchone() is not None
+
+    def _needs_hash(self, file, status):
+        if status is None or not is_image(file.full_path):
+            return False
+        return status != UNCHANGED or not self._has_hash(file)
+
+    def _store(self, files):
+        cursor = self.connection.cursor()
+        hashed = list(self.hash_images(files))
+        dir_ids = self.indexer.directory_ids(cursor, [split_path(file.full_path)[0] for file, _ in hashed])
+        rows = []
+        for file, value in hashed:
+            directory, name = split_path(file.full_path)
+            rows.append((dir_ids[directory], name, value))
+
+        cursor.executemany(
+            "INSERT OR REPLACE INTO perceptual_hashes (dir_id, name, phash, {0}) VALUES (?,?,?,{1})".format(
+                ", ".join(BLOCK_COLUMNS), ",".join("?" * len(BLOCK_COLUMNS))),
+            [(dir_id, name, _to_signed(value)) + tuple(split_blocks(value))
+             for dir_id, name, value in rows if value is not None]
+        )
+        cursor.executemany(
+            "DELETE FROM perceptual_hashes WHERE dir_id = ? AND name = ?",
+            [(dir_id, name) for dir_id, name, value in rows if value is None]
+        )
+        self.connection.commit()
+
+    def add_files(self, results):
+        # the results of Indexer.add_files are passed through, the images among them are hashed per batch
+        self.build()
+        for batch in _batches(results, self.BATCH_SIZE):
+            self._store([file for file, status in batch if self._needs_hash(file, status)])
+            for result in batch:
+                yield result
+
+    def iter_hashes(self):
+        if not self.indexer.has_table('perceptual_hashes'):
+            return
+        # images of which the file is no longer indexed are skipped
+        rows = self.connection.execute("""
+            SELECT d.path || p.name, p.phash
+            FROM perceptual_hashes p
+            JOIN files f ON f.dir_id = p.dir_id AND f.name = p.name
+            JOIN directories d ON d.dir_id = p.dir_id
+            ORDER BY d.path, p.name
+        """)
+        for full_path, value in rows:
+            yield full_path, _to_unsigned(value)
+
+    def _candidates(self, value, max_distance):
+        radius = max_distance // len(BLOCKS)
+        if radius > MAX_RADIUS:
+            return self.iter_hashes()
+        return self._nearby_hashes(value, radius)
+
+    def _nearby_hashes(self, value, radius):
+        # a hash close to the value in several blocks is found by each of their lookups, it is only compared once
+        seen = set()
+        for column, block, (_, mask) in zip(BLOCK_COLUMNS, split_blocks(value), BLOCKS):
+            blocks = _nearby(block, mask.bit_length(), radius)
+            rows = self.connection.execute("""
+                SELECT d.path || p.name, p.phash
+                FROM perceptual_hashes p
+                JOIN files f ON f.dir_id = p.dir_id AND f.name = p.name
+                JOIN directories d ON d.dir_id = p.dir_id
+                WHERE p.{0} IN ({1})
+            """.format(column, ",".join("?" * len(blocks))), blocks)
+            for full_path, candidate in rows:
+                if full_path not in seen:
+                    seen.add(full_path)
+                    yield full_path, _to_unsigned(candidate)
+
+    def search(self, value, max_distance=DEFAULT_DISTANCE):
+        # the candidates have a block close to one of the hash, only those within max_distance bits are similar
+        matches = []
+        for full_path, candidate in self._candidates(value, max_distance):
+            distance = hamming(value, candidate)
+            if distance <= max_distance:
+                matches.append((distance, full_path))
+        return sorted(matches)
+
+    def find_similar(self, files, max_distance=DEFAULT_DISTANCE):
+        if not self.indexer.has_table('perceptual_hashes'):
+            return
+        for file, value in self.hash_images(file for file in files if is_image(file.full_path)):
+            if value is None:
+                continue
+            matches = [(distance, path) for distance, path in self.search(value, max_distance)
+                       if path != file.full_path]
+            if matches:
+                yield file, matches
+
+    def similar_groups(self, max_distance=DEFAULT_DISTANCE):
+        # every image is grouped with the similar images which are not in a group yet, so an image is reported once
+        # and a chain of slightly different images doesn't end up in a single group
+        grouped = set()
+        for full_path, value in list(self.iter_hashes()):
+            if full_path in grouped:
+                continue
+            group = [(distance, path) for distance, path in self.search(value, max_distance) if path not in grouped]
+            if len(group) > 1:
+                grouped.update(path for _, path in group)
+                yield group
@@ -0,0 +1,214 @@
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .files import stat_file
+from .hashing import ParallelHasher
+
+
+def _take(files, count):
+    chunk = []
+    for file in files:
+        chunk.append(file._replace(stat=stat_file(file)))
+        if len(chunk) >= count:
+            break
+    return chunk
+
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+class StageStats(object):
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        # seconds spent doing the work of the stage, summed over all workers
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self.max_queue = 0
+        self._queue_total = 0
+        self._queue_samples = 0
+
+    def start(self):
+        if self.started is None:
+            self.started = time.perf_counter()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def sample_queue(self, queue):
+        depth = queue.qsize()
+        self.max_queue = max(self.max_queue, depth)
+        self._queue_total += depth
+        self._queue_samples += 1
+
+    @property
+    def mean_queue(self):
+        return self._queue_total / self._queue_samples if self._queue_samples else 0.0
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self):
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def utilization(self):
+        # a stage which is busy all the time bounds the pipeline, its input queue stays full
+        return self.busy / (self.elapsed * self.workers) if self.elapsed else 0.0
+
+    def __str__(self):
+        return "{0}: {1} files in {2:.2f}s ({3:.1f} files/s), {4:.0%} busy, queue max {5} mean {6:.1f}".format(
+            self.name, self.items, self.elapsed, self.throughput, self.utilization, self.max_queue, self.mean_queue)
+
+
+# scanner -> hasher -> writer stages connected by bounded queues, a full queue stops the stage before it. Blocking work
+# runs in threads so the event loop is never blocked: directories are listed in a single scan thread, files are read
+# and hashed by a pool of workers and all SQLite work, the index and the hash cache, runs in a single database thread.
+# Both connections must be opened with check_same_thread=False.
+class Pipeline(object):
+    QUEUE_SIZE = 1000
+    # number of files listed by the scan thread at once
+    SCAN_CHUNK = 100
+
+    def __init__(self, scanner, indexer, jobs=1, incremental=False, batch_size=None, queue_size=QUEUE_SIZE):
+        self.scanner = scanner
+        self.indexer = indexer
+        # the hash workers of the pipeline take the place of the pool of a parallel hasher
+        hasher = indexer.hasher
+        self.hasher = hasher.hasher if isinstance(hasher, ParallelHasher) else hasher
+        self.jobs = jobs
+        self.incremental = incremental
+        self.batch_size = batch_size or indexer.BATCH_SIZE
+        self.queue_size = queue_size
+        self.stats = [
+            StageStats('scan'),
+            StageStats('lookup'),
+            StageStats('hash', jobs),
+            StageStats('write'),
+        ]
+        self._statuses = {}
+        # sizes of files which are being hashed or waiting to be written, see Indexer.add_files
+        self._pending_sizes = Counter()
+        self._pending_links = {}
+        self._running_hashers = 0
+
+    async def _run_in(self, executor, stats, function, *args):
+        result, duration = await asyncio.get_event_loop().run_in_executor(executor, _timed, function, *args)
+        stats.busy += duration
+        return result
+
+    async def _scan(self, executor, scanned):
+        stats = self.stats[0]
+        stats.start()
+        files = iter(self.scanner.iter_files())
+        while True:
+            chunk = await self._run_in(executor, stats, _take, files, self.SCAN_CHUNK)
+            if not chunk:
+                break
+            for file in chunk:
+                await scanned.put(file)
+            stats.items += len(chunk)
+
+        for _ in range(self.jobs):
+            await scanned.put(None)
+        stats.finish()
+
+    def _lookup(self, file):
+        if not self.indexer._needs_hash(
+                file, self.incremental, self._statuses, self._pending_sizes, self._pending_links):
+            return False, None
+        if self.hasher.cache is None:
+            return True, None
+        return True, self.hasher.cache.get(file, self.hasher.strategy, self.hasher.algorithm)
+
+    def _store_in_cache(self, file, hashes):
+        self.hasher.cache.put(file, self.hasher.strategy, self.hasher.algorithm, hashes)
+
+    async def _hash(self, database, executor, scanned, hashed):
+        lookup, stats = self.stats[1:3]
+        lookup.start()
+        stats.start()
+        while True:
+            stats.sample_queue(scanned)
+            file = await scanned.get()
+            if file is None:
+                break
+
+            needs_hash, hashes = await self._run_in(database, lookup, self._lookup, file)
+            lookup.items += 1
+            if needs_hash and hashes is None:
+                hashes = await self._run_in(executor, stats, self.hasher._hash_content, file)
+                stats.items += 1
+                if self.hasher.cache is not None:
+                    await self._run_in(database, lookup, self._store_in_cache, file, hashes)
+            await hashed.put((file, hashes))
+
+        self._running_hashers -= 1
+        if not self._running_hashers:
+            await hashed.put(None)
+            lookup.finish()
+            stats.finish()
+
+    async def _write(self, database, hashed, statuses, on_result):
+        stats = self.stats[3]
+        stats.start()
+        batch = []
+        done = False
+        while not done:
+            stats.sample_queue(hashed)
+            item = await hashed.get()
+            if item is None:
+                done = True
+            else:
+                batch.append(item)
+
+            if batch and (done or len(batch) >= self.batch_size):
+                results = await self._run_in(
+                    database, stats, self.indexer._store_hashed,
+                    batch, self.incremental, self._statuses, self._pending_sizes, None, self._pending_links)
+                stats.items += len(batch)
+                batch = []
+                for file, status in results:
+                    statuses[status] += 1
+                    if on_result is not None:
+                        on_result(file, status)
+
+        if self.hasher.cache is not None:
+            await self._run_in(database, stats, self.hasher.cache.flush)
+        stats.finish()
+
+    async def run(self, on_result=None):
+        scanned = asyncio.Queue(self.queue_size)
+        hashed = asyncio.Queue(self.queue_size)
+        statuses = Counter()
+        self._running_hashers = self.jobs
+
+        scan_executor = ThreadPoolExecutor(max_workers=1)
+        hash_executor = ThreadPoolExecutor(max_workers=self.jobs)
+        database = ThreadPoolExecutor(max_workers=1)
+        tasks = [asyncio.ensure_future(self._scan(scan_executor, scanned))]
+        tasks.extend(
+            asyncio.ensure_future(self._hash(database, hash_executor, scanned, hashed)) for _ in range(self.jobs))
+        tasks.append(asyncio.ensure_future(self._write(database, hashed, statuses, on_result)))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            for executor in (scan_executor, hash_executor, database):
+                executor.shutdown(wait=False)
+
+        return statuses
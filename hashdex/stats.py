@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+# cpu time of the calling thread, python 3.5 and 3.6 only have the cpu time of the whole process
+_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'bytes': self.bytes, 'wall': self.wall, 'cpu': self.cpu}
+
+
+# scanners, hashers, indexers and verifiers have a stats attribute which is None unless statistics are collected, so
+# the only cost of disabled statistics is a check for None. Stages are measured from worker threads as well, so the
+# wall and cpu time of a stage is summed over all threads working on it.
+class Stats(object):
+    def __init__(self):
+        self.stages = {}
+        self.order = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start(self):
+        return time.perf_counter(), _cpu_time()
+
+    def stop(self, name, started, count=1, size=0):
+        self.add(name, count, size, time.perf_counter() - started[0], _cpu_time() - started[1])
+
+    def add(self, name, count, size, wall, cpu):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+                self.order.append(name)
+            stage.count += count
+            stage.bytes += size
+            stage.wall += wall
+            stage.cpu += cpu
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def to_dict(self):
+        return {
+            'elapsed': self.elapsed(),
+            'stages': dict((name, stage.to_dict()) for name, stage in self.stages.items()),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def summary(self):
+        lines = ["{0:<10} {1:>10} {2:>14} {3:>10} {4:>10}".format('stage', 'count', 'bytes', 'wall', 'cpu')]
+        for name in self.order:
+            stage = self.stages[name]
+            lines.append("{0:<10} {1:>10} {2:>14} {3:>9.3f}s {4:>9.3f}s".format(
+                name, stage.count, stage.bytes, stage.wall, stage.cpu))
+        lines.append("total time {0:.3f}s".format(self.elapsed()))
+        return "\n".join(lines)
+
+
+def measure(stats, name, count, size, function, *args):
+    if stats is None:
+        return function(*args)
+
+    started = stats.start()
+    result = function(*args)
+    stats.stop(name, started, count, size)
+    return result
+
+
+def timed_iter(stats, name, iterable, size=None):
+    # only the time spent producing an item is measured, not the time the consumer spends on it
+    iterator = iter(iterable)
+    while True:
+        started = stats.start()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stats.stop(name, started, 0)
+            return
+        stats.stop(name, started, 1, size(item) if size is not None else 0)
+        yield item
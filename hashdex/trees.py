@@ -0,0 +1,154 @@
+import hashlib
+import os
+from collections import defaultdict
+
+from .files import DuplicateFileResult
+from .indexer import parent_directory
+from .stats import measure
+
+
+def _name(path):
+    return os.path.basename(os.path.dirname(path))
+
+
+def _encode(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def tree_digest(entries):
+    # merkle hash of a directory: the names, sizes and digests of its files and subdirectories, ordered by name. The
+    # sampled hash of a file doesn't cover all of its content, the size tells apart files which only differ in length.
+    # A directory of which any file isn't hashed has no digest, files with a unique size can't have a copy anyway
+    entries = sorted(entries)
+    if any(digest is None for _, _, _, digest in entries):
+        return None
+
+    digest = hashlib.sha1()
+    for name, kind, size, entry_digest in entries:
+        digest.update(kind + _encode(name) + b'\0' + str(size).encode() + b'\0' + bytes(entry_digest))
+    return digest.digest()
+
+
+class TreeIndex(object):
+    def __init__(self, indexer):
+        self.indexer = indexer
+        self.connection = indexer.connection
+        self.stats = indexer.stats
+
+    def build(self):
+        # directories without files are not stored in the directories table, so tree hashes are stored by path
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS tree_hashes (
+                path TEXT PRIMARY KEY,
+                digest BLOB,
+                size INTEGER NOT NULL,
+                files INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.connection.commit()
+
+    def _stored(self):
+        if not self.indexer.has_table('tree_hashes'):
+            return {}
+        return dict(
+            (path, (None if digest is None else bytes(digest), size, files))
+            for path, digest, size, files in self.connection.execute(
+                "SELECT path, digest, size, files FROM tree_hashes")
+        )
+
+    def _tree(self):
+        # every directory with indexed files and all directories above them
+        dir_ids = dict(
+            (path, dir_id) for dir_id, path in self.connection.execute("""
+                SELECT d.dir_id, d.path
+                FROM directories d
+                WHERE EXISTS (SELECT 1 FROM files f WHERE f.dir_id = d.dir_id)
+            """)
+        )
+        children = defaultdict(list)
+        seen = set()
+        for path in dir_ids:
+            while path not in seen:
+                seen.add(path)
+                parent = parent_directory(path)
+                if parent == path:
+                    break
+                children[parent].append(path)
+                path = parent
+        return dir_ids, children, seen
+
+    def _hash_directory(self, path, dir_id, children, hashes):
+        entries = []
+        size = files = 0
+        if dir_id is not None:
+            for name, file_size, digest in self.connection.execute("""
+                SELECT f.name, f.size, h.digest
+                FROM files f
+                LEFT JOIN hashes h ON h.hash_id = f.hash_id
+                WHERE f.dir_id = ?
+            """, (dir_id, )):
+                entries.append((name, b'f', file_size or 0, digest))
+                size += file_size or 0
+                files += 1
+
+        for child in children.get(path, ()):
+            digest, child_size, child_files = hashes[child]
+            entries.append((_name(child), b'd', child_size, digest))
+            size += child_size
+            files += child_files
+        return tree_digest(entries), size, files
+
+    def _hash_directories(self, stale, dir_ids, children, hashes):
+        # subdirectories are always longer than their parent, so they are hashed first
+        for path in sorted(stale, key=len, reverse=True):
+            hashes[path] = self._hash_directory(path, dir_ids.get(path), children, hashes)
+
+    def update(self):
+        # only directories of which the hash was invalidated by adding or removing files are hashed again, all others
+        # are read from the index. The hashes of a read only index are only kept in memory
+        stored = self._stored()
+        dir_ids, children, paths = self._tree()
+        hashes = dict((path, stored[path]) for path in paths if path in stored)
+        stale = [path for path in paths if path not in stored]
+        measure(self.stats, 'tree', len(stale), 0, self._hash_directories, stale, dir_ids, children, hashes)
+
+        if stale and not self.indexer.read_only:
+            self.build()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tree_hashes (path, digest, size, files) VALUES (?,?,?,?)",
+                [(path, ) + hashes[path] for path in stale]
+            )
+            self.connection.commit()
+        return hashes
+
+    def _is_implied(self, group, hashes):
+        # copies of directories which only exist because their parents are copies of each other are reported with
+        # their parents, every parent holds one of them
+        parents = set(parent_directory(path) for path in group)
+        digests = set(hashes[parent][0] if parent in hashes else None for parent in parents)
+        return len(parents) == len(group) and len(digests) == 1 and None not in digests
+
+    def get_duplicates(self, min_size=None, paths=None, order_by_wasted=False):
+        hashes = self.update()
+        prefixes = [os.path.join(os.path.abspath(os.path.expanduser(path)), '') for path in paths or ()]
+
+        groups = defaultdict(list)
+        for path, (digest, size, _) in hashes.items():
+            if digest is None or (min_size and size < min_size):
+                continue
+            if prefixes and not any(path.startswith(prefix) for prefix in prefixes):
+                continue
+            groups[digest].append(path)
+
+        results = []
+        for group in groups.values():
+            if len(group) > 1 and not self._is_implied(group, hashes):
+                result = DuplicateFileResult(hashes[group[0]][1])
+                for path in sorted(group):
+                    result.add_duplicate(path)
+                results.append(result)
+
+        results.sort(key=lambda result: result.dupes[0])
+        if order_by_wasted:
+            results.sort(key=lambda result: result.get_wasted_size(), reverse=True)
+        return results
@@ -0,0 +1,115 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .stats import measure
+
+
+class _Member(object):
+    def __init__(self, path, keep_open):
+        self.path = path
+        self.keep_open = keep_open
+        self.offset = 0
+        self._file = None
+
+    def read(self, size):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+            self._file.seek(self.offset)
+
+        content = self._file.read(size)
+        self.offset += len(content)
+        if not self.keep_open:
+            self.close()
+        return content
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Verifier(object):
+
+    CHUNK_SIZE = 1 << 20
+    # groups with more members are verified by reopening the files for every chunk
+    MAX_OPEN_FILES = 128
+
+    def __init__(self, jobs=1, min_size=0):
+        self.jobs = jobs
+        self.min_size = min_size
+        self.stats = None
+
+    def should_verify(self, size):
+        return size is None or size >= self.min_size
+
+    def _split_chunk(self, group, identical):
+        # members are compared to one representative chunk per distinct content, so only the distinct
+        # chunks are held in memory and not one chunk per member
+        splits = []
+        for member in group:
+            try:
+                content = member.read(self.CHUNK_SIZE)
+            except (IOError, OSError):
+                member.close()
+                identical.append([member])
+                continue
+
+            for representative, members in splits:
+                if representative == content:
+                    members.append(member)
+                    break
+            else:
+                splits.append((content, [member]))
+
+        remaining = []
+        for content, members in splits:
+            if not content or len(members) == 1:
+                # all members reached the end of the file at the same offset, or nothing is left to compare to
+                for member in members:
+                    member.close()
+                identical.append(members)
+            else:
+                remaining.append(members)
+        return remaining
+
+    def split(self, paths):
+        # every file is read exactly once, in lock-step with the other members of its group. A group is split
+        # as soon as the content of its members diverges
+        keep_open = len(paths) <= self.MAX_OPEN_FILES
+        members = [_Member(path, keep_open) for path in paths]
+        order = dict((path, i) for i, path in enumerate(paths))
+        identical = []
+        try:
+            groups = [members]
+            while groups:
+                groups = [split for group in groups for split in self._split_chunk(group, identical)]
+        finally:
+            for member in members:
+                member.close()
+
+        groups = [[member.path for member in group] for group in identical]
+        return sorted(groups, key=lambda group: order[group[0]])
+
+    def _split(self, paths, size):
+        if not self.should_verify(size):
+            return [list(paths)]
+        return measure(self.stats, 'verify', len(paths), (size or 0) * len(paths), self.split, paths)
+
+    def split_groups(self, groups):
+        if self.jobs <= 1:
+            for paths, size in groups:
+                yield size, self._split(paths, size)
+            return
+
+        # groups are verified concurrently, the results are yielded in the order of the groups
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = deque()
+            for paths, size in groups:
+                pending.append((size, executor.submit(self._split, paths, size)))
+                if len(pending) >= self.jobs * 2:
+                    size, future = pending.popleft()
+                    yield size, future.result()
+
+            while pending:
+                size, future = pending.popleft()
+                yield size, future.result()
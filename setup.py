@@ -43,6 +43,11 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'xxhash': ['xxhash>=2.0'],
+        'images': ['Pillow>=5.0'],
+        'chunks': ['fastcdc>=1.4'],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='hashdex',
@@ -0,0 +1,32 @@
+import pytest
+from hashdex.files import DirectoryScanner, File
+from hashdex.hashing import Hasher
+from hashdex.indexer import Indexer, create_connection
+
+
+@pytest.fixture
+def indexer():
+    # the pipeline uses the connection from its database thread
+    indexer = Indexer(create_connection(":memory:", check_same_thread=False), Hasher())
+    indexer.build_db()
+    return indexer
+
+
+@pytest.fixture
+def add_directory(indexer):
+    def add(path, incremental=False, index=None):
+        results = indexer.add_files(DirectoryScanner(str(path)).iter_files(), incremental)
+        if index is not None:
+            # perceptual hashes and chunks are indexed from the results of the file index
+            results = index.add_files(results)
+        return list(results)
+    return add
+
+
+@pytest.fixture
+def write_file():
+    def write(path, content):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        return File(str(path), path.name)
+    return write
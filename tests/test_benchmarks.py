@@ -0,0 +1,28 @@
+import os
+from benchmarks.suite import measure
+from benchmarks.tree import generate_tree
+
+
+def _tree_files(root):
+    return sorted(os.path.relpath(os.path.join(path, name), root) for path, _, names in os.walk(root) for name in names)
+
+
+def test_generated_tree_is_reproducible(tmp_path):
+    first = generate_tree(str(tmp_path / "first"), files=50, max_size=4096, duplicate_ratio=0.5, depth=2, fanout=2)
+    second = generate_tree(str(tmp_path / "second"), files=50, max_size=4096, duplicate_ratio=0.5, depth=2, fanout=2)
+
+    assert first == second
+    assert first['directories'] == 7
+    assert 0 < first['duplicates'] < 50
+    assert _tree_files(str(tmp_path / "first")) == _tree_files(str(tmp_path / "second"))
+
+
+def test_measure_reports_throughput(tmp_path):
+    summary = generate_tree(str(tmp_path), files=20, max_size=4096)
+
+    result = measure('add-files', str(tmp_path), repeat=2)
+
+    assert result['files'] == 20
+    assert result['bytes'] == summary['bytes']
+    assert len(result['timings']) == 2
+    assert result['peak_rss'] > 0
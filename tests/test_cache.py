@@ -0,0 +1,74 @@
+import os
+from hashdex.cache import HashCache
+from hashdex.files import File
+from hashdex.hashing import Hasher, ParallelHasher
+from hashdex.indexer import create_connection
+
+
+def _write(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return File(str(path), name, os.stat(str(path)))
+
+
+def test_cached_hashes_are_not_read_again(mocker, tmp_path):
+    file = _write(tmp_path, "a.txt", b"abc")
+    hasher = Hasher(cache=HashCache(create_connection(":memory:")))
+    hash_content = mocker.spy(hasher, "_hash_content")
+
+    first = hasher.get_hashes(file)
+    second = hasher.get_hashes(file)
+
+    assert first == second
+    assert hash_content.call_count == 1
+    assert (hasher.cache.hits, hasher.cache.misses) == (1, 1)
+
+
+def test_cache_is_shared_between_connections(tmp_path):
+    file = _write(tmp_path, "a.txt", b"abc")
+    location = str(tmp_path / "cache.db")
+
+    cache = HashCache(create_connection(location))
+    Hasher(cache=cache).get_hashes(file)
+    cache.close()
+
+    cache = HashCache(create_connection(location))
+    assert cache.get(file, Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM) is not None
+    assert cache.get(file, Hasher.FULL, Hasher.DEFAULT_ALGORITHM) is None
+
+
+def test_modified_file_is_hashed_again(tmp_path):
+    file = _write(tmp_path, "a.txt", b"abc")
+    hasher = Hasher(cache=HashCache(create_connection(":memory:")))
+    hasher.get_hashes(file)
+
+    os.utime(file.full_path, ns=(0, 0))
+    changed = File(file.full_path, file.filename, os.stat(file.full_path))
+
+    assert hasher.cache.get(changed, Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM) is None
+
+
+def test_parallel_hasher_uses_the_cache(mocker, tmp_path):
+    files = [_write(tmp_path, "{0}.txt".format(i), str(i).encode()) for i in range(6)]
+    hasher = Hasher(cache=HashCache(create_connection(":memory:")))
+    parallel = ParallelHasher(hasher, jobs=2)
+
+    expected = dict(parallel.hash_files(files))
+    hash_content = mocker.spy(hasher, "_hash_content")
+
+    assert dict(parallel.hash_files(files)) == expected
+    assert hash_content.called is False
+    parallel.close()
+
+
+def test_prune_removes_least_recently_used_entries(mocker, tmp_path):
+    cache = HashCache(create_connection(":memory:"))
+    time = mocker.patch("hashdex.cache.time.time")
+    for i in range(3):
+        time.return_value = i
+        cache.put(_write(tmp_path, "{0}.txt".format(i), b"x"), Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM, ("a", "b"))
+        cache.flush()
+
+    assert cache.prune(2) == 1
+    assert cache.count() == 2
+    assert cache.get(File(str(tmp_path / "0.txt"), "0.txt"), Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM) is None
@@ -0,0 +1,47 @@
+import os
+import pytest
+from hashdex.checkpoint import Checkpoint
+from hashdex.files import DirectoryScanner
+from hashdex.indexer import NEW, UNCHANGED
+
+
+@pytest.fixture
+def directory(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).mkdir()
+        for filename in ("x.txt", "y.txt"):
+            (tmp_path / name / filename).write_bytes(name.encode() * 10)
+    return str(tmp_path)
+
+
+def _interrupted_add(indexer, directory, count):
+    checkpoint = Checkpoint(indexer.connection)
+    added = indexer.add_files(DirectoryScanner(directory).iter_files(), batch_size=1, checkpoint=checkpoint)
+    results = [next(added) for _ in range(count)]
+    added.close()
+    return results
+
+
+def test_completed_directories_are_recorded(indexer, directory):
+    results = _interrupted_add(indexer, directory, 3)
+
+    first = os.path.dirname(results[0][0].full_path)
+    assert Checkpoint(indexer.connection).completed_directories() == set([first])
+
+
+def test_partially_indexed_directories_are_not_recorded(indexer, directory):
+    _interrupted_add(indexer, directory, 1)
+
+    assert Checkpoint(indexer.connection).completed_directories() == set()
+
+
+def test_resumed_add_skips_completed_directories(indexer, directory):
+    _interrupted_add(indexer, directory, 3)
+
+    checkpoint = Checkpoint(indexer.connection)
+    scanner = DirectoryScanner(directory, skip_directories=checkpoint.completed_directories())
+    results = list(indexer.add_files(scanner.iter_files(), incremental=True, checkpoint=checkpoint))
+
+    assert sorted(status for _, status in results) == [NEW] * 3 + [UNCHANGED]
+    assert indexer.get_index_count() == 6
+    assert len(checkpoint.completed_directories()) == 3
@@ -0,0 +1,148 @@
+import io
+import random
+from collections import namedtuple
+import pytest
+from hashdex.chunks import Chunker, ChunkIndex, NativeChunker, FASTCDC
+from hashdex.indexer import UNCHANGED
+
+
+def _random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def _chunks(chunker, content):
+    return list(chunker.chunks(io.BytesIO(content)))
+
+
+def test_chunks_cover_the_content_within_size_bounds():
+    chunker = Chunker(256)
+    content = _random_bytes(50000)
+
+    chunks = _chunks(chunker, content)
+
+    assert [offset for offset, _, _ in chunks] == [sum(size for _, size, _ in chunks[:i]) for i in range(len(chunks))]
+    assert sum(size for _, size, _ in chunks) == len(content)
+    assert all(chunker.min_size <= size <= chunker.max_size for _, size, _ in chunks[:-1])
+
+
+def test_inserted_bytes_only_change_nearby_chunks():
+    chunker = Chunker(256)
+    content = _random_bytes(50000)
+
+    original = set(digest for _, _, digest in _chunks(chunker, content))
+    changed = set(digest for _, _, digest in _chunks(chunker, content[:20000] + b"inserted" + content[20000:]))
+
+    assert len(original - changed) <= 3
+
+
+def test_chunks_do_not_depend_on_the_read_size():
+    chunker = Chunker(256)
+    content = _random_bytes(20000)
+    expected = _chunks(chunker, content)
+
+    chunker.READ_SIZE = 100
+
+    assert _chunks(chunker, content) == expected
+
+
+def test_chunk_size_has_to_be_a_power_of_two():
+    with pytest.raises(ValueError):
+        Chunker(1000)
+
+
+@pytest.fixture
+def directory(tmp_path):
+    shared = _random_bytes(20000, 1)
+    (tmp_path / "backups").mkdir()
+    (tmp_path / "other").mkdir()
+    (tmp_path / "backups" / "monday.img").write_bytes(shared + _random_bytes(5000, 2))
+    (tmp_path / "backups" / "tuesday.img").write_bytes(shared + _random_bytes(10000, 3))
+    (tmp_path / "other" / "unrelated.bin").write_bytes(_random_bytes(8000, 4))
+    return tmp_path
+
+
+def test_files_are_ranked_by_shared_bytes(indexer, add_directory, directory):
+    chunk_index = ChunkIndex(indexer, 256)
+    add_directory(directory, index=chunk_index)
+
+    files = list(chunk_index.shared_files())
+
+    assert [path for path, _, _ in files] == [
+        str(directory / "backups" / "monday.img"), str(directory / "backups" / "tuesday.img")]
+    assert [total for _, total, _ in files] == [25000, 30000]
+    assert all(19000 < shared <= 20000 for _, _, shared in files)
+
+    directories = list(chunk_index.shared_directories())
+    assert [(path, total) for path, total, _ in directories] == [(str(directory / "backups") + "/", 55000)]
+
+
+def test_unchanged_files_are_not_chunked_again(mocker, indexer, add_directory, directory):
+    chunk_index = ChunkIndex(indexer, 256)
+    add_directory(directory, index=chunk_index)
+    store = mocker.spy(ChunkIndex, "_store_file")
+
+    results = add_directory(directory, incremental=True, index=ChunkIndex(indexer, 256))
+
+    assert set(status for _, status in results) == set([UNCHANGED])
+    assert store.called is False
+
+
+def test_chunks_of_removed_files_are_purged(indexer, add_directory, directory):
+    chunk_index = ChunkIndex(indexer, 256)
+    add_directory(directory, index=chunk_index)
+    indexer.connection.execute("DELETE FROM files WHERE name = 'monday.img'")
+
+    indexer.purge_orphans()
+
+    assert list(chunk_index.shared_files()) == []
+    assert indexer.connection.execute(
+        "SELECT COUNT(DISTINCT name) FROM file_chunks").fetchone()[0] == 2
+
+
+def test_chunk_size_of_an_index_can_not_change(indexer, add_directory, directory):
+    add_directory(directory, index=ChunkIndex(indexer, 256))
+
+    with pytest.raises(ValueError):
+        ChunkIndex(indexer, 512).build()
+    chunk_index = ChunkIndex(indexer)
+    chunk_index.build()
+    assert chunk_index.chunker.avg_size == 256
+
+
+def _fastcdc(path, min_size, avg_size, max_size, fat):
+    # stands in for the fastcdc package, with the chunk boundaries of the python chunker
+    Chunk = namedtuple("Chunk", "offset length data hash")
+    content = open(path, "rb").read()
+    for offset, size, _ in Chunker(avg_size).file_chunks(path):
+        yield Chunk(offset, size, content[offset:offset + size], "")
+
+
+def test_new_indexes_are_chunked_with_the_fastcdc_package(mocker, indexer, add_directory, directory):
+    native = mocker.patch("hashdex.chunks.fastcdc_cy", side_effect=_fastcdc)
+    chunk_index = ChunkIndex(indexer, 256)
+    add_directory(directory, index=chunk_index)
+
+    assert isinstance(chunk_index.chunker, NativeChunker)
+    assert indexer.get_meta('chunker') == FASTCDC
+    assert native.call_count == 3
+    assert [path for path, _, _ in chunk_index.shared_files()] == [
+        str(directory / "backups" / "monday.img"), str(directory / "backups" / "tuesday.img")]
+
+
+def test_indexes_keep_the_backend_they_were_chunked_with(mocker, indexer, add_directory, directory):
+    add_directory(directory, index=ChunkIndex(indexer, 256))
+    mocker.patch("hashdex.chunks.fastcdc_cy", side_effect=_fastcdc)
+
+    chunk_index = ChunkIndex(indexer)
+    chunk_index.build()
+
+    assert type(chunk_index.chunker) is Chunker
+
+
+def test_fastcdc_index_requires_the_fastcdc_package(mocker, indexer):
+    mocker.patch("hashdex.chunks.fastcdc_cy", side_effect=_fastcdc)
+    ChunkIndex(indexer, 256).build()
+    mocker.patch("hashdex.chunks.fastcdc_cy", None)
+
+    with pytest.raises(ValueError):
+        ChunkIndex(indexer).build()
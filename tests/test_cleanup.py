@@ -0,0 +1,48 @@
+import pytest
+from hashdex.cleanup import Cleaner
+
+
+@pytest.fixture
+def indexer(indexer, write_file, tmp_path):
+    files = [write_file(tmp_path / directory / name, directory.encode() * 10)
+             for directory in ("a", "b", "c") for name in ("x.txt", "y.txt")]
+    list(indexer.add_files(files))
+    return indexer
+
+
+def _count(indexer, table):
+    return indexer.connection.execute("SELECT COUNT(*) FROM {0}".format(table)).fetchone()[0]
+
+
+def _remove(tmp_path):
+    (tmp_path / "a" / "x.txt").unlink()
+    for name in ("x.txt", "y.txt"):
+        (tmp_path / "b" / name).unlink()
+    (tmp_path / "b").rmdir()
+    return [str(tmp_path / "a" / "x.txt"), str(tmp_path / "b" / "x.txt"), str(tmp_path / "b" / "y.txt")]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_missing_files_are_removed(indexer, tmp_path, jobs):
+    removed = _remove(tmp_path)
+
+    assert sorted(Cleaner(indexer, jobs, batch_size=1).clean()) == removed
+    assert sorted(file.full_path for file in indexer.get_files()) == [
+        str(tmp_path / "a" / "y.txt"), str(tmp_path / "c" / "x.txt"), str(tmp_path / "c" / "y.txt")]
+
+
+def test_orphans_are_purged(indexer, tmp_path):
+    _remove(tmp_path)
+    assert (_count(indexer, "hashes"), _count(indexer, "directories")) == (3, 3)
+
+    list(Cleaner(indexer).clean())
+
+    assert (_count(indexer, "hashes"), _count(indexer, "directories")) == (2, 2)
+
+
+def test_dry_run_keeps_the_index(indexer, tmp_path):
+    removed = _remove(tmp_path)
+
+    assert sorted(Cleaner(indexer, dry_run=True).clean()) == removed
+    assert _count(indexer, "files") == 6
+    assert _count(indexer, "hashes") == 3
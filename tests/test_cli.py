@@ -3,12 +3,19 @@
 
 """Tests for `hashdex` package."""
 
+import json
 import os
 import re
+import sqlite3
+
+import pytest
 
 from click.testing import CliRunner
+from hashdex.checkpoint import Checkpoint
 from hashdex.cli import cli
 from hashdex.files import File, DuplicateFileResult
+from hashdex.hashing import Hasher
+from hashdex.indexer import Indexer, create_connection
 
 
 def test_main_command_shows_help():
@@ -36,9 +43,194 @@ def test_adding_to_index():
         with open('./input/x.txt', 'w') as f:
             f.write("a"*10000)
 
-        result = runner.invoke(cli, ['add', './input', '--index', 'output/index.db'])
+        result = runner.invoke(cli, ['add', './input', '--index', 'output/index.db', '--cache', 'output/cache.db'])
+
+        assert 'Successfully Indexed 1 files' in result.output
+
+
+def test_incremental_add_reports_unchanged_files():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("output")
+        os.mkdir("input")
+        with open('./input/x.txt', 'w') as f:
+            f.write("a"*10000)
+
+        runner.invoke(cli, ['add', './input', '--index', 'output/index.db', '--cache', 'output/cache.db'])
+        result = runner.invoke(cli, ['add', '--incremental', './input', '--index', 'output/index.db',
+                                     '--cache', 'output/cache.db'])
+
+        assert '0 new, 0 changed, 1 unchanged files' in result.output
+
+
+def test_resumed_add_skips_completed_directories():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        for directory in ("done", "todo"):
+            os.makedirs(os.path.join("input", directory))
+            with open(os.path.join("input", directory, "x.txt"), 'w') as f:
+                f.write(directory * 1000)
+
+        indexer = Indexer(create_connection("index.db"), Hasher())
+        indexer.build_db()
+        Checkpoint(indexer.connection)
+        indexer.connection.execute(
+            "INSERT INTO checkpoint (path) VALUES (?)", (os.path.abspath(os.path.join("input", "done")), ))
+        indexer.connection.commit()
+
+        result = runner.invoke(cli, ['add', './input', '--index', 'index.db', '--no-cache', '--resume'])
 
+        assert 'Skipping 1 completely indexed directories' in result.output
         assert 'Successfully Indexed 1 files' in result.output
+        assert Checkpoint(create_connection("index.db")).completed_directories() == set()
+
+
+def test_add_reports_stats():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        for name in ("x.txt", "y.txt"):
+            with open(os.path.join("input", name), 'w') as f:
+                f.write("a" * 10000)
+
+        result = runner.invoke(cli, ['add', './input', '--index', 'index.db', '--no-cache', '--stats',
+                                     '--stats-json', 'stats.json'])
+        with open('stats.json') as f:
+            stats = json.load(f)
+
+    assert re.search(r"^scan +2 +20000 ", result.output, re.MULTILINE)
+    assert stats['stages']['read']['count'] == 2
+    assert stats['stages']['commit']['count'] == 2
+
+
+def test_similar_images(tmp_path):
+    pytest.importorskip("PIL")
+    from PIL import Image
+    runner = CliRunner()
+    (tmp_path / "photos").mkdir()
+    (tmp_path / "uploads").mkdir()
+    image = Image.linear_gradient('L').resize((300, 200))
+    image.save(str(tmp_path / "photos" / "a.png"))
+    image.resize((150, 100)).save(str(tmp_path / "photos" / "a-small.jpg"), quality=70)
+    image.rotate(90).save(str(tmp_path / "uploads" / "b.jpg"))
+    image.resize((600, 400)).save(str(tmp_path / "uploads" / "a-large.jpg"))
+    index = str(tmp_path / "index.db")
+
+    result = runner.invoke(cli, ['add', str(tmp_path / "photos"), '--index', index, '--no-cache', '--perceptual'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['duplicates', '--index', index, '--similar'])
+    assert "{0} (distance 0)".format(tmp_path / "photos" / "a-small.jpg") in result.output
+    assert "{0} (distance 0)".format(tmp_path / "photos" / "a.png") in result.output
+
+    result = runner.invoke(cli, ['check', str(tmp_path / "uploads"), '--index', index, '--no-cache', '--similar'])
+    assert "similar image found {0}".format(tmp_path / "uploads" / "a-large.jpg") in result.output
+    assert "b.jpg" not in result.output
+    assert "0 files of 2 files deleted" in result.output
+
+
+def test_shared_content_report(tmp_path):
+    runner = CliRunner()
+    (tmp_path / "input").mkdir()
+    shared = os.urandom(50000)
+    (tmp_path / "input" / "a.img").write_bytes(shared + os.urandom(1000))
+    (tmp_path / "input" / "b.img").write_bytes(os.urandom(1000) + shared)
+    index = str(tmp_path / "index.db")
+
+    result = runner.invoke(cli, ['add', str(tmp_path / "input"), '--index', index, '--no-cache', '--chunks',
+                                 '--chunk-size', '1024'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['shared', '--index', index])
+    lines = result.output.splitlines()
+    assert sorted(line.split()[-1] for line in lines[1:]) == [
+        str(tmp_path / "input" / "a.img"), str(tmp_path / "input" / "b.img")]
+
+    result = runner.invoke(cli, ['add', str(tmp_path / "input"), '--index', index, '--no-cache', '--chunks',
+                                 '--chunk-size', '2048'])
+    assert result.exit_code == 2
+
+
+def test_similar_images_need_pillow(mocker):
+    mocker.patch('hashdex.cli.IMAGES_AVAILABLE', False)
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ['duplicates', '--index', 'index.db', '--similar'])
+
+    assert result.exit_code == 2
+    assert "pip install hashdex[images]" in result.output
+
+
+def test_adding_to_index_in_parallel():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("output")
+        os.mkdir("input")
+        for name in ('x.txt', 'y.txt', 'z.txt'):
+            with open(os.path.join('input', name), 'w') as f:
+                f.write("a"*10000)
+
+        result = runner.invoke(cli, ['add', './input', '--index', 'output/index.db', '--cache', 'output/cache.db',
+                                     '--jobs', '2'])
+
+        assert 'Successfully Indexed 3 files' in result.output
+        assert '3 new, 0 changed, 0 unchanged files' in result.output
+
+
+def test_failed_add_closes_the_parallel_hasher_and_the_cache(mocker):
+    runner = CliRunner()
+    close_hasher = mocker.patch('hashdex.cli.ParallelHasher.close')
+    close_cache = mocker.patch('hashdex.cli.HashCache.close')
+    mocker.patch('hashdex.cli.Indexer.add_files', side_effect=RuntimeError("disk failure"))
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        with open(os.path.join('input', 'x.txt'), 'w') as f:
+            f.write("a"*10000)
+
+        result = runner.invoke(cli, ['add', './input', '--index', 'index.db', '--cache', 'cache.db', '--jobs', '2'])
+
+        assert isinstance(result.exception, RuntimeError)
+        close_hasher.assert_called_once_with()
+        close_cache.assert_called_once_with()
+
+
+def test_parallel_check_closes_the_hasher(mocker):
+    runner = CliRunner()
+    close_hasher = mocker.patch('hashdex.cli.ParallelHasher.close')
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        with open(os.path.join('input', 'x.txt'), 'w') as f:
+            f.write("a"*10000)
+
+        runner.invoke(cli, ['add', './input', '--index', 'index.db', '--no-cache'])
+        result = runner.invoke(cli, ['check', './input', '--index', 'index.db', '--no-cache', '--jobs', '2'])
+
+        assert result.exit_code == 0
+        close_hasher.assert_called_once_with()
+
+
+def test_adding_with_other_hash_strategy_fails():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("output")
+        os.mkdir("input")
+        with open('./input/x.txt', 'w') as f:
+            f.write("a"*10000)
+
+        runner.invoke(cli, ['add', './input', '--index', 'output/index.db', '--no-cache', '--strategy', 'full'])
+        result = runner.invoke(cli, ['add', './input', '--index', 'output/index.db', '--no-cache',
+                                     '--strategy', 'sampled'])
+
+        assert result.exit_code != 0
+        assert 'hashed with the full strategy' in result.output
 
 
 def test_duplicates(mocker):
@@ -50,6 +242,7 @@ def test_duplicates(mocker):
     r1.add_diff("z")
 
     i = mocker.MagicMock()
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
     i.get_duplicates.return_value = [r1]
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
@@ -70,6 +263,7 @@ def test_duplicates_with_non_equal_duplicates(mocker):
     r1.add_diff("x")
 
     i = mocker.MagicMock()
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
     i.get_duplicates.return_value = [r1]
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
@@ -82,10 +276,49 @@ def test_duplicates_with_non_equal_duplicates(mocker):
     assert 'NOT EQUAL' in result.output
 
 
+def test_duplicate_directories(tmp_path):
+    runner = CliRunner()
+    for copy in ("photos", "backup"):
+        (tmp_path / "input" / copy / "raw").mkdir(parents=True)
+        (tmp_path / "input" / copy / "raw" / "1.cr2").write_bytes(b"first photo")
+        (tmp_path / "input" / copy / "raw" / "2.cr2").write_bytes(b"second photo")
+    index = str(tmp_path / "index.db")
+
+    result = runner.invoke(cli, ['add', str(tmp_path / "input"), '--index', index, '--no-cache'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['duplicates', '--index', index, '--dirs'])
+    assert result.exit_code == 0
+    assert str(tmp_path / "input" / "photos") + "/" in result.output
+    assert str(tmp_path / "input" / "backup") + "/" in result.output
+    assert "1.cr2" not in result.output
+    assert "raw" not in result.output
+
+
+def test_dedupe(tmp_path):
+    runner = CliRunner()
+    (tmp_path / "input").mkdir()
+    for name in ("a", "b"):
+        (tmp_path / "input" / name).write_bytes(b"same content")
+    index = str(tmp_path / "index.db")
+
+    result = runner.invoke(cli, ['add', str(tmp_path / "input"), '--index', index, '--no-cache'])
+    assert result.exit_code == 0
+
+    result = runner.invoke(cli, ['dedupe', '--index', index])
+    assert result.exit_code == 0
+    assert "1 files linked" in result.output
+    assert os.path.samefile(str(tmp_path / "input" / "a"), str(tmp_path / "input" / "b"))
+
+    result = runner.invoke(cli, ['dedupe', '--index', index])
+    assert "0 files linked" in result.output
+
+
 def test_check_without_rm(mocker):
     f = File("./x.txt", 'x.txt')
     i = mocker.MagicMock()
-    i.fetch_indexed_file.return_value = f
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+    i.fetch_indexed_files.side_effect = lambda files: [(file, f) for file in files]
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
     mocked_indexer.return_value = i
@@ -98,7 +331,7 @@ def test_check_without_rm(mocker):
         with open('./input/x.txt', 'w') as df:
             df.write("a" * 10000)
 
-        result = runner.invoke(cli, ['check', './input', '--index', './index.db'])
+        result = runner.invoke(cli, ['check', './input', '--index', './index.db', '--no-cache'])
 
         assert os.path.exists('./input/x.txt') is True
         assert f.full_path in result.output
@@ -107,7 +340,8 @@ def test_check_without_rm(mocker):
 def test_check_with_rm(mocker):
     f = File("./x.txt", 'x.txt')
     i = mocker.MagicMock()
-    i.fetch_indexed_file.return_value = f
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+    i.fetch_indexed_files.side_effect = lambda files: [(file, f) for file in files]
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
     mocked_indexer.return_value = i
@@ -120,7 +354,7 @@ def test_check_with_rm(mocker):
         with open('./input/x.txt', 'w') as df:
             df.write("a" * 10000)
 
-        result = runner.invoke(cli, ['check', '--rm', '--index', './index.db', './input'])
+        result = runner.invoke(cli, ['check', '--rm', '--index', './index.db', '--no-cache', './input'])
 
         assert os.path.exists('./input/x.txt') is False
         assert f.full_path in result.output
@@ -129,7 +363,8 @@ def test_check_with_rm(mocker):
 def test_move_duplicate_files_on_check(mocker):
     f = File("./x.txt", 'x.txt')
     i = mocker.MagicMock()
-    i.fetch_indexed_file.return_value = f
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+    i.fetch_indexed_files.side_effect = lambda files: [(file, f) for file in files]
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
     mocked_indexer.return_value = i
@@ -142,29 +377,182 @@ def test_move_duplicate_files_on_check(mocker):
         with open('./input/x.txt', 'w') as df:
             df.write("a" * 10000)
 
-        result = runner.invoke(cli, ['check', '--mv', './output/', '--index', './index.db', './input'])
+        result = runner.invoke(cli, ['check', '--mv', './output/', '--index', './index.db', '--no-cache', './input'])
 
         assert os.path.exists('./input/x.txt') is False
         assert os.path.exists('./output/x.txt') is True
         assert f.full_path in result.output
 
 
-def test_cleanup_old_files(mocker):
+def test_check_does_not_remove_files_only_matching_the_sampled_hash(tmp_path):
+    # the sampled hash only reads the first 500KB of files of 1MB or more
+    head = b"h" * 600000
+    (tmp_path / "idx").mkdir()
+    (tmp_path / "up").mkdir()
+    (tmp_path / "idx" / "a").write_bytes(head + b"a" * 600000)
+    (tmp_path / "idx" / "b").write_bytes(head + b"b" * 600000)
+    (tmp_path / "up" / "b").write_bytes(head + b"c" * 600000)
+    index = str(tmp_path / "index.db")
+    runner = CliRunner()
+    runner.invoke(cli, ['add', str(tmp_path / "idx"), '--index', index, '--no-cache'])
+
+    result = runner.invoke(cli, ['check', '--rm', '--index', index, '--no-cache', str(tmp_path / "up")])
+
+    assert result.exit_code == 0
+    assert (tmp_path / "up" / "b").exists()
+    assert "0 files of 1 files deleted" in result.output
+
+
+def test_cleanup_old_files():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        for name in ('existing.txt', 'non-existing.txt'):
+            with open(os.path.join('input', name), 'w') as df:
+                df.write("a" * 10000)
+        runner.invoke(cli, ['add', './input', '--index', './index.db', '--no-cache'])
+        os.unlink(os.path.join('input', 'non-existing.txt'))
+        missing = os.path.abspath(os.path.join('input', 'non-existing.txt'))
+
+        result = runner.invoke(cli, ['cleanup', '--index', './index.db', '--dry-run'])
+        assert result.output == 'Missing {0}\n'.format(missing)
+
+        result = runner.invoke(cli, ['cleanup', '--index', './index.db'])
+        assert result.output == 'Deleted {0}\n'.format(missing)
+
+        result = runner.invoke(cli, ['cleanup', '--index', './index.db'])
+        assert result.output == ''
+
+
+def test_duplicates_with_filters(mocker):
     runner = CliRunner()
 
     i = mocker.MagicMock()
-    i.get_files.return_value = [
-        File("./existing.txt", "existing.txt"),
-        File("./non-existing.txt", "non-existing.txt")
-    ]
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+    i.get_duplicates.return_value = []
 
     mocked_indexer = mocker.patch('hashdex.cli.Indexer')
     mocked_indexer.return_value = i
 
     with runner.isolated_filesystem():
-        with open('./existing.txt', 'w') as df:
-            df.write("a" * 10000)
+        result = runner.invoke(cli, ['duplicates', '--index', './index.db', '--min-size', '10',
+                                     '--path', 'photos', '--sort', 'wasted'])
 
-        result = runner.invoke(cli, ['cleanup', '--index', './index.db'])
+    assert result.exit_code == 0
+    i.get_duplicates.assert_called_once_with(10, ('photos',), True)
+
+
+def test_duplicates_without_verification(mocker):
+    runner = CliRunner()
+
+    i = mocker.MagicMock()
+    i.get_hasher_settings.return_value = (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+    i.get_duplicates.return_value = []
 
-    assert 'Deleted ./non-existing.txt' in result.output
+    mocked_indexer = mocker.patch('hashdex.cli.Indexer')
+    mocked_indexer.return_value = i
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ['duplicates', '--index', './index.db', '--no-verify'])
+
+    assert result.exit_code == 0
+    assert i.verifier is None
+
+
+def test_cache_commands():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        for name in ('x.txt', 'y.txt'):
+            with open(os.path.join('input', name), 'w') as f:
+                f.write("a" * 10000)
+
+        runner.invoke(cli, ['add', './input', '--index', 'index.db', '--cache', 'cache.db'])
+        result = runner.invoke(cli, ['cache', 'stats', '--cache', 'cache.db'])
+        assert '2 cached hashes' in result.output
+
+        result = runner.invoke(cli, ['cache', 'prune', '--cache', 'cache.db', '--max-entries', '1'])
+        assert 'Removed 1 cached hashes' in result.output
+
+
+def test_read_only_index_has_to_exist():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ['duplicates', '--index', 'index.db', '--read-only'])
+
+        assert result.exit_code != 0
+        assert not os.path.exists('index.db')
+
+
+def test_read_only_duplicates():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        for name in ('x.txt', 'y.txt'):
+            with open(os.path.join('input', name), 'w') as f:
+                f.write("a" * 10000)
+
+        runner.invoke(cli, ['add', './input', '--index', 'index.db', '--no-cache', '--profile', 'tuned'])
+        result = runner.invoke(cli, ['duplicates', '--index', 'index.db', '--read-only', '--profile', 'tuned'])
+
+        assert result.exit_code == 0
+        assert 'x.txt' in result.output
+        assert 'y.txt' in result.output
+
+
+def _create_legacy_index(location, path):
+    connection = sqlite3.connect(location)
+    connection.execute("CREATE TABLE hashes (hash_id INTEGER PRIMARY KEY, sha1_hash TEXT, md5_hash TEXT)")
+    connection.execute("CREATE TABLE files (hash_id INTEGER, full_path TEXT, filename TEXT)")
+    connection.execute("INSERT INTO files VALUES (NULL, ?, ?)", (path, os.path.basename(path)))
+    connection.commit()
+    connection.close()
+
+
+def test_legacy_index_has_to_be_migrated():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        for name in ('x.txt', 'y.txt'):
+            with open(os.path.join('input', name), 'w') as f:
+                f.write("a" * 10000)
+        _create_legacy_index('index.db', os.path.abspath('./input/x.txt'))
+
+        result = runner.invoke(cli, ['duplicates', '--index', 'index.db'])
+        assert result.exit_code != 0
+        assert 'hashdex migrate' in result.output
+
+        result = runner.invoke(cli, ['migrate', '--index', 'index.db', '--vacuum'])
+        assert 'Migrated index to version 6' in result.output
+
+        result = runner.invoke(cli, ['check', './input', '--index', 'index.db', '--no-cache'])
+        assert '1 files of 2 files deleted' in result.output
+
+
+def test_relative_paths_of_a_legacy_index_need_a_base():
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        os.mkdir("input")
+        with open(os.path.join('input', 'x.txt'), 'w') as f:
+            f.write("a" * 10000)
+        _create_legacy_index('index.db', 'input/x.txt')
+
+        result = runner.invoke(cli, ['migrate', '--index', 'index.db'])
+        assert result.exit_code != 0
+        assert '--base' in result.output
+
+        result = runner.invoke(cli, ['migrate', '--index', 'index.db', '--base', '.'])
+        assert 'Migrated index to version 6' in result.output
+
+        result = runner.invoke(cli, ['add', 'input', '--index', 'index.db', '--no-cache', '--incremental'])
+        assert result.exit_code == 0
+        connection = sqlite3.connect('index.db')
+        paths = connection.execute("SELECT d.path || f.name FROM files f JOIN directories d USING (dir_id)").fetchall()
+        assert paths == [(os.path.abspath(os.path.join('input', 'x.txt')), )]
+        connection.close()
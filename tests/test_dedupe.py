@@ -0,0 +1,109 @@
+import errno
+import os
+import pytest
+from hashdex import dedupe
+from hashdex.dedupe import Deduplicator, REFLINK
+from hashdex.indexer import UNCHANGED
+from hashdex.verify import Verifier
+
+
+@pytest.fixture
+def copies(tmp_path):
+    for name in ("original", "copy1", "copy2"):
+        (tmp_path / name).write_bytes(b"content" * 100)
+    (tmp_path / "other").write_bytes(b"another" * 100)
+    return tmp_path
+
+
+def _dedupe(indexer, mode=dedupe.HARDLINK, dry_run=False):
+    return list(Deduplicator(indexer, mode, dry_run).dedupe(indexer.get_duplicates()))
+
+
+def test_duplicates_are_replaced_with_hardlinks(indexer, add_directory, copies):
+    add_directory(copies, incremental=True)
+
+    results = _dedupe(indexer)
+
+    assert [(os.path.basename(path), os.path.basename(original), error) for path, original, error in results] == [
+        ("copy2", "copy1", None), ("original", "copy1", None)]
+    inodes = set(os.stat(str(copies / name)).st_ino for name in ("original", "copy1", "copy2"))
+    assert len(inodes) == 1
+    assert (copies / "copy1").read_bytes() == b"content" * 100
+    # linked files are up to date in the index and no longer reported
+    assert set(status for _, status in add_directory(copies, incremental=True)) == set([UNCHANGED])
+    assert list(indexer.get_duplicates()) == []
+
+
+def test_hardlinks_are_compared_once(mocker, indexer, add_directory, copies):
+    os.link(str(copies / "original"), str(copies / "link"))
+    add_directory(copies, incremental=True)
+    split = mocker.spy(Verifier, "split")
+
+    [result] = indexer.get_duplicates()
+
+    assert len(split.call_args[0][1]) == 3
+    assert len(result.dupes) == 4
+    assert result.get_wasted_size() == 1400
+
+
+def test_dry_run_does_not_change_files(indexer, add_directory, copies):
+    add_directory(copies, incremental=True)
+
+    results = _dedupe(indexer, dry_run=True)
+
+    assert len(results) == 2
+    assert len(set(os.stat(str(copies / name)).st_ino for name in ("original", "copy1", "copy2"))) == 3
+
+
+def _rewrite(path, content):
+    # rewritten in place, keeping the size and the inode
+    mtime_ns = os.stat(str(path)).st_mtime_ns
+    with open(str(path), 'r+b') as f:
+        f.write(content)
+    os.utime(str(path), ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+
+
+@pytest.mark.parametrize("name", ["copy1", "copy2"])
+def test_files_rewritten_after_the_comparison_are_skipped(mocker, indexer, add_directory, copies, name):
+    add_directory(copies, incremental=True)
+    split = Verifier.split
+
+    def split_and_rewrite(verifier, paths):
+        groups = split(verifier, paths)
+        _rewrite(copies / name, b"changed" * 100)
+        return groups
+    mocker.patch.object(Verifier, "split", split_and_rewrite)
+
+    results = _dedupe(indexer)
+
+    errors = [error for _, _, error in results if error is not None]
+    assert errors and all(error.errno == errno.EAGAIN for error in errors)
+    assert (copies / name).read_bytes() == b"changed" * 100
+    assert os.stat(str(copies / name)).st_nlink == 1
+
+
+@pytest.mark.skipif(dedupe.fcntl is None, reason="reflinks need fcntl")
+def test_failed_reflinks_leave_the_duplicate(mocker, indexer, add_directory, copies):
+    mocker.patch("hashdex.dedupe.fcntl.ioctl", side_effect=OSError(95, "Operation not supported"))
+    add_directory(copies, incremental=True)
+
+    results = _dedupe(indexer, REFLINK)
+
+    assert [error.errno for _, _, error in results] == [95, 95]
+    assert sorted(os.listdir(str(copies))) == ["copy1", "copy2", "original", "other"]
+    assert (copies / "copy1").read_bytes() == b"content" * 100
+
+
+@pytest.mark.skipif(dedupe.fcntl is None, reason="reflinks need fcntl")
+def test_reflinks_keep_the_permissions_of_the_duplicate(mocker, indexer, add_directory, copies):
+    def clone(target, request, source):
+        os.write(target, os.pread(source, 1 << 20, 0))
+    mocker.patch("hashdex.dedupe.fcntl.ioctl", side_effect=clone)
+    os.chmod(str(copies / "copy1"), 0o600)
+    add_directory(copies, incremental=True)
+
+    _dedupe(indexer, REFLINK)
+
+    assert (copies / "copy1").read_bytes() == b"content" * 100
+    assert os.stat(str(copies / "copy1")).st_mode & 0o777 == 0o600
+    assert os.stat(str(copies / "copy1")).st_ino != os.stat(str(copies / "original")).st_ino
@@ -1,21 +1,83 @@
+import os
+import pytest
 from hashdex.files import DirectoryScanner, DuplicateFileResult
 
 
 class TestDirectoryScanner():
 
-    def test_scans_simple_dir(self, mocker):
-        mocked_walk = mocker.patch('os.walk')
-        mocked_walk.return_value = [('.', [], ['x.txt'])]
+    def test_scans_simple_dir(self, tmp_path):
+        (tmp_path / "x.txt").write_text(u"x")
 
-        files = DirectoryScanner('.').get_files()
+        files = DirectoryScanner(str(tmp_path)).get_files()
         assert files[0].filename == 'x.txt'
+        assert files[0].stat.st_size == 1
 
-    def test_recursive_dir(self, mocker):
-        mocked_walk = mocker.patch('os.walk')
-        mocked_walk.return_value = iter([('.', ["dir"], []), ('dir', [], ['x.txt'])])
+    def test_recursive_dir(self, tmp_path):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "dir" / "x.txt").write_text(u"x")
 
-        files = DirectoryScanner('.').get_files()
+        files = DirectoryScanner(str(tmp_path)).get_files()
         assert files[0].filename == 'x.txt'
+        assert files[0].full_path == str(tmp_path / "dir" / "x.txt")
+
+    def test_relative_dir_gives_absolute_paths(self, tmp_path, monkeypatch):
+        (tmp_path / "x.txt").write_text(u"x")
+        monkeypatch.chdir(str(tmp_path))
+
+        files = DirectoryScanner('.').get_files()
+        assert files[0].full_path == str(tmp_path / "x.txt")
+
+    def test_iter_files_is_lazy(self, tmp_path, mocker):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "x.txt").write_text(u"x")
+        (tmp_path / "dir" / "y.txt").write_text(u"y")
+        scandir = mocker.spy(os, "scandir")
+
+        files = DirectoryScanner(str(tmp_path)).iter_files()
+        next(files)
+        assert scandir.call_count == 1
+
+    def test_skips_symlinked_dirs(self, tmp_path):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "dir" / "x.txt").write_text(u"x")
+        os.symlink(str(tmp_path / "dir"), str(tmp_path / "link"))
+
+        assert [f.filename for f in DirectoryScanner(str(tmp_path)).get_files()] == ['x.txt']
+
+    def test_count_files(self, tmp_path):
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "x.txt").write_text(u"x")
+        (tmp_path / "dir" / "y.txt").write_text(u"y")
+
+        assert DirectoryScanner(str(tmp_path)).count_files() == 2
+        assert DirectoryScanner(str(tmp_path / "x.txt")).count_files() == 1
+
+    def test_parallel_scan(self, tmp_path):
+        expected = set()
+        for i in range(5):
+            directory = tmp_path / "dir{0}".format(i) / "sub"
+            directory.mkdir(parents=True)
+            for name in ("x.txt", "y.txt"):
+                (directory / name).write_text(u"x")
+                expected.add(str(directory / name))
+
+        scanner = DirectoryScanner(str(tmp_path), jobs=3)
+        files = scanner.get_files()
+
+        assert set(f.full_path for f in files) == expected
+        assert all(f.stat is not None for f in files)
+        assert scanner.count_files() == 10
+
+    @pytest.mark.parametrize("jobs", [1, 3])
+    def test_skipped_directories(self, tmp_path, jobs):
+        (tmp_path / "dir" / "sub").mkdir(parents=True)
+        (tmp_path / "x.txt").write_text(u"x")
+        (tmp_path / "dir" / "y.txt").write_text(u"y")
+        (tmp_path / "dir" / "sub" / "z.txt").write_text(u"z")
+
+        scanner = DirectoryScanner(str(tmp_path), jobs, skip_directories=set([str(tmp_path / "dir")]))
+        assert sorted(f.filename for f in scanner.get_files()) == ['x.txt', 'z.txt']
+        assert scanner.count_files() == 2
 
     def test_path_is_file(self):
         files = DirectoryScanner(__file__).get_files()
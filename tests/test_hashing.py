@@ -0,0 +1,131 @@
+import hashlib
+import pickle
+import pytest
+from hashdex.files import File
+from hashdex.hashing import Hasher, ParallelHasher
+from hashdex.indexer import Indexer, create_connection
+
+
+def _create_files(tmp_path, count):
+    files = []
+    for i in range(count):
+        path = tmp_path / "{0}.txt".format(i)
+        path.write_bytes(str(i % 3).encode() * 100)
+        files.append(File(str(path), path.name))
+    return files
+
+
+@pytest.mark.parametrize("backend", ["threads", "processes"])
+def test_parallel_hashes_equal_serial_hashes(tmp_path, backend):
+    files = _create_files(tmp_path, 10)
+
+    expected = dict(Hasher().hash_files(files))
+    hasher = ParallelHasher(Hasher(), jobs=3, backend=backend)
+    result = dict(hasher.hash_files(files))
+    hasher.close()
+
+    assert result == expected
+
+
+def test_files_not_needing_a_hash_are_passed_through(tmp_path):
+    files = _create_files(tmp_path, 6)
+    hasher = ParallelHasher(Hasher(), jobs=2)
+
+    results = list(hasher.hash_files(files, lambda f: f.filename != "1.txt"))
+
+    assert len(results) == 6
+    assert [hashes for file, hashes in results if file.filename == "1.txt"] == [None]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        ParallelHasher(Hasher(), backend="gpu")
+
+
+def test_parallel_indexing_finds_duplicates(tmp_path):
+    indexer = Indexer(create_connection(":memory:"), ParallelHasher(Hasher(), jobs=4))
+    indexer.build_db()
+
+    list(indexer.add_files(_create_files(tmp_path, 12)))
+
+    assert indexer.get_index_count() == 12
+    assert sorted(len(result.get_files()) for result in indexer.get_duplicates()) == [4, 4, 4]
+
+
+def _hash_contents(tmp_path, hasher, *contents):
+    hashes = []
+    for i, content in enumerate(contents):
+        path = tmp_path / "file{0}".format(i)
+        path.write_bytes(content)
+        hashes.append(hasher.get_hashes(File(str(path), path.name)))
+    return hashes
+
+
+def test_sampled_strategy_ignores_the_end_of_big_files(tmp_path):
+    hasher = Hasher(Hasher.SAMPLED)
+    hasher.BYTE_COUNT = 6
+
+    first, second = _hash_contents(tmp_path, hasher, b"abcdefgh", b"abcdefgX")
+    assert first == second
+
+
+def test_head_middle_tail_strategy_samples_the_end_of_big_files(tmp_path):
+    hasher = Hasher(Hasher.HEAD_MIDDLE_TAIL)
+    hasher.BYTE_COUNT = 6
+
+    first, second, third = _hash_contents(tmp_path, hasher, b"abcdefghij", b"abcdefghiX", b"abXdefghij")
+    assert first != second
+    assert first == third
+
+
+def test_full_strategy_hashes_all_content(tmp_path):
+    hasher = Hasher(Hasher.FULL)
+    hasher.CHUNK_SIZE = 4
+
+    first, second = _hash_contents(tmp_path, hasher, b"abcdeXghij", b"abcdefghij")
+    assert first != second
+    assert second == (hashlib.sha1(b"abcdefghij").hexdigest(), hashlib.md5(b"abcdefghij").hexdigest())
+
+
+def test_full_strategy_with_mmap(tmp_path):
+    mapped = Hasher(Hasher.FULL, use_mmap=True)
+    chunked = Hasher(Hasher.FULL)
+
+    content = b"abcdefghij" * 1000
+    assert _hash_contents(tmp_path, mapped, content, b"") == _hash_contents(tmp_path, chunked, content, b"")
+
+
+def test_hasher_reuses_its_buffer(tmp_path):
+    hasher = Hasher(Hasher.FULL)
+    _hash_contents(tmp_path, hasher, b"abc")
+    buffer = hasher._get_buffer()
+    _hash_contents(tmp_path, hasher, b"def")
+
+    assert hasher._get_buffer() is buffer
+
+
+def test_hasher_can_be_pickled():
+    hasher = pickle.loads(pickle.dumps(Hasher(Hasher.FULL, use_mmap=True)))
+    assert (hasher.strategy, hasher.use_mmap) == (Hasher.FULL, True)
+
+
+def test_single_digest_algorithm(tmp_path):
+    [hashes] = _hash_contents(tmp_path, Hasher(Hasher.FULL, 'blake2b'), b"abc")
+    assert hashes == (hashlib.blake2b(b"abc", digest_size=20).hexdigest(), '')
+
+
+def test_unknown_strategy_and_algorithm():
+    with pytest.raises(ValueError):
+        Hasher('everything')
+    with pytest.raises(ValueError):
+        Hasher(Hasher.FULL, 'crc32')
+
+
+def test_index_records_hash_settings():
+    indexer = Indexer(create_connection(":memory:"), Hasher(Hasher.FULL, 'blake2b'))
+    indexer.build_db()
+    assert indexer.get_hasher_settings() == (Hasher.FULL, 'blake2b')
+
+    indexer.hasher = Hasher()
+    with pytest.raises(ValueError):
+        indexer.check_hasher()
@@ -1,15 +1,22 @@
 import sqlite3
+import pytest
 import six
 import os
+from collections import Counter
 from tempfile import gettempdir
 from hashlib import sha1, md5
-from hashdex.files import File, DuplicateFileResult
-from hashdex.indexer import Indexer, Hasher, create_connection
+from hashdex.files import File, DuplicateFileResult, DirectoryScanner
+from hashdex.hashing import ParallelHasher
+from hashdex.indexer import Indexer, Hasher, create_connection, NEW, CHANGED, UNCHANGED
 
 
 class DummyStatResult(object):
-    def __init__(self, st_size):
+    def __init__(self, st_size, st_mtime_ns=0, st_ino=0, st_dev=0, st_nlink=1):
         self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ino = st_ino
+        self.st_dev = st_dev
+        self.st_nlink = st_nlink
 
 
 def test_create_connection():
@@ -27,87 +34,128 @@ def test_create_path_for_connection(mocker):
     assert create_connection(connection) == "dummy return value"
 
 
-class TestIndexer:
+def test_tuned_connection_profile(tmp_path):
+    connection = create_connection(str(tmp_path / "index.db"), "tuned")
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert connection.execute("PRAGMA synchronous").fetchone()[0] == 1
 
-    def test_indexer_can_add_file(self, mocker):
-        connection = mocker.Mock()
 
-        c1 = mocker.Mock()
-        connection.execute.return_value = c1
-        c1.fetchone.return_value = (1,)
+def test_read_only_connection(tmp_path):
+    create_connection(str(tmp_path / "index.db"), "tuned").execute("CREATE TABLE x ( a INTEGER )")
 
-        cursor = mocker.MagicMock()
-        connection.cursor.return_value = cursor
+    connection = create_connection(str(tmp_path / "index.db"), "tuned", read_only=True)
+    with pytest.raises(sqlite3.OperationalError):
+        connection.execute("INSERT INTO x (a) VALUES (1)")
 
-        hasher = mocker.Mock()
-        hasher.get_hashes.return_value = ("hash1", "hash2")
 
-        indexer = Indexer(connection, hasher)
-        f = File('~/test.txt', 'test.txt')
+class TestIndexer:
 
-        indexer.add_file(f)
+    def test_indexer_can_add_file(self, mocker, tmp_path):
+        connection = create_connection(":memory:")
 
-        cursor.execute.assert_has_calls([
-            mocker.call("INSERT OR IGNORE INTO hashes (sha1_hash, md5_hash) VALUES (?,?)", ("hash1", "hash2")),
-            mocker.call("INSERT OR IGNORE INTO files (hash_id, full_path, filename) VALUES (?,?,?)",
-                        (1, '~/test.txt', 'test.txt')),
-        ])
+        hasher = Hasher()
+        mocker.patch.object(hasher, "get_hashes", return_value=("aa11", "bb22"))
 
-        assert connection.commit.called is True
+        indexer = Indexer(connection, hasher)
+        indexer.build_db()
+        indexer.add_file(File(str(tmp_path / "other.txt"), "other.txt", DummyStatResult(10)))
+        indexer.add_file(File(str(tmp_path / "test.txt"), "test.txt", DummyStatResult(10)))
+
+        assert connection.execute("""
+            SELECT d.path, f.name, h.digest, f.size, f.mtime_ns, f.inode, f.device
+            FROM files f
+            JOIN directories d ON d.dir_id = f.dir_id
+            JOIN hashes h ON h.hash_id = f.hash_id
+            ORDER BY f.name
+        """).fetchall() == [
+            (os.path.join(str(tmp_path), ""), name, b"\xaa\x11\xbb\x22", 10, 0, 0, 0)
+            for name in ("other.txt", "test.txt")
+        ]
 
     def test_logging_of_db_exception_on_file_add(self, mocker):
         connection = mocker.Mock()
-        connection.execute.return_value = mocker.Mock()
+        connection.execute.return_value.fetchone.return_value = None
 
         cursor = mocker.MagicMock()
-        cursor.execute.side_effect = sqlite3.Error()
+        cursor.executemany.side_effect = sqlite3.Error()
         connection.cursor.return_value = cursor
 
-        hasher = mocker.Mock()
-        hasher.get_hashes.return_value = ("hash1", "hash2")
+        hasher = Hasher()
+        mocker.patch.object(hasher, "get_hashes", return_value=("hash1", "hash2"))
 
         indexer = Indexer(connection, hasher)
-        f = File('~/test.txt', 'test.txt')
-
-        indexer.add_file(f)
+        f = File('~/test.txt', 'test.txt', DummyStatResult(10))
 
+        assert indexer.add_file(f) is None
         assert connection.rollback.called is True
 
-    def test_in_index(self, mocker):
-        connection = mocker.Mock()
-        connection.execute.return_value.fetchone.return_value = ("x",)
+    def test_add_files_commits_once_per_batch(self, mocker, tmp_path):
+        connection = create_connection(":memory:")
+        indexer = Indexer(connection, Hasher())
+        indexer.build_db()
+        commit = mocker.spy(indexer, "_flush")
 
-        hasher = mocker.Mock()
-        hasher.get_hashes.return_value = ("hash1", "hash2")
+        files = []
+        for i in range(10):
+            path = tmp_path / "{0}.txt".format(i)
+            path.write_bytes(str(i % 2).encode() * 10)
+            files.append(File(str(path), path.name))
 
-        f = File("x", "y")
-        indexer = Indexer(connection, hasher)
+        results = list(indexer.add_files(files, batch_size=4))
 
-        assert indexer.in_index(f) is True
+        assert [status for _, status in results] == [NEW] * 10
+        assert commit.call_count == 3
+        assert connection.execute("SELECT COUNT(*) FROM files WHERE hash_id IS NULL").fetchone()[0] == 0
+        assert sorted(len(result.get_files()) for result in indexer.get_duplicates()) == [5, 5]
 
-    def test_fetch_indexed_file(self, mocker):
-        connection = mocker.MagicMock()
-        connection.cursor.return_value.execute.return_value.fetchone.return_value = ("x", "y")
+    def _indexed(self, tmp_path, content):
+        indexer = Indexer(create_connection(":memory:"), Hasher())
+        indexer.build_db()
 
-        hasher = mocker.Mock()
-        hasher.get_hashes.return_value = ("hash1", "hash2")
+        path = tmp_path / "indexed.txt"
+        path.write_bytes(content)
+        indexer.add_file(File(str(path), path.name))
 
-        f = File("x", "y")
-        indexer = Indexer(connection, hasher)
+        return indexer
 
-        assert indexer.fetch_indexed_file(f).filename == f.filename
+    def test_in_index(self, tmp_path):
+        indexer = self._indexed(tmp_path, b"content")
 
-    def test_fetch_non_existing_file(self, mocker):
-        connection = mocker.MagicMock()
-        connection.cursor.return_value.execute.return_value.fetchone.return_value = None
+        path = tmp_path / "x"
+        path.write_bytes(b"content")
 
-        hasher = mocker.Mock()
-        hasher.get_hashes.return_value = ("hash1", "hash2")
+        assert indexer.in_index(File(str(path), "y")) is True
 
-        f = File("x", "y")
-        indexer = Indexer(connection, hasher)
+    def test_fetch_indexed_file(self, tmp_path):
+        indexer = self._indexed(tmp_path, b"content")
+
+        path = tmp_path / "x"
+        path.write_bytes(b"content")
+
+        assert indexer.fetch_indexed_file(File(str(path), "y")).filename == "indexed.txt"
+
+    def test_fetch_non_existing_file(self, tmp_path):
+        indexer = self._indexed(tmp_path, b"content")
+
+        path = tmp_path / "x"
+        path.write_bytes(b"CONTENT")
+
+        assert indexer.fetch_indexed_file(File(str(path), "y")) is None
+
+    def test_fetch_indexed_files_in_batches(self, mocker, tmp_path):
+        indexer = self._indexed(tmp_path, b"content")
+        find_originals = mocker.spy(indexer, "_find_originals")
+
+        files = []
+        for i, content in enumerate([b"content", b"CONTENT", b"other", b"content"]):
+            path = tmp_path / "check{0}".format(i)
+            path.write_bytes(content)
+            files.append(File(str(path), path.name))
 
-        assert indexer.fetch_indexed_file(f) is None
+        results = dict((file.filename, original) for file, original in indexer.fetch_indexed_files(files, 3))
+
+        assert [name for name in sorted(results) if results[name] is not None] == ["check0", "check3"]
+        assert find_originals.call_count == 2
 
     def test_get_index_count(self, mocker):
         connection = mocker.MagicMock()
@@ -121,9 +169,11 @@ class TestIndexer:
         connection\
             .cursor.return_value \
             .execute.return_value \
-            .fetchall.return_value = [("path1|path2",), (("path3|path4|path5",))]
+            .__iter__.return_value = iter([
+                (1, "path1", 10, None), (1, "path2", 10, None), (2, "path3", 5, None), (2, "path4", 5, None),
+                (2, "path5", 5, None)])
 
-        mocker.patch("filecmp.cmp").return_value = True
+        mocker.patch("hashdex.verify.Verifier.split").side_effect = lambda paths: [paths]
 
         r1 = DuplicateFileResult()
         r1.add_duplicate("path1")
@@ -142,9 +192,12 @@ class TestIndexer:
         connection \
             .cursor.return_value \
             .execute.return_value \
-            .fetchall.return_value = [("path1|path2",), (("path3|path4|path5",))]
+            .__iter__.return_value = iter([
+                (1, "path1", 10, None), (1, "path2", 10, None), (2, "path3", 5, None), (2, "path4", 5, None),
+                (2, "path5", 5, None)])
 
-        mocker.patch("filecmp.cmp").side_effect = [False, True, True, True]
+        mocker.patch("hashdex.verify.Verifier.split").side_effect = [
+            [["path1"], ["path2"]], [["path3", "path4", "path5"]]]
 
         r1 = DuplicateFileResult()
         r1.add_duplicate("path1")
@@ -163,19 +216,19 @@ class TestIndexer:
 
         indexer = Indexer(connection, mocker.Mock())
         indexer.build_db()
-        assert connection.execute.call_count == 4
+        assert connection.execute.call_count == 10
 
     def test_db_schema_after_build(self, mocker):
         connection = create_connection(":memory:")
 
-        indexer = Indexer(connection, mocker.Mock())
+        indexer = Indexer(connection, Hasher())
         indexer.build_db()
 
         tables = map(
             lambda x: x[0],
             connection.execute("SELECT tbl_name FROM sqlite_master WHERE type='table'").fetchall())
 
-        assert set(tables).issubset(["hashes", "files", "sqlite_sequence"])
+        assert set(tables) == set(["hashes", "directories", "files", "meta"])
 
     def test_get_files(self, mocker):
         connection = mocker.MagicMock()
@@ -188,7 +241,7 @@ class TestIndexer:
             ]
 
         indexer = Indexer(connection, mocker.Mock())
-        assert list(indexer.get_files()) == [File("/full/path.log", "path.log"), ("/full/path2.log", "path2.log")]
+        assert list(indexer.get_files()) == [File("/full/path.log", "path.log"), File("/full/path2.log", "path2.log")]
 
     def test_delete_file_from_index(self, mocker):
         connection = mocker.MagicMock()
@@ -206,6 +259,97 @@ class TestIndexer:
         assert indexer.delete(File("/full/path.log", "path.log")) is False
 
 
+class TestSizeFirstIndexing:
+    def test_file_with_unique_size_is_not_hashed(self, mocker, write_file, tmp_path):
+        hasher = Hasher()
+        get_hashes = mocker.spy(hasher, "get_hashes")
+        indexer = Indexer(create_connection(":memory:"), hasher)
+        indexer.build_db()
+
+        indexer.add_file(write_file(tmp_path / "a.txt", b"a" * 10))
+        indexer.add_file(write_file(tmp_path / "b.txt", b"b" * 20))
+
+        assert get_hashes.called is False
+        assert indexer.get_index_count() == 2
+
+    def test_files_sharing_a_size_are_hashed(self, indexer, write_file, tmp_path):
+        indexer.add_file(write_file(tmp_path / "a.txt", b"a" * 10))
+        indexer.add_file(write_file(tmp_path / "b.txt", b"a" * 10))
+
+        rows = indexer.connection.execute("SELECT hash_id FROM files").fetchall()
+        assert [row[0] is not None for row in rows] == [True, True]
+        assert len(list(indexer.get_duplicates())) == 1
+
+    def test_check_does_not_read_files_without_size_match(self, mocker, write_file, tmp_path):
+        hasher = Hasher()
+        get_hashes = mocker.spy(hasher, "get_hashes")
+        indexer = Indexer(create_connection(":memory:"), hasher)
+        indexer.build_db()
+        indexer.add_file(write_file(tmp_path / "a.txt", b"a" * 10))
+
+        assert indexer.fetch_indexed_file(write_file(tmp_path / "b.txt", b"b" * 20)) is None
+        assert get_hashes.called is False
+
+    def test_check_hashes_indexed_file_on_size_match(self, indexer, write_file, tmp_path):
+        indexed = write_file(tmp_path / "a.txt", b"a" * 10)
+        indexer.add_file(indexed)
+
+        assert indexer.fetch_indexed_file(write_file(tmp_path / "b.txt", b"a" * 10)) == indexed
+        assert indexer.fetch_indexed_file(write_file(tmp_path / "c.txt", b"c" * 10)) is None
+
+    def test_check_compares_the_content_of_sampled_matches(self, indexer, write_file, tmp_path):
+        # the sampled hash only reads the first 500KB of files of 1MB or more
+        head = b"h" * 600000
+        indexed = write_file(tmp_path / "index" / "a", head + b"a" * 600000)
+        copy = write_file(tmp_path / "index" / "b", head + b"b" * 600000)
+        list(indexer.add_files([indexed, copy]))
+
+        checked = [write_file(tmp_path / "up" / name, head + name.encode() * 600000) for name in ("b", "c")]
+
+        assert [original for _, original in indexer.fetch_indexed_files(checked)] == [copy, None]
+
+    def test_read_only_check_does_not_store_hashes(self, write_file, tmp_path):
+        location = str(tmp_path / "index.db")
+        indexer = Indexer(create_connection(location), Hasher())
+        indexer.build_db()
+        indexed = write_file(tmp_path / "a.txt", b"a" * 10)
+        indexer.add_file(indexed)
+
+        indexer = Indexer(create_connection(location, read_only=True), Hasher())
+        indexer.read_only = True
+        checked = [write_file(tmp_path / "{0}.txt".format(name), b"a" * 10) for name in "bc"]
+
+        assert [original for _, original in indexer.fetch_indexed_files(checked, batch_size=1)] == [indexed, indexed]
+        assert indexer.connection.execute("SELECT COUNT(*) FROM files WHERE hash_id IS NULL").fetchone()[0] == 1
+
+    def test_incremental_add_skips_unchanged_files(self, mocker, indexer, write_file, tmp_path):
+        first = write_file(tmp_path / "a.txt", b"a" * 10)
+        second = write_file(tmp_path / "b.txt", b"a" * 10)
+
+        assert [indexer.add_file(first), indexer.add_file(second)] == [NEW, NEW]
+
+        get_hashes = mocker.spy(indexer.hasher, "get_hashes")
+        assert indexer.add_file(first, incremental=True) == UNCHANGED
+        assert get_hashes.called is False
+
+        (tmp_path / "a.txt").write_bytes(b"b" * 10)
+        os.utime(first.full_path, ns=(0, 0))
+        assert indexer.add_file(first, incremental=True) == CHANGED
+        assert get_hashes.call_count == 1
+        assert list(indexer.get_duplicates()) == []
+
+
+def mock_readinto(*contents):
+    contents = list(contents)
+
+    def readinto(view):
+        content = contents.pop(0) if contents else b""
+        view[:len(content)] = content
+        return len(content)
+
+    return readinto
+
+
 class TestHasher:
     def test_hasher_hashes_file_content(self, mocker):
         if six.PY3:
@@ -221,7 +365,7 @@ class TestHasher:
         mocked_stat.return_value = DummyStatResult(Hasher.BYTE_COUNT - 1)
 
         file_mock.__enter__.return_value = file_mock
-        file_mock.read.return_value = b"content"
+        file_mock.readinto.side_effect = mock_readinto(b"content")
 
         f = File('~/test.txt', 'test.txt')
         hasher = Hasher()
@@ -247,9 +391,125 @@ class TestHasher:
 
         # mock a file with "abcdefg" as content
         file_mock.__enter__.return_value = file_mock
-        file_mock.read.side_effect = [b"abc", b"efg"]
+        file_mock.readinto.side_effect = mock_readinto(b"abc", b"efg")
 
         f = File('~/test.txt', 'test.txt')
         hashes = hasher.get_hashes(f)
 
         assert hashes == (sha1(b"abcefg").hexdigest(), md5(b"abcefg").hexdigest())
+
+
+class TestDuplicates:
+    @pytest.fixture
+    def indexer(self, indexer, write_file, tmp_path):
+        for directory, name, content in [("a", "small1", b"x"), ("b", "small2", b"x"),
+                                         ("a", "big1", b"y" * 100), ("b", "big2", b"y" * 100),
+                                         ("b", "big|3", b"y" * 100)]:
+            indexer.add_file(write_file(tmp_path / directory / name, content))
+        return indexer
+
+    def test_paths_containing_a_pipe(self, indexer):
+        groups = [sorted(os.path.basename(path) for path in result.get_files())
+                  for result in indexer.get_duplicates()]
+        assert sorted(groups) == [["big1", "big2", "big|3"], ["small1", "small2"]]
+
+    def test_min_size(self, indexer):
+        [result] = indexer.get_duplicates(min_size=2)
+        assert len(result.get_files()) == 3
+
+    def test_paths(self, indexer, tmp_path):
+        [result] = indexer.get_duplicates(paths=[str(tmp_path / "b")])
+        assert sorted(os.path.basename(path) for path in result.get_files()) == ["big2", "big|3"]
+
+    def test_order_by_wasted(self, indexer):
+        assert [result.get_wasted_size() for result in indexer.get_duplicates(order_by_wasted=True)] == [200, 1]
+
+    def test_verification_splits_groups(self, indexer, tmp_path):
+        (tmp_path / "b" / "big2").write_bytes(b"z" * 100)
+        (tmp_path / "b" / "big|3").write_bytes(b"z" * 100)
+
+        [result] = indexer.get_duplicates(min_size=2)
+        assert [os.path.basename(path) for path in result.dupes] == ["big2", "big|3"]
+        assert [os.path.basename(path) for path in result.diffs] == ["big1"]
+
+    def test_verification_can_be_disabled(self, indexer, tmp_path):
+        (tmp_path / "a" / "big1").write_bytes(b"z" * 100)
+        indexer.verifier = None
+
+        [result] = indexer.get_duplicates(min_size=2)
+        assert result.is_equal()
+
+
+class TestHardlinks:
+    @pytest.fixture
+    def snapshots(self, tmp_path):
+        for snapshot in ("daily.0", "daily.1", "daily.2"):
+            (tmp_path / snapshot).mkdir()
+        (tmp_path / "daily.0" / "photo.jpg").write_bytes(b"p" * 100)
+        (tmp_path / "daily.0" / "copy.jpg").write_bytes(b"p" * 100)
+        for snapshot in ("daily.1", "daily.2"):
+            os.link(str(tmp_path / "daily.0" / "photo.jpg"), str(tmp_path / snapshot / "photo.jpg"))
+        return tmp_path
+
+    def _hashed_paths(self, indexer):
+        return sorted(row[0] for row in indexer.connection.execute("""
+            SELECT d.path || f.name FROM files f JOIN directories d ON d.dir_id = f.dir_id WHERE f.hash_id IS NOT NULL
+        """))
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_every_inode_is_hashed_once(self, mocker, snapshots, jobs):
+        hasher = Hasher()
+        hash_content = mocker.spy(hasher, "_hash_content")
+        indexer = Indexer(create_connection(":memory:"), ParallelHasher(hasher, jobs) if jobs > 1 else hasher)
+        indexer.build_db()
+
+        list(indexer.add_files(DirectoryScanner(str(snapshots)).iter_files(), batch_size=2))
+
+        assert sorted(os.path.basename(call[0][0].full_path) for call in hash_content.call_args_list) == [
+            "copy.jpg", "photo.jpg"]
+        assert len(self._hashed_paths(indexer)) == 4
+        [result] = indexer.get_duplicates()
+        assert len(result.dupes) == 4 and result.copies == 2
+
+    def test_hardlinks_stored_before_the_path_reading_their_inode_are_not_read(self, mocker, indexer, snapshots):
+        # the pipeline can store a hardlink before the path through which its inode is being read
+        statuses, sizes, links = {}, Counter(), {}
+        copy, photo, link = [File(str(snapshots / path), os.path.basename(path), os.stat(str(snapshots / path)))
+                             for path in ("daily.0/copy.jpg", "daily.0/photo.jpg", "daily.1/photo.jpg")]
+        assert [indexer._needs_hash(file, False, statuses, sizes, links) for file in (copy, photo, link)] == [
+            False, True, False]
+        hashes = indexer.hasher.get_hashes(photo)
+        hash_content = mocker.spy(indexer.hasher, "_hash_content")
+
+        for file, file_hashes in [(link, None), (copy, None), (photo, hashes)]:
+            indexer._store_hashed([(file, file_hashes)], False, statuses, sizes, None, links)
+
+        assert [call[0][0].full_path for call in hash_content.call_args_list] == [copy.full_path]
+        assert self._hashed_paths(indexer) == sorted(file.full_path for file in (copy, photo, link))
+
+    def test_new_hardlinks_of_indexed_files_are_not_read(self, mocker, snapshots):
+        indexer = Indexer(create_connection(":memory:"), Hasher())
+        indexer.build_db()
+        list(indexer.add_files(DirectoryScanner(str(snapshots)).iter_files()))
+        os.mkdir(str(snapshots / "daily.3"))
+        os.link(str(snapshots / "daily.0" / "photo.jpg"), str(snapshots / "daily.3" / "photo.jpg"))
+        hash_content = mocker.spy(indexer.hasher, "_hash_content")
+
+        list(indexer.add_files(DirectoryScanner(str(snapshots / "daily.3")).iter_files()))
+
+        assert hash_content.called is False
+        assert str(snapshots / "daily.3" / "photo.jpg") in self._hashed_paths(indexer)
+
+    def test_unhashed_hardlinks_are_hashed_once_when_their_size_matches(self, mocker, snapshots):
+        indexer = Indexer(create_connection(":memory:"), Hasher())
+        indexer.build_db()
+        os.unlink(str(snapshots / "daily.0" / "copy.jpg"))
+        list(indexer.add_files(DirectoryScanner(str(snapshots)).iter_files()))
+        assert self._hashed_paths(indexer) == []
+        (snapshots / "copy.jpg").write_bytes(b"p" * 100)
+        hash_content = mocker.spy(indexer.hasher, "_hash_content")
+
+        list(indexer.add_files(DirectoryScanner(str(snapshots / "copy.jpg")).iter_files()))
+
+        assert hash_content.call_count == 2
+        assert len(self._hashed_paths(indexer)) == 4
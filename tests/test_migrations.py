@@ -0,0 +1,182 @@
+import pytest
+from hashdex.files import File
+from hashdex.hashing import Hasher
+from hashdex.indexer import Indexer, create_connection, SCHEMA_VERSION
+from hashdex.migrations import migrate
+from hashdex.perceptual import BLOCK_COLUMNS, split_blocks, _to_signed, _to_unsigned
+from hashdex.trees import TreeIndex
+
+
+def _legacy_index(tmp_path, count):
+    connection = create_connection(":memory:")
+    connection.execute("CREATE TABLE hashes (hash_id INTEGER PRIMARY KEY, sha1_hash TEXT, md5_hash TEXT)")
+    connection.execute("CREATE UNIQUE INDEX idx_hashes ON hashes ( sha1_hash , md5_hash )")
+    connection.execute("CREATE TABLE files (hash_id INTEGER, full_path TEXT, filename TEXT)")
+    connection.execute("CREATE UNIQUE INDEX idx_paths ON files ( full_path )")
+    connection.execute("INSERT INTO hashes VALUES (1, 'aa', 'bb')")
+
+    files = []
+    for i in range(count):
+        path = tmp_path / "{0}.txt".format(i)
+        path.write_bytes(b"a" * 10)
+        files.append(File(str(path), path.name))
+    files.append(File(str(tmp_path / "missing.txt"), "missing.txt"))
+    connection.executemany("INSERT INTO files VALUES (1, ?, ?)", [(file.full_path, file.filename) for file in files])
+    connection.commit()
+
+    return Indexer(connection, Hasher()), files
+
+
+def _migrated_files(indexer):
+    return indexer.connection.execute("""
+        SELECT d.path || f.name, f.size, f.mtime_ns, h.digest
+        FROM files f
+        JOIN directories d ON d.dir_id = f.dir_id
+        JOIN hashes h ON h.hash_id = f.hash_id
+        ORDER BY f.name
+    """).fetchall()
+
+
+def test_new_index_has_the_current_version():
+    indexer = Indexer(create_connection(":memory:"), Hasher())
+    indexer.build_db()
+
+    assert indexer.connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert list(migrate(indexer)) == []
+
+
+def test_migrate_legacy_index(tmp_path):
+    indexer, files = _legacy_index(tmp_path, 1)
+    assert indexer.get_schema_version() == 1
+
+    assert [version for version, _ in migrate(indexer)] == [2, 3, 4, 5, 6]
+
+    assert indexer.get_schema_version() == SCHEMA_VERSION
+    assert indexer.needs_upgrade() is False
+    assert _migrated_files(indexer) == [
+        (files[0].full_path, 10, None, b"\xaa\xbb"),
+        (files[1].full_path, None, None, b"\xaa\xbb"),
+    ]
+    assert indexer.get_hasher_settings() == (Hasher.SAMPLED, Hasher.DEFAULT_ALGORITHM)
+
+
+def test_interrupted_migration_is_resumed(mocker, tmp_path):
+    indexer, files = _legacy_index(tmp_path, 4)
+    directory_ids = indexer.directory_ids
+    calls = []
+
+    def interrupted(cursor, paths):
+        calls.append(paths)
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        return directory_ids(cursor, paths)
+
+    mocker.patch.object(indexer, "directory_ids", side_effect=interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        list(migrate(indexer, batch_size=2))
+    indexer.connection.rollback()
+
+    assert indexer.get_schema_version() == 1
+    assert indexer.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 4
+
+    assert [version for version, _ in migrate(indexer, batch_size=2)] == [2, 3, 4, 5, 6]
+    assert len(calls) == 4
+    assert [row[0] for row in _migrated_files(indexer)] == sorted(file.full_path for file in files)
+    assert indexer.get_meta('migrated_files') is None
+
+
+def test_version_2_index_gets_an_inode_index():
+    indexer = Indexer(create_connection(":memory:"), Hasher())
+    indexer.build_db()
+    indexer.connection.execute("DROP INDEX idx_inodes")
+    indexer.set_schema_version(2)
+
+    assert [version for version, _ in migrate(indexer)] == [3, 4, 5, 6]
+
+    assert indexer.get_schema_version() == SCHEMA_VERSION
+    assert indexer.connection.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = 'idx_inodes'").fetchone()[0] == 1
+
+
+def test_version_3_index_gets_perceptual_hash_blocks():
+    indexer = Indexer(create_connection(":memory:"), Hasher())
+    indexer.build_db()
+    indexer.connection.execute("""
+        CREATE TABLE perceptual_hashes (
+            dir_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phash INTEGER NOT NULL,
+            PRIMARY KEY (dir_id, name)
+        ) WITHOUT ROWID
+    """)
+    values = [0, 1 << 63, (1 << 64) - 1, 0x123456789abcdef0]
+    indexer.connection.executemany("INSERT INTO perceptual_hashes VALUES (1, ?, ?)",
+                                   [(str(value), _to_signed(value)) for value in values])
+    indexer.set_schema_version(3)
+
+    assert [version for version, _ in migrate(indexer)] == [4, 5, 6]
+
+    rows = indexer.connection.execute(
+        "SELECT name, {0} FROM perceptual_hashes".format(", ".join(BLOCK_COLUMNS))).fetchall()
+    assert sorted((int(row[0]), list(row[1:])) for row in rows) == sorted(
+        (value, split_blocks(value)) for value in values)
+    indexes = indexer.connection.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_perceptual_%'").fetchone()[0]
+    assert indexes == len(BLOCK_COLUMNS)
+
+
+def test_version_5_index_gets_wider_perceptual_hash_blocks():
+    indexer = Indexer(create_connection(":memory:"), Hasher())
+    indexer.build_db()
+    old_columns = ['block{0}'.format(i) for i in range(9)]
+    indexer.connection.execute("""
+        CREATE TABLE perceptual_hashes (
+            dir_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            phash INTEGER NOT NULL,
+            {0},
+            PRIMARY KEY (dir_id, name)
+        ) WITHOUT ROWID
+    """.format(", ".join("{0} INTEGER".format(column) for column in old_columns)))
+    for column in old_columns:
+        indexer.connection.execute("CREATE INDEX idx_perceptual_{0} ON perceptual_hashes ( {0} )".format(column))
+    values = [0, 1 << 63, (1 << 64) - 1, 0x123456789abcdef0]
+    indexer.connection.executemany("INSERT INTO perceptual_hashes (dir_id, name, phash) VALUES (1, ?, ?)",
+                                   [(str(value), _to_signed(value)) for value in values])
+    indexer.set_schema_version(5)
+
+    assert [version for version, _ in migrate(indexer)] == [6]
+
+    columns = [row[1] for row in indexer.connection.execute("PRAGMA table_info(perceptual_hashes)").fetchall()]
+    assert columns == ['dir_id', 'name', 'phash'] + BLOCK_COLUMNS
+    rows = indexer.connection.execute(
+        "SELECT name, phash, {0} FROM perceptual_hashes".format(", ".join(BLOCK_COLUMNS))).fetchall()
+    assert sorted((int(row[0]), _to_unsigned(row[1]), list(row[2:])) for row in rows) == sorted(
+        (value, value, split_blocks(value)) for value in values)
+    indexes = indexer.connection.execute(
+        "SELECT tbl_name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_perceptual_%'").fetchall()
+    assert indexes == [('perceptual_hashes',)] * len(BLOCK_COLUMNS)
+
+
+def test_version_4_index_drops_the_tree_hashes():
+    indexer = Indexer(create_connection(":memory:"), Hasher())
+    indexer.build_db()
+    TreeIndex(indexer).build()
+    indexer.set_schema_version(4)
+
+    assert [version for version, _ in migrate(indexer)] == [5, 6]
+
+    assert not indexer.has_table('tree_hashes')
+
+
+def test_relative_legacy_paths_are_resolved_against_the_base(tmp_path):
+    indexer, files = _legacy_index(tmp_path, 1)
+    indexer.connection.execute("UPDATE files SET full_path = '0.txt' WHERE full_path = ?", (files[0].full_path, ))
+
+    with pytest.raises(ValueError):
+        list(migrate(indexer))
+    assert indexer.get_schema_version() == 1
+
+    assert [version for version, _ in migrate(indexer, base=str(tmp_path))] == [2, 3, 4, 5, 6]
+    assert [row[0] for row in _migrated_files(indexer)] == [file.full_path for file in files]
+    assert indexer.get_meta('migration_base') is None
@@ -0,0 +1,145 @@
+import random
+import pytest
+from hashdex.files import DirectoryScanner
+from hashdex.indexer import UNCHANGED
+from hashdex.perceptual import (PerceptualIndex, BLOCKS, DEFAULT_DISTANCE, MAX_RADIUS, hamming, split_blocks,
+                                _nearby, _to_signed, _to_unsigned)
+
+
+def test_hashes_survive_signed_storage():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= _to_signed(value) < (1 << 63)
+        assert _to_unsigned(_to_signed(value)) == value
+
+
+def test_blocks_cover_every_bit_of_signed_and_unsigned_hashes():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1, 0x123456789abcdef0):
+        blocks = split_blocks(value)
+        assert split_blocks(_to_signed(value)) == blocks
+        assert sum(block << shift for block, (shift, _) in zip(blocks, BLOCKS)) == value
+
+
+def _flip(rng, value, bits):
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def hashes(mocker, indexer, add_directory, tmp_path):
+    # perceptual hashes of indexed files, without decoding any image
+    rng = random.Random(0)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    values += [_flip(rng, value, i % 11) for i, value in enumerate(values[:100])]
+    for i in range(len(values)):
+        (tmp_path / "{0}.jpg".format(i)).write_bytes(b"")
+    mocker.patch("hashdex.perceptual.image_hash", side_effect=lambda file: values[int(file.filename[:-4])])
+    perceptual = PerceptualIndex(indexer)
+    add_directory(tmp_path, index=perceptual)
+    return perceptual, dict((str(tmp_path / "{0}.jpg".format(i)), value) for i, value in enumerate(values))
+
+
+def test_search_finds_the_same_hashes_as_brute_force(hashes):
+    perceptual, values = hashes
+    queries = list(values.values())[:20] + list(values.values())[-20:]
+
+    for query in queries:
+        for max_distance in (0, 3, DEFAULT_DISTANCE, 12, len(BLOCKS) * (MAX_RADIUS + 1)):
+            expected = sorted((hamming(query, value), path) for path, value in values.items()
+                              if hamming(query, value) <= max_distance)
+            assert perceptual.search(query, max_distance) == expected
+
+
+def test_nearby_blocks_differ_in_at_most_the_radius():
+    values = _nearby(0x1234, 16, 2)
+
+    assert len(values) == len(set(values)) == 1 + 16 + 120
+    assert all(hamming(value, 0x1234) <= 2 for value in values)
+
+
+def test_search_only_compares_hashes_with_a_nearby_block(mocker, hashes):
+    perceptual, values = hashes
+    compare = mocker.patch("hashdex.perceptual.hamming", side_effect=hamming)
+    rng = random.Random(1)
+
+    for _ in range(20):
+        perceptual.search(rng.getrandbits(64))
+
+    # a random hash has a block within two bits of one of the four blocks of about one in 120 of the others
+    assert compare.call_count < 20 * len(values) // 50
+
+
+def test_search_compares_all_hashes_beyond_the_largest_radius(mocker, hashes):
+    perceptual, values = hashes
+    compare = mocker.patch("hashdex.perceptual.hamming", side_effect=hamming)
+
+    perceptual.search(0, len(BLOCKS) * (MAX_RADIUS + 1))
+
+    assert compare.call_count == len(values)
+
+
+def _draw(path, seed, size=(400, 300), quality=None):
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGB', (400, 300), (128, 128, 128))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.randrange(300), rng.randrange(200)
+        draw.ellipse([x, y, x + rng.randrange(50, 150), y + rng.randrange(50, 150)],
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.resize(size).save(str(path), quality=quality) if quality else image.resize(size).save(str(path))
+
+
+@pytest.fixture
+def images(tmp_path):
+    pytest.importorskip("PIL")
+    (tmp_path / "photos").mkdir()
+    (tmp_path / "uploads").mkdir()
+    _draw(tmp_path / "photos" / "beach.png", 1)
+    _draw(tmp_path / "photos" / "forest.png", 2)
+    _draw(tmp_path / "photos" / "beach-small.jpg", 1, (200, 150), 60)
+    (tmp_path / "photos" / "notes.txt").write_text(u"not an image")
+    (tmp_path / "photos" / "broken.jpg").write_bytes(b"not an image either")
+    _draw(tmp_path / "uploads" / "forest.jpg", 2, (800, 600), 80)
+    return tmp_path
+
+
+def test_resized_copies_are_grouped(indexer, add_directory, images):
+    perceptual = PerceptualIndex(indexer)
+    results = add_directory(images / "photos", index=perceptual)
+
+    assert len(results) == 5
+    groups = [set(path for _, path in group) for group in perceptual.similar_groups()]
+    assert groups == [set([str(images / "photos" / "beach.png"), str(images / "photos" / "beach-small.jpg")])]
+
+
+def test_unchanged_images_are_not_hashed_again(mocker, indexer, add_directory, images):
+    add_directory(images / "photos", index=PerceptualIndex(indexer))
+    dhash = mocker.patch("hashdex.perceptual.dhash", side_effect=OSError)
+
+    results = add_directory(images / "photos", incremental=True, index=PerceptualIndex(indexer))
+
+    assert set(status for _, status in results) == set([UNCHANGED])
+    # only the image which can't be decoded has no perceptual hash
+    assert dhash.call_count == 1
+
+
+def test_similar_images_are_found_for_new_files(indexer, add_directory, images):
+    perceptual = PerceptualIndex(indexer)
+    add_directory(images / "photos", index=perceptual)
+
+    found = list(perceptual.find_similar(DirectoryScanner(str(images / "uploads")).get_files()))
+
+    assert [(file.filename, [path for _, path in matches]) for file, matches in found] == [
+        ("forest.jpg", [str(images / "photos" / "forest.png")])]
+
+
+def test_perceptual_hashes_of_removed_files_are_purged(indexer, add_directory, images):
+    perceptual = PerceptualIndex(indexer)
+    add_directory(images / "photos", index=perceptual)
+    indexer.connection.execute("DELETE FROM files WHERE name = 'beach.png'")
+
+    indexer.purge_orphans()
+
+    assert len(list(perceptual.iter_hashes())) == 2
+    assert indexer.connection.execute("SELECT COUNT(*) FROM perceptual_hashes").fetchone()[0] == 2
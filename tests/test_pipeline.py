@@ -0,0 +1,94 @@
+import asyncio
+import os
+import pytest
+from hashdex.cache import HashCache
+from hashdex.files import DirectoryScanner
+from hashdex.indexer import Indexer, create_connection, NEW, UNCHANGED
+from hashdex.pipeline import Pipeline
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def directory(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "same.txt").write_bytes(b"same" * 100)
+        (tmp_path / name / "unique.txt").write_bytes(name.encode() * (10 + len(name)))
+    (tmp_path / "b" / "unique.txt").write_bytes(b"b" * 20)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_pipeline_indexes_files(indexer, directory, jobs):
+    results = []
+    pipeline = Pipeline(DirectoryScanner(directory), indexer, jobs, batch_size=2, queue_size=1)
+
+    statuses = _run(pipeline.run(lambda file, status: results.append(file.filename)))
+
+    assert statuses == {NEW: 4}
+    assert sorted(results) == ['same.txt', 'same.txt', 'unique.txt', 'unique.txt']
+    assert indexer.get_index_count() == 4
+    assert [len(result.get_files()) for result in indexer.get_duplicates()] == [2]
+
+
+def test_incremental_pipeline_skips_unchanged_files(mocker, indexer, directory):
+    _run(Pipeline(DirectoryScanner(directory), indexer).run())
+    hash_content = mocker.spy(indexer.hasher, "_hash_content")
+
+    statuses = _run(Pipeline(DirectoryScanner(directory), indexer, incremental=True).run())
+
+    assert statuses == {UNCHANGED: 4}
+    assert hash_content.called is False
+
+
+def test_pipeline_reports_stage_stats(indexer, directory):
+    pipeline = Pipeline(DirectoryScanner(directory), indexer, jobs=2)
+    _run(pipeline.run())
+
+    stats = dict((stage.name, stage) for stage in pipeline.stats)
+    assert [stats[name].items for name in ('scan', 'lookup', 'hash', 'write')] == [4, 4, 1, 4]
+    assert all(stage.elapsed > 0 for stage in pipeline.stats)
+    assert str(stats['hash']).startswith("hash: 1 files in")
+
+
+def test_pipeline_uses_the_hash_cache(mocker, indexer, directory):
+    indexer.hasher.cache = HashCache(create_connection(":memory:", check_same_thread=False))
+    _run(Pipeline(DirectoryScanner(directory), indexer).run())
+    assert indexer.hasher.cache.count() == 2
+
+    other = Indexer(create_connection(":memory:", check_same_thread=False), indexer.hasher)
+    other.build_db()
+    hash_content = mocker.spy(indexer.hasher, "_hash_content")
+    _run(Pipeline(DirectoryScanner(directory), other).run())
+
+    assert hash_content.called is False
+
+
+def test_pipeline_errors_are_raised(mocker, indexer, directory):
+    mocker.patch.object(indexer.hasher, "_hash_content", side_effect=OSError("unreadable"))
+
+    with pytest.raises(OSError):
+        _run(Pipeline(DirectoryScanner(directory), indexer, jobs=2).run())
+
+
+def test_pipeline_reads_hardlinks_once(mocker, indexer, tmp_path):
+    (tmp_path / "copy").write_bytes(b"x" * 100)
+    (tmp_path / "0").mkdir()
+    (tmp_path / "0" / "file").write_bytes(b"x" * 100)
+    for snapshot in range(1, 6):
+        (tmp_path / str(snapshot)).mkdir()
+        os.link(str(tmp_path / "0" / "file"), str(tmp_path / str(snapshot) / "file"))
+    hash_content = mocker.spy(indexer.hasher, "_hash_content")
+
+    _run(Pipeline(DirectoryScanner(str(tmp_path)), indexer, jobs=3, batch_size=2).run())
+
+    assert hash_content.call_count == 2
+    [result] = indexer.get_duplicates()
+    assert len(result.dupes) == 7 and result.copies == 2
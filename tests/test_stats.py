@@ -0,0 +1,40 @@
+import json
+from hashdex.files import DirectoryScanner
+from hashdex.hashing import Hasher
+from hashdex.stats import Stats, measure, timed_iter
+
+
+def test_stages_accumulate_counts_and_bytes():
+    stats = Stats()
+    for size in (10, 20):
+        stats.stop('read', stats.start(), 1, size)
+
+    stage = stats.stages['read']
+    assert (stage.count, stage.bytes) == (2, 30)
+    assert stage.wall >= 0 and stage.cpu >= 0
+    assert json.loads(stats.to_json())['stages']['read']['bytes'] == 30
+
+
+def test_timed_iter_counts_items():
+    stats = Stats()
+
+    assert list(timed_iter(stats, 'scan', ['ab', 'c'], len)) == ['ab', 'c']
+    assert (stats.stages['scan'].count, stats.stages['scan'].bytes) == (2, 3)
+
+
+def test_measure_without_stats_only_calls_function():
+    assert measure(None, 'lookup', 1, 0, max, 1, 2) == 2
+
+
+def test_hasher_records_read_and_hash_stages(tmp_path):
+    (tmp_path / "x.txt").write_bytes(b"x" * 100)
+    file = DirectoryScanner(str(tmp_path)).get_files()[0]
+    hasher = Hasher(Hasher.FULL)
+    expected = hasher.get_hashes(file)
+
+    hasher.stats = Stats()
+
+    assert hasher.get_hashes(file) == expected
+    assert [(hasher.stats.stages[name].count, hasher.stats.stages[name].bytes) for name in ('read', 'hash')] == [
+        (1, 100), (1, 100)]
+    assert "read" in hasher.stats.summary()
@@ -0,0 +1,110 @@
+import pytest
+from hashdex.cleanup import Cleaner
+from hashdex.trees import TreeIndex
+
+
+def _write_album(path, extra=b""):
+    (path / "raw").mkdir(parents=True)
+    (path / "cover.jpg").write_bytes(b"cover" + extra)
+    (path / "raw" / "1.cr2").write_bytes(b"first photo" + extra)
+    (path / "raw" / "2.cr2").write_bytes(b"second photo" + extra)
+
+
+@pytest.fixture
+def photos(tmp_path):
+    _write_album(tmp_path / "photos" / "2019")
+    _write_album(tmp_path / "backup" / "2019")
+    _write_album(tmp_path / "photos" / "2020", b" changed")
+    return tmp_path
+
+
+def _groups(tree_index, **kwargs):
+    return [result.get_files() for result in tree_index.get_duplicates(**kwargs)]
+
+
+def test_copied_directories_are_reported_once(indexer, add_directory, photos):
+    add_directory(photos)
+
+    groups = _groups(TreeIndex(indexer))
+
+    # the raw directories of both copies are part of the copy of their parent
+    assert groups == [[str(photos / "backup" / "2019") + "/", str(photos / "photos" / "2019") + "/"]]
+
+
+def test_copies_within_a_copied_directory_are_reported(indexer, add_directory, photos):
+    _write_album(photos / "photos" / "2019" / "again")
+    _write_album(photos / "backup" / "2019" / "again")
+    add_directory(photos)
+
+    groups = _groups(TreeIndex(indexer))
+
+    # both raw directories of an album are copies, unlike the copy of the album in its copied parent
+    assert groups == [
+        [str(photos / "backup" / "2019") + "/", str(photos / "photos" / "2019") + "/"],
+        [
+            str(photos / "backup" / "2019" / "again" / "raw") + "/",
+            str(photos / "backup" / "2019" / "raw") + "/",
+            str(photos / "photos" / "2019" / "again" / "raw") + "/",
+            str(photos / "photos" / "2019" / "raw") + "/",
+        ],
+    ]
+
+
+def test_only_changed_directories_are_hashed_again(mocker, indexer, add_directory, photos):
+    add_directory(photos)
+    tree_index = TreeIndex(indexer)
+    tree_index.update()
+    hash_directory = mocker.spy(TreeIndex, "_hash_directory")
+
+    (photos / "backup" / "2019" / "raw" / "3.cr2").write_bytes(b"third photo")
+    add_directory(photos / "backup" / "2019" / "raw")
+
+    assert _groups(tree_index) == []
+    hashed = set(call[0][1] for call in hash_directory.call_args_list)
+    assert str(photos / "backup" / "2019" / "raw") + "/" in hashed
+    assert str(photos / "backup") + "/" in hashed
+    assert str(photos / "photos" / "2019") + "/" not in hashed
+    assert str(photos / "photos") + "/" not in hashed
+
+
+def test_removed_files_change_the_directory_hash(indexer, add_directory, photos):
+    add_directory(photos)
+    tree_index = TreeIndex(indexer)
+    assert _groups(tree_index)
+
+    (photos / "backup" / "2019" / "cover.jpg").unlink()
+    list(Cleaner(indexer).clean())
+
+    assert _groups(tree_index) == [
+        [str(photos / "backup" / "2019" / "raw") + "/", str(photos / "photos" / "2019" / "raw") + "/"]]
+
+
+def test_directories_with_unhashed_files_have_no_hash(indexer, add_directory, tmp_path):
+    (tmp_path / "unique").mkdir()
+    (tmp_path / "unique" / "file").write_bytes(b"only file of this size")
+    add_directory(tmp_path)
+
+    hashes = TreeIndex(indexer).update()
+
+    assert hashes[str(tmp_path / "unique") + "/"] == (None, 22, 1)
+
+
+def test_read_only_index_is_not_written(indexer, add_directory, photos):
+    add_directory(photos)
+    indexer.read_only = True
+
+    assert len(_groups(TreeIndex(indexer))) == 1
+    assert not indexer.has_table('tree_hashes')
+
+
+def test_directories_differing_in_the_tail_of_a_large_file_are_not_copies(indexer, add_directory, tmp_path):
+    # the sampled hash only reads the first 500KB of files of 1MB or more
+    head = b"h" * 600000
+    for directory, tail in (("a", b"t" * 600010), ("b", b"u" * 600020)):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "x.bin").write_bytes(head + tail)
+        (tmp_path / "copies").mkdir(exist_ok=True)
+        (tmp_path / "copies" / directory).write_bytes(head + tail)
+    add_directory(tmp_path)
+
+    assert _groups(TreeIndex(indexer)) == []
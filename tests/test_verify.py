@@ -0,0 +1,68 @@
+from six.moves import builtins
+from hashdex.verify import Verifier
+
+
+def _write(tmp_path, **contents):
+    paths = []
+    for name, content in sorted(contents.items()):
+        path = tmp_path / name
+        path.write_bytes(content)
+        paths.append(str(path))
+    return paths
+
+
+def test_identical_files_stay_in_one_group(tmp_path):
+    paths = _write(tmp_path, a=b"abcdef", b=b"abcdef", c=b"abcdef")
+    assert Verifier().split(paths) == [paths]
+
+
+def test_group_is_split_where_content_diverges(tmp_path):
+    verifier = Verifier()
+    verifier.CHUNK_SIZE = 2
+    a, b, c, d = _write(tmp_path, a=b"abcdef", b=b"abXdef", c=b"abcdef", d=b"abXdef")
+
+    assert verifier.split([a, b, c, d]) == [[a, c], [b, d]]
+
+
+def test_every_file_is_read_once(mocker, tmp_path):
+    verifier = Verifier()
+    verifier.CHUNK_SIZE = 2
+    paths = _write(tmp_path, a=b"abcdef", b=b"abcdef", c=b"abcdeX")
+    opened = mocker.spy(builtins, "open")
+
+    assert verifier.split(paths) == [paths[:2], paths[2:]]
+    assert sorted(call[0][0] for call in opened.call_args_list) == paths
+
+
+def test_groups_over_the_open_file_limit(tmp_path):
+    verifier = Verifier()
+    verifier.CHUNK_SIZE = 2
+    verifier.MAX_OPEN_FILES = 1
+    a, b, c = _write(tmp_path, a=b"abcdef", b=b"abcdeX", c=b"abcdef")
+
+    assert verifier.split([a, b, c]) == [[a, c], [b]]
+
+
+def test_missing_file_does_not_match(tmp_path):
+    a, b = _write(tmp_path, a=b"abc", b=b"abc")
+    missing = str(tmp_path / "missing")
+
+    assert Verifier().split([a, missing, b]) == [[a, b], [missing]]
+
+
+def test_parallel_verification_keeps_group_order(tmp_path):
+    groups = []
+    for i in range(10):
+        groups.append((_write(tmp_path, **{"x{0}".format(i): b"x", "y{0}".format(i): str(i).encode()}), 1))
+
+    expected = list(Verifier().split_groups(groups))
+    assert list(Verifier(jobs=4).split_groups(groups)) == expected
+
+
+def test_small_groups_are_not_verified(mocker, tmp_path):
+    verifier = Verifier(min_size=10)
+    split = mocker.spy(verifier, "split")
+    paths = _write(tmp_path, a=b"abc", b=b"xyz")
+
+    assert list(verifier.split_groups([(paths, 3)])) == [(3, [paths])]
+    assert split.called is False